@@ -321,8 +321,13 @@ rec {
   };
 
   # Phase 2: build complete machine configurations.
-  machines = { names }:
-    let nodes' = filterAttrs (n: v: elem n names) nodes; in
+  # The configurations of the machines in ‘names’.  Machines listed in
+  # ‘prebuilt’ are not evaluated; the given store path is used instead.
+  machines = { names, prebuilt ? {} }:
+    let
+      nodes' = filterAttrs (n: v: elem n names && !hasAttr n prebuilt) nodes;
+      prebuilt' = filterAttrs (n: v: elem n names) prebuilt;
+    in
     runCommand "nixops-machines"
       { preferLocalBuild = true; }
       ''
@@ -330,6 +335,9 @@ rec {
         ${toString (attrValues (mapAttrs (n: v: ''
           ln -s ${v.config.system.build.toplevel} $out/${n}
         '') nodes'))}
+        ${toString (attrValues (mapAttrs (n: v: ''
+          ln -s ${builtins.storePath v} $out/${n}
+        '') prebuilt'))}
       '';
 
 
@@ -3,11 +3,11 @@
 import os
 import re
 import azure
-import time
 import threading
 import requests
 
 from nixops.util import attr_property, check_wait
+import nixops.parallel
 import nixops.resources
 
 from azure import *
@@ -265,6 +265,9 @@ class ResourceState(nixops.resources.ResourceState):
         self._nrpc = None
         self._smc = None
 
+    def get_rate_limit_key(self):
+        return ("azure", self.subscription_id)
+
     def get_mgmt_credentials(self):
         with self.tokens_lock:
             token_id = "{0}|||{1}|||{2}".format(self.authority_url, self.user, self.password)
@@ -282,12 +285,17 @@ class ResourceState(nixops.resources.ResourceState):
                 self.tokens[token_id] = token
         return SubscriptionCloudCredentials(self.subscription_id, token['accessToken'])
 
+    # The clients are fetched for each API call, so this is where the
+    # calls are rate limited.
+
     def rmc(self):
+        nixops.parallel.throttle(self.get_rate_limit_key())
         if not self._rmc:
             self._rmc = ResourceManagementClient(self.get_mgmt_credentials())
         return self._rmc
 
     def cmc(self):
+        nixops.parallel.throttle(self.get_rate_limit_key())
         if not self._cmc:
             self.rmc().providers.register('Microsoft.Compute')
             self._cmc = ComputeManagementClient(self.get_mgmt_credentials())
@@ -296,12 +304,14 @@ class ResourceState(nixops.resources.ResourceState):
         return self._cmc
 
     def nrpc(self):
+        nixops.parallel.throttle(self.get_rate_limit_key())
         if not self._nrpc:
             self.rmc().providers.register('Microsoft.Network')
             self._nrpc = NetworkResourceProviderClient(self.get_mgmt_credentials())
         return self._nrpc
 
     def smc(self):
+        nixops.parallel.throttle(self.get_rate_limit_key())
         if not self._smc:
             self.rmc().providers.register('Microsoft.Storage')
             self._smc = StorageManagementClient(self.get_mgmt_credentials())
@@ -442,7 +452,7 @@ class ResourceState(nixops.resources.ResourceState):
             resource = self.get_resource()
             return self.is_settled(resource)
 
-        check_wait(check_settled, initial=1, max_tries=100, exception=True)
+        check_wait(check_settled, initial=1, max_tries=100, exception=True, category=self.get_type())
 
     def get_settled_resource(self, initial=1, factor=1, max_tries=60):
         def _get_resource():
@@ -451,18 +461,14 @@ class ResourceState(nixops.resources.ResourceState):
             except Exception as e:
                 self.log("Failed getting access to {0}".format(self.full_name))
                 raise
-        wait = initial
-        tries = 0
-        resource = _get_resource()
-
-        while tries < max_tries and not self.is_settled(resource):
-            wait = wait * factor
-            tries = tries + 1
-            if tries == max_tries:
-                raise Exception("resource failed to settle")
-            time.sleep(wait)
-            resource = _get_resource()
-        return resource
+        resource = [None]
+        def check_settled():
+            resource[0] = _get_resource()
+            return self.is_settled(resource[0])
+        if not check_wait(check_settled, initial=initial, factor=factor, max_tries=max_tries,
+                          exception=False, category=self.get_type()):
+            raise Exception("resource failed to settle")
+        return resource[0]
 
     def get_resource_state(self, cls, name):
         if cls is None:
@@ -2,9 +2,17 @@
 
 import os
 import re
+import sys
+import random
+import hashlib
+import tarfile
+import StringIO
 import subprocess
+import tempfile
 
 import nixops.util
+import nixops.wait
+import nixops.parallel
 import nixops.resources
 import nixops.ssh_util
 
@@ -53,6 +61,18 @@ class MachineState(nixops.resources.ResourceState):
     # this machine.
     cur_toplevel = nixops.util.attr_property("toplevel", None)
 
+    # Nix store path of the last configuration built for this machine
+    # in incremental mode, and the hash of the inputs it was built
+    # from.
+    built_toplevel = nixops.util.attr_property("builtToplevel", None)
+    build_key = nixops.util.attr_property("buildKey", None)
+
+    # Nix store paths whose closures are known to be present on this
+    # machine, most recently copied first.  Since a valid store path
+    # implies that its closure is valid, this is a compact record of
+    # the machine's store contents.
+    valid_roots = nixops.util.attr_property("validStoreRoots", [], 'json')
+
     # Time (in Unix epoch) the instance was started, if known.
     start_time = nixops.util.attr_property("startTime", None, int)
 
@@ -67,6 +87,7 @@ class MachineState(nixops.resources.ResourceState):
         self.ssh.register_flag_fun(self.get_ssh_flags)
         self.ssh.register_host_fun(self.get_ssh_name)
         self.ssh.register_passwd_fun(self.get_ssh_password)
+        self.ssh.register_host_id_fun(self.get_ssh_host_id)
         self._ssh_private_key_file = None
 
     def prefix_definition(self, attr):
@@ -78,10 +99,11 @@ class MachineState(nixops.resources.ResourceState):
         return state == self.STARTING or state == self.UP
 
     def set_common_state(self, defn):
-        self.store_keys_on_machine = defn.store_keys_on_machine
-        self.keys = defn.keys
-        self.ssh_port = defn.ssh_port
-        self.has_fast_connection = defn.has_fast_connection
+        with self.depl._db:
+            self.store_keys_on_machine = defn.store_keys_on_machine
+            self.keys = defn.keys
+            self.ssh_port = defn.ssh_port
+            self.has_fast_connection = defn.has_fast_connection
 
     def stop(self):
         """Stop this machine, if possible."""
@@ -104,6 +126,15 @@ class MachineState(nixops.resources.ResourceState):
 
     # FIXME: Move this to ResourceState so that other kinds of
     # resources can be checked.
+    @classmethod
+    def prefetch_check(cls, machines):
+        """
+        Called with all machines of this type before they are checked,
+        so that backends can fetch their state in bulk rather than per
+        machine.
+        """
+        pass
+
     def check(self):
         """Check machine state."""
         res = CheckResult()
@@ -111,7 +142,18 @@ class MachineState(nixops.resources.ResourceState):
         return res
 
     def _check(self, res):
-        avg = self.get_load_avg()
+        # Get everything we need from the machine in a single round trip.
+        try:
+            [(avg_status, avg), (units_status, units), (tmp_status, _)] = self.run_batch(
+                ["cat /proc/loadavg",
+                 "systemctl --all --full --no-legend",
+                 "cat /etc/fstab | cut -d' ' -f 2 | grep '^/tmp$' &> /dev/null"],
+                timeout=15)
+            avg = avg.rstrip().split(' ') if avg_status == 0 else None
+            if avg is not None and len(avg) < 3: avg = None
+        except (nixops.ssh_util.SSHConnectionFailed, nixops.ssh_util.SSHCommandFailed):
+            avg = None
+
         if avg == None:
             if self.state == self.UP: self.state = self.UNREACHABLE
             res.is_reachable = False
@@ -123,8 +165,10 @@ class MachineState(nixops.resources.ResourceState):
             res.load = avg
 
             # Get the systemd units that are in a failed state or in progress.
-            out = self.run_command("systemctl --all --full --no-legend",
-                                   capture_stdout=True).split('\n')
+            if units_status != 0:
+                raise nixops.ssh_util.SSHCommandFailed(
+                    "unable to get the systemd units of machine ‘{0}’".format(self.name), units_status)
+            out = units.split('\n')
             res.failed_units = []
             res.in_progress_units = []
             for l in out:
@@ -146,11 +190,8 @@ class MachineState(nixops.resources.ResourceState):
                          and not match.group(1) == "tmp.mount":
                     res.failed_units.append(match.group(1))
 
-                if match and match.group(1) == "tmp.mount":
-                    try:
-                        self.run_command("cat /etc/fstab | cut -d' ' -f 2 | grep '^/tmp$' &> /dev/null")
-                    except:
-                        continue
+                # /tmp only counts if it's in /etc/fstab.
+                if match and match.group(1) == "tmp.mount" and tmp_status == 0:
                     res.failed_units.append(match.group(1))
 
     def restore(self, defn, backup_id, devices=[]):
@@ -165,6 +206,35 @@ class MachineState(nixops.resources.ResourceState):
         """Make backup of persistent disks, if possible."""
         self.warn("don't know how to make backup of disks for machine ‘{0}’".format(self.name))
 
+    def sync_disks(self):
+        """Flush the file system buffers of the machine before a backup."""
+        if self.state == self.STOPPED: return
+        res = subprocess.call(["ssh", "root@" + self.get_ssh_name()] + self.get_ssh_flags() + ["sync"])
+        if res != 0:
+            self.logger.log("running sync failed on {0}.".format(self.name))
+
+    @classmethod
+    def backup_machines(cls, machines, backup_id, executor):
+        """
+        Back up all ‘machines’ of this type, given as (machine,
+        definition) pairs, running the work through ‘executor’.  Each
+        machine must be synced (see sync_disks()) right before its
+        backup.  By default, this calls sync_disks() and backup() on
+        each machine.
+        """
+        def worker((m, defn)):
+            m.sync_disks()
+            m.backup(defn, backup_id)
+        executor.run(machines, worker)
+
+    @classmethod
+    def prefetch_backups(cls, machines):
+        """
+        Called with all machines of this type before get_backups(), so
+        that backends can fetch the state of the backups in bulk.
+        """
+        pass
+
     def reboot(self, hard=False):
         """Reboot this machine."""
         self.log("rebooting...")
@@ -182,11 +252,25 @@ class MachineState(nixops.resources.ResourceState):
     def reboot_sync(self, hard=False):
         """Reboot this machine and wait until it's up again."""
         self.reboot(hard=hard)
+        probe = nixops.wait.TCPProbe()
+        self._probe_reboot(probe)
+        probe.run(callback=lambda: self.log_continue("."))
+        self._rebooted()
+
+    def _probe_reboot(self, probe):
+        """
+        Add this machine to ‘probe’ to wait until it has gone down and
+        come back up, logging both transitions.
+        """
+        def on_change(is_open):
+            if is_open: self.log_end("[up]")
+            else: self.log_continue("[down]")
         self.log_start("waiting for the machine to finish rebooting...")
-        nixops.util.wait_for_tcp_port(self.get_ssh_name(), self.ssh_port, open=False, callback=lambda: self.log_continue("."))
-        self.log_continue("[down]")
-        nixops.util.wait_for_tcp_port(self.get_ssh_name(), self.ssh_port, callback=lambda: self.log_continue("."))
-        self.log_end("[up]")
+        probe.add(self.get_ssh_name(), self.ssh_port, states=[False, True],
+                  on_change=on_change, category=self.get_type())
+
+    def _rebooted(self):
+        """Called when the machine is up again after a reboot."""
         self.state = self.UP
         self.ssh_pinged = True
         self._ssh_pinged_this_time = True
@@ -199,45 +283,93 @@ class MachineState(nixops.resources.ResourceState):
         self.warn("machine ‘{0}’ doesn't have a rescue"
                   " system.".format(self.name))
 
-    def send_keys(self):
-        if self.state == self.RESCUE:
-            # Don't send keys when in RESCUE state, because we're most likely
-            # bootstrapping plus we probably don't have /run mounted properly
-            # so keys will probably end up being written to DISK instead of
-            # into memory.
-            return
-        if self.store_keys_on_machine: return
-        self.run_command("mkdir -m 0750 -p /run/keys"
-                         " && chown root:keys /run/keys")
-        for k, opts in self.get_keys().items():
-            self.log("uploading key ‘{0}’...".format(k))
-            tmp = self.depl.tempdir + "/key-" + self.name
-            f = open(tmp, "w+"); f.write(opts['text']); f.close()
-            outfile = "/run/keys/" + k
-            outfile_esc = "'" + outfile.replace("'", r"'\''") + "'"
-            self.run_command("rm -f " + outfile_esc)
-            self.upload_file(tmp, outfile)
-            self.run_command(
+    def _should_send_keys(self):
+        # Don't send keys when in RESCUE state, because we're most likely
+        # bootstrapping plus we probably don't have /run mounted properly
+        # so keys will probably end up being written to DISK instead of
+        # into memory.
+        return self.state != self.RESCUE and not self.store_keys_on_machine
+
+    def _prepare_keys_commands(self):
+        """
+        Return the commands that must be run before uploading the keys,
+        so that callers can batch them with other commands.  The last
+        one prints the SHA-256 hashes of the keys already on the machine.
+        """
+        return ["mkdir -m 0750 -p /run/keys && chown root:keys /run/keys",
+                "cd /run/keys && for f in *; do [ ! -f \"$f\" ] || sha256sum -- \"$f\"; done"]
+
+    def send_keys(self, prepared=None):
+        """
+        Upload the keys to /run/keys in a single tar stream, skipping
+        keys that the machine already has.  If ‘prepared’ is set, it
+        contains the results of running _prepare_keys_commands(),
+        which the caller has batched with other commands.
+        """
+        if not self._should_send_keys(): return
+        keys = self.get_keys()
+        if prepared is None:
+            prepared = self.run_batch(self._prepare_keys_commands(), stop_on_error=True)
+        for res in prepared:
+            if res is None or res[0] != 0:
+                raise nixops.ssh_util.SSHCommandFailed(
+                    "unable to prepare for uploading keys to machine ‘{0}’".format(self.name),
+                    res[0] if res else 1)
+        remote_hashes = {}
+        for l in prepared[-1][1].splitlines():
+            (h, name) = l.split("  ", 1)
+            remote_hashes[name] = h
+
+        def esc(s):
+            return "'" + s.replace("'", r"'\''") + "'"
+
+        script = ["set -e", "umask 077"]
+        changed = []
+        for k, opts in sorted(keys.items()):
+            text = opts['text']
+            if isinstance(text, unicode): text = text.encode("utf-8")
+            if remote_hashes.get(k) != hashlib.sha256(text).hexdigest():
+                changed.append((k, text))
+            script.append(
               ' '.join([
                 # chown only if user and group exist,
                 # else leave root:root owned
                 "(",
-                " getent passwd '{1}' >/dev/null &&",
-                " getent group '{2}' >/dev/null &&",
-                " chown '{1}:{2}' {0}",
-                ");",
+                " getent passwd {1} >/dev/null &&",
+                " getent group {2} >/dev/null &&",
+                " chown {1}:{2} {0}",
+                ") || true;",
                 # chmod either way
-                "chmod '{3}' {0}",
+                "chmod {3} {0}",
               ])
               .format(
-                outfile_esc,
-                opts['user'],
-                opts['group'],
-                opts['permissions']
+                esc("/run/keys/" + k),
+                esc(opts['user']),
+                esc(opts['group']),
+                esc(opts['permissions'])
               )
             )
-            os.remove(tmp)
-        self.run_command("touch /run/keys/done")
+        script.append("touch /run/keys/done")
+
+        if changed:
+            self.log("uploading {0} key(s) ({1} unchanged)...".format(len(changed), len(keys) - len(changed)))
+            upload = ['t="$(mktemp -d /run/keys/.upload-XXXXXX)"',
+                      'tar -x --no-same-owner -C "$t"']
+            upload += ["mv -f \"$t\"/{0} {1}".format(esc(k), esc("/run/keys/" + k)) for (k, text) in changed]
+            upload.append('rm -rf "$t"')
+            script[2:2] = upload
+
+        with tempfile.TemporaryFile(dir=self.depl.tempdir) as f:
+            if changed:
+                tar = tarfile.open(fileobj=f, mode="w")
+                for (k, text) in changed:
+                    info = tarfile.TarInfo(k)
+                    info.size = len(text)
+                    info.mode = 0600
+                    tar.addfile(info, StringIO.StringIO(text))
+                tar.close()
+                f.seek(0)
+            self.run_command("\n".join(script), stdin=f)
 
     def get_keys(self):
         return self.keys
@@ -255,6 +387,10 @@ class MachineState(nixops.resources.ResourceState):
     def get_ssh_password(self):
         return None
 
+    def get_ssh_host_id(self):
+        """Return a string identifying this machine to SSH, or None."""
+        return self.public_host_key or self.vm_id
+
     def get_ssh_for_copy_closure(self):
         return self.ssh
 
@@ -270,11 +406,24 @@ class MachineState(nixops.resources.ResourceState):
         """Return the IP address to be used to access resource "r" from this machine."""
         return r.public_ipv4
 
+    def get_address_key(self):
+        """
+        Return a key such that machines with equal keys get the same
+        result from address_to() for every resource, so that the hosts
+        entries of a network only have to be computed once per key.
+        Backends that override address_to() should override this too;
+        otherwise every machine gets its own key.
+        """
+        if type(self).address_to.im_func is not MachineState.address_to.im_func:
+            return self.name
+        return None
+
     def wait_for_ssh(self, check=False):
         """Wait until the SSH port is open on this machine."""
         if self.ssh_pinged and (not check or self._ssh_pinged_this_time): return
         self.log_start("waiting for SSH...")
-        nixops.util.wait_for_tcp_port(self.get_ssh_name(), self.ssh_port, callback=lambda: self.log_continue("."))
+        nixops.util.wait_for_tcp_port(self.get_ssh_name(), self.ssh_port,
+                                      callback=lambda: self.log_continue("."), category=self.get_type())
         self.log_end("")
         if self.state != self.RESCUE:
             self.state = self.UP
@@ -307,6 +456,17 @@ class MachineState(nixops.resources.ResourceState):
             command = "export LANG= LC_ALL= LC_TIME=; " + command
         return self.ssh.run_command(command, self.get_ssh_flags(), **kwargs)
 
+    def run_batch(self, commands, stop_on_error=False, **kwargs):
+        """
+        Execute several commands on the machine in a single SSH session.
+
+        For possible keyword arguments, please have a look at
+        nixops.ssh_util.run_batch() and run_command().
+        """
+        return nixops.ssh_util.run_batch(
+            lambda script: self.run_command(script, capture_stdout=True, **kwargs),
+            commands, stop_on_error)
+
     def switch_to_configuration(self, method, sync, command=None):
         """
         Execute the script to switch to new configuration.
@@ -322,26 +482,104 @@ class MachineState(nixops.resources.ResourceState):
         return self.run_command(cmd, check=False)
 
     def copy_closure_to(self, path):
-        """Copy a closure to this machine."""
+        """
+        Copy a closure to this machine.  Returns the number of store
+        paths copied and their total size.
+        """
 
         # !!! Implement copying between cloud machines, as in the Perl
         # version.
 
         ssh = self.get_ssh_for_copy_closure()
 
+        # Only ask the machine about the paths that are not in the
+        # closure of a path it is known to have.  Those paths are
+        # checked as well, in case they were garbage-collected.
+        closure = nixops.util.query_closure([path])
+        known = [p for p in self.valid_roots if os.path.exists(p)]
+        to_check = (set(closure) - set(nixops.util.query_closure(known))) | set(known)
+
+        missing = self._query_missing_paths(ssh, to_check)
+        if missing & set(known):
+            self.log("some paths are no longer present on the machine, checking all paths...")
+            known = []
+            missing = self._query_missing_paths(ssh, closure)
+        missing = [p for p in closure if p in missing]
+
+        sizes = nixops.util.query_path_sizes(closure)
+        missing_size = sum(sizes[p] for p in missing)
+        self.log("{0} of {1} store paths ({2:.1f} MiB) are already present, copying {3} paths ({4:.1f} MiB)"
+                 .format(len(closure) - len(missing), len(closure),
+                         (sum(sizes.itervalues()) - missing_size) / 1048576.0,
+                         len(missing), missing_size / 1048576.0))
+
+        # Any remaining paths are copied from the local machine.
+        if missing:
+            env = dict(os.environ)
+            env['NIX_SSHOPTS'] = ' '.join(ssh._get_flags() + ssh.get_master().opts)
+            self._logged_exec(
+                ["nix-copy-closure", "--to", ssh._get_target()] + missing
+                + ([] if self.has_fast_connection else ["--gzip"]),
+                env=env)
+
+        self.valid_roots = ([path] + [p for p in known if p != path])[:MAX_VALID_ROOTS]
+        return (len(missing), missing_size)
+
+    def substitute_paths(self, paths, port, public_key):
+        """
+        Let this machine substitute the store paths ‘paths’ from the
+        binary cache served on local port ‘port’, signed by
+        ‘public_key’, through a reverse SSH tunnel.  Paths that cannot
+        be substituted are ignored.
+        """
+        ssh = self.get_ssh_for_copy_closure()
+        remote_port = random.randint(20000, 40000)
+        with tempfile.TemporaryFile() as f:
+            f.write("".join(p + "\n" for p in paths))
+            f.seek(0)
+            ssh.run_command(
+                "xargs -r nix-store -r --ignore-unknown"
+                " --option binary-caches http://127.0.0.1:{0}"
+                " --option binary-cache-public-keys '{1}' > /dev/null".format(remote_port, public_key),
+                flags=["-R", "127.0.0.1:{0}:127.0.0.1:{1}".format(remote_port, port),
+                       "-o", "ExitOnForwardFailure=yes"],
+                stdin=f, check=False)
+
+    def copy_paths_from(self, source, paths, key_file):
+        """
+        Copy the store paths ‘paths’ from machine ‘source’ to this
+        machine over the network between them, rather than from the
+        local machine.  ‘key_file’ is the path on ‘source’ of an SSH
+        private key that gives access to this machine.
+        """
+        ssh_opts = "-i {0} -p {1} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null" \
+            .format(key_file, self.ssh_port)
+        with tempfile.TemporaryFile() as f:
+            f.write("".join(p + "\n" for p in paths))
+            f.seek(0)
+            source.run_command("NIX_SSHOPTS='{0}' xargs -r nix-copy-closure --to root@{1}"
+                               .format(ssh_opts, source.address_to(self)), stdin=f)
+
+    def _query_missing_paths(self, ssh, paths):
+        """
+        Return the subset of ‘paths’ that are not valid on this
+        machine, using a single SSH command that reads the paths from
+        its standard input.
+        """
+        if not paths: return set()
+
+        script = 'paths="$(mktemp)" && cat > "$paths" && '
         # It's usually faster to let the target machine download
         # substitutes from nixos.org, so try that first.
         if not self.has_fast_connection:
-            closure = subprocess.check_output(["nix-store", "-qR", path]).splitlines()
-            ssh.run_command("nix-store -j 4 -r --ignore-unknown " + ' '.join(closure), check=False)
+            script += '{ xargs -r nix-store -j 4 -r --ignore-unknown < "$paths" >&2 || true; } && '
+        script += 'xargs -r nix-store --check-validity --print-invalid < "$paths"; res=$?; rm -f "$paths"; exit $res'
 
-        # Any remaining paths are copied from the local machine.
-        env = dict(os.environ)
-        env['NIX_SSHOPTS'] = ' '.join(ssh._get_flags() + ssh.get_master().opts)
-        self._logged_exec(
-            ["nix-copy-closure", "--to", ssh._get_target(), path]
-            + ([] if self.has_fast_connection else ["--gzip"]),
-            env=env)
+        with tempfile.TemporaryFile() as f:
+            f.write("".join(p + "\n" for p in sorted(paths)))
+            f.seek(0)
+            out = ssh.run_command(script, stdin=f, capture_stdout=True)
+        return set(out.splitlines())
 
     def generate_vpn_key(self, check=False):
         key_missing = False
@@ -413,3 +651,44 @@ class CheckResult(object):
 
         # FIXME: add a check whether the active NixOS config on the
         # machine is correct.
+
+
+# Maximum number of store paths to remember in ‘valid_roots’.
+MAX_VALID_ROOTS = 5
+
+
+def _by_type(machines, key=lambda m: m):
+    by_type = {}
+    for m in machines: by_type.setdefault(type(key(m)), []).append(m)
+    return by_type
+
+
+def prefetch_check(machines):
+    """Call prefetch_check() for each type of machine in ‘machines’."""
+    for (cls, ms) in _by_type(machines).iteritems(): cls.prefetch_check(ms)
+
+
+def prefetch_backups(machines):
+    """Call prefetch_backups() for each type of machine in ‘machines’."""
+    for (cls, ms) in _by_type(machines).iteritems(): cls.prefetch_backups(ms)
+
+
+def backup_machines(machines, backup_id, executor):
+    """
+    Call backup_machines() for each type of machine in ‘machines’, a
+    list of (machine, definition) pairs.  Raises the exception of the
+    failed type, or MultipleExceptions if several failed.
+    """
+    exceptions = []
+    for (cls, ms) in _by_type(machines, key=lambda (m, defn): m).iteritems():
+        try:
+            cls.backup_machines(ms, backup_id, executor)
+        except nixops.parallel.MultipleExceptions as e:
+            exceptions.extend(e.exceptions)
+        except Exception:
+            exceptions.append(sys.exc_info())
+    if len(exceptions) == 1:
+        excinfo = exceptions[0]
+        raise excinfo[0], excinfo[1], excinfo[2]
+    if len(exceptions) > 1:
+        raise nixops.parallel.MultipleExceptions(exceptions)
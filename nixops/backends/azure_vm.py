@@ -890,7 +890,7 @@ class AzureState(MachineState, ResourceState):
             return ((self.fetch_public_ip() is not None)
                  or (self.cmc().get_long_running_operation_status(req.azure_async_operation).status
                         != ComputeOperationStatus.in_progress))
-        check_wait(check_req, initial=1, max_tries=500, exception=True)
+        check_wait(check_req, initial=1, max_tries=500, exception=True, category=self.get_type())
 
         req_status = self.cmc().get_long_running_operation_status(req.azure_async_operation)
         if req_status.status == ComputeOperationStatus.failed:
@@ -47,6 +47,9 @@ class ContainerState(MachineState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def get_address_key(self):
+        return ("container", self.host)
+
     def get_ssh_name(self):
         assert self.private_ipv4
         if self.host == "localhost":
@@ -16,6 +16,7 @@ from nixops.resources.ebs_volume import EBSVolumeState
 from nixops.resources.elastic_ip import ElasticIPState
 import nixops.resources.ec2_common
 import nixops.util
+import nixops.parallel
 import nixops.ec2_utils
 import nixops.known_hosts
 from xml import etree
@@ -120,6 +121,8 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         self._conn_vpc = None
         self._conn_route53 = None
         self._cached_instance = None
+        self._prefetched = None
+        self._prefetched_snapshots = None
 
 
     def _reset_state(self):
@@ -245,6 +248,13 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def get_address_key(self):
+        return "ec2"
+
+
+    def get_rate_limit_key(self):
+        return ("ec2", self.region, self.access_key_id)
+
 
     def connect(self):
         if self._conn: return self._conn
@@ -262,10 +272,8 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         if self._conn_route53:
             return
 
-        # Get the secret access key from the environment or from ~/.ec2-keys.
-        (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(self.route53_access_key_id)
-
-        self._conn_route53 = boto.connect_route53(access_key_id, secret_access_key)
+        self._conn_route53 = nixops.ec2_utils.get_connection(
+            "route53", None, self.route53_access_key_id, boto.connect_route53)
 
 
     def _get_spot_instance_request_by_id(self, request_id, allow_missing=False):
@@ -317,6 +325,15 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         return snapshots[0]
 
 
+    def _get_snapshot_progress(self, snapshot_id):
+        """Return the progress of a snapshot, or None if it doesn't exist."""
+        try:
+            return self._get_snapshot_by_id(snapshot_id).update()
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code != "InvalidSnapshot.NotFound": raise
+            return None
+
+
 
     def _wait_for_ip(self):
         self.log_start("waiting for IP address... ".format(self.name))
@@ -329,17 +346,15 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                 ready = False
             return ready
 
+        backoff = self.backoff()
         while True:
             instance = self._get_instance(update=True)
             self.log_continue("[{0}] ".format(instance.state))
             if instance.state not in {"pending", "running", "scheduling", "launching", "stopped"}:
                 raise Exception("EC2 instance ‘{0}’ failed to start (state is ‘{1}’)".format(self.vm_id, instance.state))
-            if instance.state != "running":
-                time.sleep(3)
-                continue
-            if _instance_ip_ready(instance):
+            if instance.state == "running" and _instance_ip_ready(instance):
                 break
-            time.sleep(3)
+            backoff.sleep()
 
         self.log_end("{0} / {1}".format(instance.ip_address, instance.private_ip_address))
 
@@ -370,9 +385,35 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         self.block_device_mapping = x
 
 
+    @classmethod
+    def prefetch_backups(cls, machines):
+        """
+        Describe the snapshots of the backups of all ‘machines’ with one
+        call per region, access key and batch of IDs, rather than one
+        call per snapshot.
+        """
+        groups = {}
+        for m in machines:
+            if m.region: groups.setdefault((m.region, m.access_key_id), []).append(m)
+
+        for ms in groups.itervalues():
+            conn = ms[0].connect()
+            snapshot_ids = [s for m in ms for b in m.backups.itervalues() for s in b.itervalues()]
+            snapshots = nixops.ec2_utils.describe_by_ids(
+                lambda ids, filters=None: conn.get_all_snapshots(snapshot_ids=ids, filters=filters),
+                snapshot_ids, "InvalidSnapshot.NotFound", id_filter="snapshot-id")
+            for m in ms:
+                m._prefetched_snapshots = {s: snapshots.get(s) for b in m.backups.itervalues() for s in b.itervalues()}
+
+
     def get_backups(self):
         if not self.region: return {}
         self.connect()
+
+        # Use what prefetch_backups() got, if it was called.
+        prefetched = self._prefetched_snapshots or {}
+        self._prefetched_snapshots = None
+
         backups = {}
         current_volumes = set([v['volumeId'] for v in self.block_device_mapping.values()])
         for b_id, b in self.backups.items():
@@ -385,16 +426,18 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     info.append("{0} - {1} - Not available in backup".format(self.name, _sd_to_xvd(k)))
                 else:
                     snapshot_id = b[k]
-                    try:
-                        snapshot = self._get_snapshot_by_id(snapshot_id)
-                        snapshot_status = snapshot.update()
+                    if snapshot_id in prefetched:
+                        snapshot = prefetched[snapshot_id]
+                        snapshot_status = snapshot.progress if snapshot else None
+                    else:
+                        snapshot_status = self._get_snapshot_progress(snapshot_id)
+                    if snapshot_status is None:
+                        info.append("{0} - {1} - {2} - Snapshot has disappeared".format(self.name, _sd_to_xvd(k), snapshot_id))
+                        backup_status = "unavailable"
+                    else:
                         info.append("progress[{0},{1},{2}] = {3}".format(self.name, _sd_to_xvd(k), snapshot_id, snapshot_status))
                         if snapshot_status != '100%':
                             backup_status = "running"
-                    except boto.exception.EC2ResponseError as e:
-                        if e.error_code != "InvalidSnapshot.NotFound": raise
-                        info.append("{0} - {1} - {2} - Snapshot has disappeared".format(self.name, _sd_to_xvd(k), snapshot_id))
-                        backup_status = "unavailable"
             backups[b_id]['status'] = backup_status
             backups[b_id]['info'] = info
         return backups
@@ -423,24 +466,55 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
 
 
     def backup(self, defn, backup_id):
-        self.connect()
+        self.backup_machines([(self, defn)], backup_id, nixops.parallel.Executor(nr_workers=1))
 
-        self.log("backing up machine ‘{0}’ using id ‘{1}’".format(self.name, backup_id))
-        backup = {}
-        _backups = self.backups
-        for k, v in self.block_device_mapping.items():
-            snapshot = self._retry(lambda: self._conn.create_snapshot(volume_id=v['volumeId']))
-            self.log("+ created snapshot of volume ‘{0}’: ‘{1}’".format(v['volumeId'], snapshot.id))
-
-            snapshot_tags = {}
-            snapshot_tags.update(defn.tags)
-            snapshot_tags.update(self.get_common_tags())
-            snapshot_tags['Name'] = "{0} - {3} [{1} - {2}]".format(self.depl.description, self.name, k, backup_id)
 
-            self._retry(lambda: self._conn.create_tags([snapshot.id], snapshot_tags))
-            backup[k] = snapshot.id
-        _backups[backup_id] = backup
-        self.backups = _backups
+    @classmethod
+    def backup_machines(cls, machines, backup_id, executor):
+        """
+        Back up all ‘machines’ concurrently, syncing each machine right
+        before snapshotting its volumes, then tag the snapshots with as
+        few CreateTags calls as possible.
+        """
+        # Record the snapshots that were created even if some failed,
+        # so that they show up as an incomplete backup.
+        created = {}
+
+        def worker((m, defn)):
+            m.log("backing up machine ‘{0}’ using id ‘{1}’".format(m.name, backup_id))
+            m.sync_disks()
+            conn = m.connect()
+            backup = created[m] = {}
+            for (k, v) in sorted(m.block_device_mapping.items()):
+                snapshot = m._retry(lambda: conn.create_snapshot(volume_id=v['volumeId']))
+                m.log("+ created snapshot of volume ‘{0}’: ‘{1}’".format(v['volumeId'], snapshot.id))
+                backup[k] = snapshot.id
+
+        exceptions = [res.excinfo for res in executor.stream(machines, worker) if res.excinfo]
+
+        groups = {}
+        for (m, defn) in machines:
+            for (k, snapshot_id) in created.get(m, {}).iteritems():
+                tags = {}
+                tags.update(defn.tags)
+                tags.update(m.get_common_tags())
+                tags['Name'] = "{0} - {3} [{1} - {2}]".format(m.depl.description, m.name, k, backup_id)
+                tags['CharonDevice'] = k
+                groups.setdefault((m.region, m.access_key_id), (m, {}))[1][snapshot_id] = tags
+
+        for (m, defn) in machines:
+            _backups = m.backups
+            _backups[backup_id] = created.get(m, {})
+            m.backups = _backups
+
+        for (m, tags) in groups.itervalues():
+            nixops.ec2_utils.create_tags_batched(m.connect(), tags, logger=m)
+
+        if len(exceptions) == 1:
+            excinfo = exceptions[0]
+            raise excinfo[0], excinfo[1], excinfo[2]
+        if len(exceptions) > 1:
+            raise nixops.parallel.MultipleExceptions(exceptions)
 
 
     def restore(self, defn, backup_id, devices=[]):
@@ -510,13 +584,13 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                 self.log_continue("[{0}] ".format(res))
                 return res == 'available'
 
-            nixops.util.check_wait(check_available)
+            nixops.util.check_wait(check_available, category=self.get_type())
             self.log_end('')
 
             if volume.update() != "available":
                 self.log("force detaching volume ‘{0}’ from instance ‘{1}’...".format(volume_id, volume.attach_data.instance_id))
                 volume.detach(True)
-                nixops.util.check_wait(check_available)
+                nixops.util.check_wait(check_available, category=self.get_type())
 
         self.log_start("attaching volume ‘{0}’ as ‘{1}’... ".format(volume_id, _sd_to_xvd(device)))
         if self.vm_id != volume.attach_data.instance_id:
@@ -531,13 +605,13 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
 
         # If volume is not in attached state, wait for it before going on.
         if volume.attach_data.status != "attached":
-            nixops.util.check_wait(check_attached)
+            nixops.util.check_wait(check_attached, category=self.get_type())
 
         # Wait until the device is visible in the instance.
         def check_dev():
             res = self.run_command("test -e {0}".format(_sd_to_xvd(device)), check=False)
             return res == 0
-        nixops.util.check_wait(check_dev)
+        nixops.util.check_wait(check_dev, category=self.get_type())
 
         self.log_end('')
 
@@ -550,6 +624,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             if elastic_ipv4 != "":
                 # wait until machine is in running state
                 self.log_start("waiting for machine to be in running state... ".format(self.name))
+                backoff = self.backoff()
                 while True:
                     self.log_continue("[{0}] ".format(instance.state))
                     if instance.state == "running":
@@ -558,7 +633,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                         raise Exception(
                             "EC2 instance ‘{0}’ failed to reach running state (state is ‘{1}’)"
                             .format(self.vm_id, instance.state))
-                    time.sleep(3)
+                    backoff.sleep()
                     instance = self._get_instance(update=True)
                 self.log_end("")
 
@@ -575,11 +650,12 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     addresses[0].associate(self.vm_id)
                     self.log_start("waiting for address to be associated with this machine... ")
                     instance = self._get_instance(update=True)
+                    backoff = self.backoff()
                     while True:
                         self.log_continue("[{0}] ".format(instance.ip_address))
                         if instance.ip_address == elastic_ipv4:
                             break
-                        time.sleep(3)
+                        backoff.sleep()
                         instance = self._get_instance(update=True)
                     self.log_end("")
 
@@ -673,6 +749,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             self._retry(lambda: self._conn.create_tags([self.spot_instance_request_id], tags))
 
             self.log_start("waiting for spot instance request ‘{0}’ to be fulfilled... ".format(self.spot_instance_request_id))
+            backoff = self.backoff()
             while True:
                 request = self._get_spot_instance_request_by_id(self.spot_instance_request_id)
                 self.log_continue("[{0}] ".format(request.status.code))
@@ -681,7 +758,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     self.spot_instance_request_id = None
                     self.log_end("")
                     raise Exception("spot instance request failed with result ‘{0}’".format(request.status.code))
-                time.sleep(3)
+                backoff.sleep()
             self.log_end("")
 
             instance = self._retry(lambda: self._get_instance(instance_id=request.instance_id))
@@ -716,6 +793,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         # Wait until it's really cancelled. It's possible that the
         # request got fulfilled while we were cancelling it. In that
         # case, record the instance ID.
+        backoff = self.backoff()
         while True:
             request = self._get_spot_instance_request_by_id(self.spot_instance_request_id, allow_missing=True)
             if request is None: break
@@ -725,7 +803,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     raise Exception("spot instance request got fulfilled unexpectedly as instance ‘{0}’".format(request.instance_id))
                 self.vm_id = request.instance_id
             if request.state != 'open': break
-            time.sleep(3)
+            backoff.sleep()
 
         self.log_end("")
 
@@ -921,10 +999,11 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         # There is a short time window during which EC2 doesn't
         # know the instance ID yet.  So wait until it does.
         if self.state != self.UP or check:
+            backoff = self.backoff()
             while True:
                 if self._get_instance(allow_missing=True): break
                 self.log("EC2 instance ‘{0}’ not known yet, waiting...".format(self.vm_id))
-                time.sleep(3)
+                backoff.sleep()
 
         if not self.virtualization_type:
             self.virtualization_type = self._get_instance().virtualization_type
@@ -1218,7 +1297,7 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         self.log("destroying EBS volume ‘{0}’...".format(volume_id))
         volume = nixops.ec2_utils.get_volume_by_id(self.connect(), volume_id, allow_missing=True)
         if not volume: return
-        nixops.util.check_wait(lambda: volume.update() == 'available')
+        nixops.util.check_wait(lambda: volume.update() == 'available', category=self.get_type())
         volume.delete()
 
 
@@ -1250,10 +1329,11 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             instance.terminate()
 
             # Wait until it's really terminated.
+            backoff = self.backoff()
             while True:
                 self.log_continue("[{0}] ".format(instance.state))
                 if instance.state == "terminated": break
-                time.sleep(3)
+                backoff.sleep()
                 instance = self._get_instance(update=True)
 
         self.log_end("")
@@ -1296,17 +1376,17 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                     .format(self.vm_id, instance.state))
             return False
 
-        if not nixops.util.check_wait(check_stopped, initial=3, max_tries=300, exception=False): # = 15 min
+        if not nixops.util.check_wait(check_stopped, initial=3, max_tries=300, exception=False, category=self.get_type()): # = 15 min
             # If stopping times out, then do an unclean shutdown.
             self.log_end("(timed out)")
             self.log_start("force-stopping EC2 machine... ")
             instance.stop(force=True)
-            if not nixops.util.check_wait(check_stopped, initial=3, max_tries=100, exception=False): # = 5 min
+            if not nixops.util.check_wait(check_stopped, initial=3, max_tries=100, exception=False, category=self.get_type()): # = 5 min
                 # Amazon docs suggest doing a force stop twice...
                 self.log_end("(timed out)")
                 self.log_start("force-stopping EC2 machine... ")
                 instance.stop(force=True)
-                nixops.util.check_wait(check_stopped, initial=3, max_tries=100) # = 5 min
+                nixops.util.check_wait(check_stopped, initial=3, max_tries=100, category=self.get_type()) # = 5 min
 
         self.log_end("")
 
@@ -1344,13 +1424,52 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
         self.send_keys()
 
 
+    @classmethod
+    def prefetch_check(cls, machines):
+        """
+        Describe the instances, instance statuses and volumes of all
+        ‘machines’ with one call per region, access key and batch of
+        IDs, rather than several calls per machine.
+        """
+        groups = {}
+        for m in machines:
+            if m.vm_id: groups.setdefault((m.region, m.access_key_id), []).append(m)
+
+        for ms in groups.itervalues():
+            conn = ms[0].connect()
+            instances = nixops.ec2_utils.describe_by_ids(
+                lambda ids, filters=None: conn.get_only_instances(instance_ids=ids, filters=filters),
+                [m.vm_id for m in ms], "InvalidInstanceID.NotFound", id_filter="instance-id")
+            statuses = nixops.ec2_utils.describe_by_ids(
+                lambda ids, filters=None: conn.get_all_instance_status(instance_ids=ids, filters=filters),
+                instances.keys(), "InvalidInstanceID.NotFound", batch_size=100)
+            volume_ids = {m.name: [v['volumeId'] for v in m.block_device_mapping.itervalues()
+                                   if v.get('volumeId', None)] for m in ms}
+            volumes = nixops.ec2_utils.describe_by_ids(
+                lambda ids, filters=None: conn.get_all_volumes(volume_ids=ids, filters=filters),
+                [v for vs in volume_ids.itervalues() for v in vs], "InvalidVolume.NotFound", id_filter="volume-id")
+            for m in ms:
+                m._cached_instance = instances.get(m.vm_id)
+                m._prefetched = {
+                    'status': [statuses[m.vm_id]] if m.vm_id in statuses else [],
+                    'volumes': {v: volumes.get(v) for v in volume_ids[m.name]},
+                }
+
+
     def _check(self, res):
         if not self.vm_id:
             res.exists = False
             return
 
+        # Use what prefetch_check() got, if it was called.
+        prefetched = self._prefetched
+        self._prefetched = None
+
         self.connect()
-        instance = self._get_instance(allow_missing=True)
+        if prefetched is not None and not self._cached_instance:
+            instance = None
+        else:
+            instance = self._get_instance(allow_missing=True)
         old_state = self.state
         #self.log("instance state is ‘{0}’".format(instance.state if instance else "gone"))
 
@@ -1372,7 +1491,10 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
                 if k not in instance.block_device_mapping.keys() and v.get('volumeId', None):
                     res.disks_ok = False
                     res.messages.append("volume ‘{0}’ not attached to ‘{1}’".format(v['volumeId'], _sd_to_xvd(k)))
-                    volume = nixops.ec2_utils.get_volume_by_id(self.connect(), v['volumeId'], allow_missing=True)
+                    if prefetched is not None:
+                        volume = prefetched['volumes'].get(v['volumeId'])
+                    else:
+                        volume = nixops.ec2_utils.get_volume_by_id(self.connect(), v['volumeId'], allow_missing=True)
                     if not volume:
                         res.messages.append("volume ‘{0}’ no longer exists".format(v['volumeId']))
 
@@ -1397,7 +1519,10 @@ class EC2State(MachineState, nixops.resources.ec2_common.EC2CommonState):
             self.state = self.STOPPED
 
         # check for scheduled events
-        instance_status = self._conn.get_all_instance_status(instance_ids=[instance.id])
+        if prefetched is not None:
+            instance_status = prefetched['status']
+        else:
+            instance_status = self._conn.get_all_instance_status(instance_ids=[instance.id])
         for ist in instance_status:
             if ist.events:
                 for e in ist.events:
@@ -153,6 +153,9 @@ class GCEState(MachineState, ResourceState):
         else:
             return MachineState.address_to(self, resource)
 
+    def get_address_key(self):
+        return ("gce", self.network)
+
     def full_metadata(self, metadata):
         result = metadata.copy()
         result.update({
@@ -554,7 +557,7 @@ class GCEState(MachineState, ResourceState):
 
             def check_stopped():
                 return self.node().state == NodeState.STOPPED
-            if nixops.util.check_wait(check_stopped, initial=3, max_tries=100, exception=False): # = 5 min
+            if nixops.util.check_wait(check_stopped, initial=3, max_tries=100, exception=False, category=self.get_type()): # = 5 min
                 self.log_end("stopped")
             else:
                 self.log_end("(timed out)")
@@ -178,9 +178,9 @@ class HetznerState(MachineState):
             # systems.
             self.log_start("waiting for rescue system...")
             dotlog = lambda: self.log_continue(".")
-            wait_for_tcp_port(ip, 22, open=False, callback=dotlog)
+            wait_for_tcp_port(ip, 22, open=False, callback=dotlog, category="hetzner")
             self.log_continue("[down]")
-            wait_for_tcp_port(ip, 22, callback=dotlog)
+            wait_for_tcp_port(ip, 22, callback=dotlog, category="hetzner")
             self.log_end("[up]")
         self.state = self.RESCUE
 
@@ -626,7 +626,7 @@ class HetznerState(MachineState):
         """
         self.log_start("waiting for system to shutdown... ")
         dotlog = lambda: self.log_continue(".")
-        wait_for_tcp_port(self.main_ipv4, 22, open=False, callback=dotlog)
+        wait_for_tcp_port(self.main_ipv4, 22, open=False, callback=dotlog, category=self.get_type())
         self.log_continue("[down]")
 
         self.state = self.STOPPED
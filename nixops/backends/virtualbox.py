@@ -74,6 +74,9 @@ class VirtualBoxState(MachineState):
             return m.private_ipv4
         return MachineState.address_to(self, m)
 
+    def get_address_key(self):
+        return "virtualbox"
+
     @property
     def _vbox_version(self):
         v = getattr(self, '_vbox_version_obj', None)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import urllib
+import posixpath
+import subprocess
+import threading
+import SimpleHTTPServer
+import SocketServer
+
+import nixops.util
+
+__all__ = ['LocalBinaryCache']
+
+
+def get_default_cache_dir():
+    return os.environ.get("HOME", "") + "/.nixops/binary-cache"
+
+
+class LocalBinaryCache(object):
+    """
+    A binary cache in a local directory, filled with nix-push, from
+    which machines can substitute store paths.  The NARs are compressed
+    only once, no matter how many machines need them, and the cache is
+    kept between runs.  The cache is signed with a key that is created
+    the first time it is used.  Machines reach the cache over an HTTP
+    server that only listens on the loopback interface, through a
+    reverse SSH tunnel.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.secret_key_file = self.cache_dir + ".secret-key"
+        self.public_key_file = self.cache_dir + ".public-key"
+        self._server = None
+
+    def get_public_key(self):
+        """Return the public key of the cache, creating it if necessary."""
+        if not os.path.exists(self.secret_key_file):
+            dir = os.path.dirname(self.secret_key_file)
+            if not os.path.exists(dir): os.makedirs(dir, 0700)
+            key_name = "nixops-{0}-1".format(socket.gethostname())
+            old_umask = os.umask(0077)
+            try:
+                subprocess.check_call(["nix-store", "--generate-binary-cache-key", key_name,
+                                       self.secret_key_file, self.public_key_file])
+            finally:
+                os.umask(old_umask)
+        with open(self.public_key_file) as f:
+            return f.read().strip()
+
+    def add_paths(self, paths, logger):
+        """
+        Add the closures of ‘paths’ to the cache.  Paths that are
+        already in the cache are not compressed again.
+        """
+        self.get_public_key()
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir, 0700)
+        nixops.util.logged_exec(
+            ["nix-push", "--dest", self.cache_dir, "--key-file", self.secret_key_file] + list(paths),
+            logger)
+
+    def serve(self):
+        """
+        Start serving the cache over HTTP on a free port on the loopback
+        interface, and return the port.
+        """
+        cache_dir = self.cache_dir
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                path = posixpath.normpath(urllib.unquote(path.split("?", 1)[0]))
+                return os.path.join(cache_dir, *[p for p in path.split("/") if p not in ("", ".", "..")])
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        thr = threading.Thread(target=self._server.serve_forever)
+        thr.daemon = True
+        thr.start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
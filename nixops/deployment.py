@@ -5,18 +5,24 @@ import os.path
 import subprocess
 import json
 import string
+import hashlib
 import tempfile
 import shutil
 import threading
 import exceptions
 import errno
 from collections import defaultdict
-from xml.etree import ElementTree
+from xml.etree import cElementTree as ElementTree
 import nixops.statefile
 import nixops.backends
 import nixops.logger
 import nixops.parallel
-from nixops.nix_expr import RawValue, Function, Call, nixmerge, py2nix
+import nixops.wait
+import nixops.known_hosts
+import nixops.trace
+import nixops.eval_cache
+import nixops.binary_cache
+from nixops.nix_expr import RawValue, Function, Call, nixmerge_all, py2nix
 import re
 from datetime import datetime, timedelta
 import getpass
@@ -37,6 +43,9 @@ class UnknownBackend(Exception):
 
 debug = False
 
+# How long ‘nixops reboot --wait’ waits for the machines to come back.
+REBOOT_TIMEOUT = 900
+
 class Deployment(object):
     """NixOps top-level deployment manager."""
 
@@ -50,7 +59,7 @@ class Deployment(object):
     configs_path = nixops.util.attr_property("configsPath", None)
     rollback_enabled = nixops.util.attr_property("rollbackEnabled", False)
 
-    def __init__(self, statefile, uuid, log_file=sys.stderr):
+    def __init__(self, statefile, uuid, log_file=sys.stderr, preloaded=None):
         self._statefile = statefile
         self._db = statefile._db
         self.uuid = uuid
@@ -62,6 +71,11 @@ class Deployment(object):
         self.nixos_version_suffix = None
         self._tempdir = None
 
+        # Cache of nix-instantiate results, or None to always
+        # evaluate.  Off by default, since its key doesn't cover every
+        # input of the evaluation (see nixops.eval_cache.EvalCache).
+        self.eval_cache = None
+
         self.logger = nixops.logger.Logger(log_file)
 
         self._lock_file_path = None
@@ -72,11 +86,26 @@ class Deployment(object):
         if not os.path.exists(self.expr_path):
             self.expr_path = os.path.dirname(__file__) + "/../nix"
 
+        # Load the deployment and resource attributes in bulk, so that
+        # attribute accesses don't hit the state file.  ‘preloaded’ is
+        # a tuple (attrs, resources, resource_attrs) as read by
+        # StateFile.get_all_deployments().
         self.resources = {}
+        self._attrs = None
+        self._resource_attrs = {}
         with self._db:
-            c = self._db.cursor()
-            c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
-            for (id, name, type) in c.fetchall():
+            if preloaded is None:
+                c = self._db.cursor()
+                self._load_attrs()
+                c.execute("select id, name, type from Resources where deployment = ?", (self.uuid,))
+                resources = c.fetchall()
+                self._resource_attrs = {id: {} for (id, name, type) in resources}
+                c.execute("select a.machine, a.name, a.value from ResourceAttrs a join Resources r on a.machine = r.id where r.deployment = ?", (self.uuid,))
+                for (id, name, value) in c.fetchall():
+                    self._resource_attrs[id][name] = value
+            else:
+                (self._attrs, resources, self._resource_attrs) = preloaded
+            for (id, name, type) in resources:
                 r = _create_state(self, type, name, id)
                 self.resources[name] = r
         self.logger.update_log_prefixes()
@@ -121,16 +150,41 @@ class Deployment(object):
         return res
 
 
+    def _load_attrs(self):
+        """Load all deployment attributes from the state file."""
+        with self._db:
+            self._db.flush_writes()
+            c = self._db.cursor()
+            c.execute("select name, value from DeploymentAttrs where deployment = ?", (self.uuid,))
+            self._attrs = dict(c.fetchall())
+            return self._attrs
+
+
+    def _invalidate_attrs(self):
+        self._attrs = None
+
+
+    def _take_resource_attrs(self, id):
+        """Return the preloaded attributes of resource ‘id’, if any."""
+        return self._resource_attrs.pop(id, None)
+
+
     def _set_attrs(self, attrs):
         """Update deployment attributes in the state file."""
         with self._db:
-            c = self._db.cursor()
+            cache = self._attrs if self._attrs is not None else self._load_attrs()
             for n, v in attrs.iteritems():
                 if v == None:
-                    c.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n))
+                    if n not in cache: continue
+                    self._db.queue_write("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, n))
+                    del cache[n]
                 else:
-                    c.execute("insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
-                              (self.uuid, n, v))
+                    v = nixops.util.state_file_value(v)
+                    if cache.get(n) == v: continue
+                    self._db.queue_write("insert or replace into DeploymentAttrs(deployment, name, value) values (?, ?, ?)",
+                                         (self.uuid, n, v))
+                    cache[n] = v
+                self._db.on_rollback(self._invalidate_attrs)
 
 
     def _set_attr(self, name, value):
@@ -140,18 +194,14 @@ class Deployment(object):
 
     def _del_attr(self, name):
         """Delete a deployment attribute from the state file."""
-        with self._db:
-            self._db.execute("delete from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
+        self._set_attrs({name: None})
 
 
     def _get_attr(self, name, default=nixops.util.undefined):
         """Get a deployment attribute from the state file."""
-        with self._db:
-            c = self._db.cursor()
-            c.execute("select value from DeploymentAttrs where deployment = ? and name = ?", (self.uuid, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        attrs = self._attrs
+        if attrs is None: attrs = self._load_attrs()
+        return attrs.get(name, nixops.util.undefined)
 
 
     def _create_resource(self, name, type):
@@ -162,6 +212,7 @@ class Deployment(object):
         c.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
                   (self.uuid, name, type))
         id = c.lastrowid
+        self._resource_attrs[id] = {}
         r = _create_state(self, type, name, id)
         self.resources[name] = r
         return r
@@ -169,6 +220,7 @@ class Deployment(object):
 
     def export(self):
         with self._db:
+            self._db.flush_writes()
             c = self._db.cursor()
             c.execute("select name, value from DeploymentAttrs where deployment = ?", (self.uuid,))
             rows = c.fetchall()
@@ -191,9 +243,11 @@ class Deployment(object):
     def clone(self):
         with self._db:
             new = self._statefile.create_deployment()
+            self._db.flush_writes()
             self._db.execute("insert into DeploymentAttrs (deployment, name, value) " +
                              "select ?, name, value from DeploymentAttrs where deployment = ?",
                              (new.uuid, self.uuid))
+            new._load_attrs()
             new.configs_path = None
             return new
 
@@ -226,6 +280,7 @@ class Deployment(object):
     def delete_resource(self, m):
         del self.resources[m.name]
         with self._db:
+            self._db.flush_writes()
             self._db.execute("delete from Resources where deployment = ? and id = ?", (self.uuid, m.id))
 
 
@@ -242,6 +297,7 @@ class Deployment(object):
                 if os.path.islink(p): os.remove(p)
 
             # Delete the deployment from the database.
+            self._db.flush_writes()
             self._db.execute("delete from Deployments where uuid = ?", (self.uuid,))
 
 
@@ -286,16 +342,72 @@ class Deployment(object):
         args.pop(name, None)
         self.args = args
 
+    def _eval_inputs(self):
+        """
+        Return the files and directories that the evaluation of the
+        network expressions may depend on, for the evaluation cache.
+        """
+        paths = [self.expr_path]
+        for x in self.nix_exprs:
+            if x[0] != '<': paths.append(os.path.dirname(os.path.abspath(x)))
+        search_path = self.extra_nix_path + self.nix_path + \
+            [x for x in os.environ.get("NIX_PATH", "").split(":") if x]
+        for x in search_path:
+            paths.append(x.split('=', 1)[-1])
+        try:
+            paths.append(subprocess.check_output(
+                ["nix-instantiate", "--find-file", "nixpkgs"] + self._nix_path_flags(),
+                stderr=nixops.util.devnull).rstrip())
+        except subprocess.CalledProcessError:
+            pass
+        return paths
+
+
+    def _instantiate(self, name, command, stream=False):
+        """
+        Run the nix-instantiate ‘command’ and return its output, or
+        return the output of a previous run if none of its inputs have
+        changed since.  If ‘stream’ is set, a file object containing the
+        output is returned instead, so that large outputs never have to
+        be kept in memory as a whole.
+        """
+        cache = self.eval_cache
+        entry = self.uuid + "/" + name
+        key = None
+        if cache:
+            try:
+                key = cache.compute_key(command, self._eval_inputs())
+            except nixops.eval_cache.Uncacheable as e:
+                cache.uncacheable += 1
+                if debug: print >> sys.stderr, "not using the evaluation cache: {0}".format(e)
+            if key:
+                f = cache.open(entry, key)
+                if f is not None:
+                    if debug: print >> sys.stderr, "using cached evaluation of ‘{0}’".format(name)
+                    if not stream:
+                        with f: return f.read()
+                    return f
+        if not stream:
+            out = subprocess.check_output(command, stderr=self.logger.log_file)
+            if key: cache.put(entry, key, out)
+            return out
+        (fd, path) = tempfile.mkstemp(prefix=name + "-", dir=self.tempdir)
+        with os.fdopen(fd, "w") as f:
+            subprocess.check_call(command, stdout=f, stderr=self.logger.log_file)
+        if key: cache.put_file(entry, key, path)
+        return open(path)
+
+
     def evaluate_args(self):
         """Evaluate the NixOps network expression's arguments."""
         try:
-            out = subprocess.check_output(
+            out = self._instantiate("nixopsArguments",
                 ["nix-instantiate"]
                 + self.extra_nix_eval_flags
                 + self._eval_flags(self.nix_exprs) +
                 ["--eval-only", "--json", "--strict",
-                 "-A", "nixopsArguments"], stderr=self.logger.log_file)
-            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + xml
+                 "-A", "nixopsArguments"])
+            if debug: print >> sys.stderr, "JSON output of nix-instantiate:\n" + out
             return json.loads(out)
         except OSError as e:
             raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
@@ -309,45 +421,70 @@ class Deployment(object):
         self.definitions = {}
 
         try:
-            # FIXME: use --json
-            xml = subprocess.check_output(
+            out = self._instantiate("info",
                 ["nix-instantiate"]
                 + self.extra_nix_eval_flags
                 + self._eval_flags(self.nix_exprs) +
                 ["--eval-only", "--xml", "--strict",
                  "--arg", "checkConfigurationOptions", "false",
-                 "-A", "info"], stderr=self.logger.log_file)
-            if debug: print >> sys.stderr, "XML output of nix-instantiate:\n" + xml
+                 "-A", "info"], stream=True)
         except OSError as e:
             raise Exception("unable to run ‘nix-instantiate’: {0}".format(e))
         except subprocess.CalledProcessError:
             raise NixEvalError
 
-        tree = ElementTree.fromstring(xml)
-
-        # Convert the XML to a more Pythonic representation. This is
-        # in fact the same as what json.loads() on the output of
-        # "nix-instantiate --json" would yield.
-        config = nixops.util.xml_expr_to_python(tree.find("*"))
+        with out:
+            if debug:
+                pos = out.tell()
+                print >> sys.stderr, "XML output of nix-instantiate:\n" + out.read()
+                out.seek(pos)
+            network = self._parse_info(out)
 
         # Extract global deployment attributes.
-        self.description = config["network"].get("description", self.default_description)
-        self.rollback_enabled = config["network"].get("enableRollback", False)
+        self.description = network.get("description", self.default_description)
+        self.rollback_enabled = network.get("enableRollback", False)
+
+
+    def _parse_info(self, f):
+        """
+        Parse the XML output of evaluating the ‘info’ attribute and
+        create the definitions of all machines and resources.  The XML
+        is parsed incrementally: each machine or resource is converted
+        to a definition as soon as its element is complete, and the
+        element is discarded afterwards, so the whole document is never
+        in memory at once.  Returns the ‘network’ attribute set.
+        """
+        network = {}
+        attr_names = [] # names of the enclosing <attr> elements
+
+        for (event, elem) in ElementTree.iterparse(f, events=("start", "end")):
+            if elem.tag != "attr": continue
+            if event == "start":
+                attr_names.append(elem.get("name"))
+                continue
+            name = attr_names.pop()
+            depth = len(attr_names)
+
+            if depth == 0:
+                # A top-level attribute (‘network’, ‘machines’ or
+                # ‘resources’).
+                if name == "network":
+                    network = nixops.util.xml_expr_to_python(elem[0])
+
+            elif depth == 1 and attr_names[0] == "machines":
+                cfg = nixops.util.xml_expr_to_python(elem[0])
+                self.definitions[name] = _create_definition(elem, cfg, cfg["targetEnv"])
+
+            elif depth == 2 and attr_names[0] == "resources":
+                cfg = nixops.util.xml_expr_to_python(elem[0])
+                self.definitions[name] = _create_definition(elem, cfg, attr_names[1])
+
+            else:
+                continue
 
-        # Extract machine information.
-        for x in tree.findall("attrs/attr[@name='machines']/attrs/attr"):
-            name = x.get("name")
-            cfg = config["machines"][name]
-            defn = _create_definition(x, cfg, cfg["targetEnv"])
-            self.definitions[name] = defn
+            elem.clear()
 
-        # Extract info about other kinds of resources.
-        for x in tree.findall("attrs/attr[@name='resources']/attrs/attr"):
-            res_type = x.get("name")
-            for y in x.findall("attrs/attr"):
-                name = y.get("name")
-                defn = _create_definition(y, config["resources"][res_type][name], res_type)
-                self.definitions[name] = defn
+        return network
 
 
     def evaluate_option_value(self, machine_name, option_name, xml=False, include_physical=False):
@@ -384,6 +521,26 @@ class Deployment(object):
     def get_physical_spec(self):
         """Compute the contents of the Nix expression specifying the computed physical deployment attributes"""
 
+        (shared, parts) = self._get_physical_spec_parts()
+        spec = py2nix(nixmerge_all(
+            parts[r.name] for r in self.active_resources.itervalues()
+        )) + "\n"
+        if not shared: return spec
+        return "let\n" + "".join(
+            "  {0} = {1};\n".format(name, py2nix(value, initial_indentation=1).lstrip())
+            for (name, value) in sorted(shared.iteritems())) + "in\n" + spec
+
+    def _get_physical_spec_parts(self):
+        """
+        Return the physical deployment attributes of each active
+        resource, indexed by resource name.  Modules that are the same
+        for many machines (the hosts entries and the SSH host keys of
+        the network) are returned separately, as a dictionary of
+        modules that get_physical_spec() binds in a ‘let’, and that the
+        machines import by name.  This keeps the size of the spec
+        linear in the number of machines.
+        """
+
         active_machines = self.active
         active_resources = self.active_resources
 
@@ -406,6 +563,16 @@ class Deployment(object):
         # lookups.
         hosts = defaultdict(lambda: defaultdict(list))
 
+        # The entries for the addresses of all resources are the same
+        # for machines with the same address key, so they are computed
+        # once per key:
+        #
+        #   address_hosts[key] = (module name, {remote_ip: [name1, name2, ...]})
+        address_hosts = {}
+        address_keys = {}
+
+        shared = {}
+
         def index_to_private_ip(index):
             n = 105 + index / 256
             assert n <= 255
@@ -416,10 +583,14 @@ class Deployment(object):
             attrs_list = attrs_per_resource[m.name]
 
             # Emit configuration to realise encrypted peer-to-peer links.
-            for m2 in active_resources.itervalues():
-                ip = m.address_to(m2)
-                if ip:
-                    hosts[m.name][ip] += [m2.name, m2.name + "-unencrypted"]
+            key = address_keys[m.name] = m.get_address_key()
+            if key not in address_hosts:
+                remote = defaultdict(list)
+                for m2 in sorted(active_resources.itervalues(), key=lambda r: r.name):
+                    ip = m.address_to(m2)
+                    if ip:
+                        remote[ip] += [m2.name, m2.name + "-unencrypted"]
+                address_hosts[key] = ("nixopsHosts{0}".format(len(address_hosts)), remote)
 
             # Always use the encrypted/unencrypted suffixes for aliases rather
             # than for the canonical name!
@@ -488,20 +659,62 @@ class Deployment(object):
                     ('system', 'nixosVersionSuffix'): self.nixos_version_suffix
                 })
 
-        for m in active_machines.itervalues():
+        for m in sorted(active_machines.itervalues(), key=lambda m: m.name):
             do_machine(m)
 
+        def hosts_lines(hosts):
+            # Sort the hosts by its canonical host names.
+            sorted_hosts = sorted(hosts.iteritems(),
+                                  key=lambda item: item[1][0])
+            # Just to remember the format:
+            #   ip_address canonical_hostname [aliases...]
+            return ''.join("{0} {1}\n".format(ip, ' '.join(names))
+                           for ip, names in sorted_hosts)
+
+        used_hosts_modules = set()
+
+        def machine_hosts(m):
+            """Return the hosts entries of ‘m’ and the hosts module it imports, if any."""
+            (name, remote) = address_hosts[address_keys[m.name]]
+            if not remote: return (hosts[m.name], [])
+            if not any(ip in remote for ip in hosts[m.name]):
+                used_hosts_modules.add(name)
+                return (hosts[m.name], [name])
+            # Some of the machine's own entries are for an address that
+            # is in the shared module too; keep a single line per
+            # address by giving the machine all of its entries.
+            merged = defaultdict(list)
+            for h in [remote, hosts[m.name]]:
+                for ip, names in h.iteritems():
+                    merged[ip] += names
+            return (merged, [])
+
+        # Add SSH public host keys for all machines in network.
+        known_hosts = {}
+        for m2 in active_machines.itervalues():
+            if hasattr(m2, 'public_host_key') and m2.public_host_key:
+                # Using references to files in same tempdir for now, until NixOS has support
+                # for adding the keys directly as string. This way at least it is compatible
+                # with older versions of NixOS as well.
+                # TODO: after reasonable amount of time replace with string option
+                known_hosts[m2.name] = {
+                     'hostNames': [m2.name + "-unencrypted",
+                                   m2.name + "-encrypted",
+                                   m2.name],
+                     'publicKey': m2.public_host_key,
+                }
+        if known_hosts:
+            shared["nixopsKnownHosts"] = Function("{ config, lib, pkgs, ... }", {
+                ('services', 'openssh', 'knownHosts'): known_hosts,
+            })
+
         def emit_resource(r):
             config = []
             config.extend(attrs_per_resource[r.name])
+            imports = []
             if is_machine(r):
-                # Sort the hosts by its canonical host names.
-                sorted_hosts = sorted(hosts[r.name].iteritems(),
-                                      key=lambda item: item[1][0])
-                # Just to remember the format:
-                #   ip_address canonical_hostname [aliases...]
-                extra_hosts = ["{0} {1}".format(ip, ' '.join(names))
-                               for ip, names in sorted_hosts]
+                (own_hosts, imports) = machine_hosts(r)
+                if known_hosts: imports = ["nixopsKnownHosts"] + imports
 
                 if authorized_keys[r.name]:
                     config.append({
@@ -518,27 +731,10 @@ class Deployment(object):
                     ('networking', 'firewall'): {
                         'trustedInterfaces': list(trusted_interfaces[r.name])
                     },
-                    ('networking', 'extraHosts'): '\n'.join(extra_hosts) + "\n"
+                    ('networking', 'extraHosts'): hosts_lines(own_hosts)
                 })
 
-
-                # Add SSH public host keys for all machines in network.
-                for m2 in active_machines.itervalues():
-                    if hasattr(m2, 'public_host_key') and m2.public_host_key:
-                        # Using references to files in same tempdir for now, until NixOS has support
-                        # for adding the keys directly as string. This way at least it is compatible
-                        # with older versions of NixOS as well.
-                        # TODO: after reasonable amount of time replace with string option
-                        config.append({
-                            ('services', 'openssh', 'knownHosts', m2.name): {
-                                 'hostNames': [m2.name + "-unencrypted",
-                                               m2.name + "-encrypted",
-                                               m2.name],
-                                 'publicKey': m2.public_host_key,
-                            }
-                        })
-
-            merged = reduce(nixmerge, config) if len(config) > 0 else {}
+            merged = nixmerge_all(config)
             physical = r.get_physical_spec()
 
             if len(merged) == 0 and len(physical) == 0:
@@ -547,13 +743,17 @@ class Deployment(object):
                 return r.prefix_definition({
                     r.name: Function("{ config, lib, pkgs, ... }", {
                         'config': merged,
-                        'imports': [physical],
+                        'imports': [RawValue(name) for name in imports] + [physical],
                     })
                 })
 
-        return py2nix(reduce(nixmerge, [
-            emit_resource(r) for r in active_resources.itervalues()
-        ], {})) + "\n"
+        parts = {r.name: emit_resource(r) for r in active_resources.itervalues()}
+        for (name, remote) in address_hosts.itervalues():
+            if name in used_hosts_modules:
+                shared[name] = Function("{ config, lib, pkgs, ... }", {
+                    ('networking', 'extraHosts'): hosts_lines(remote),
+                })
+        return (shared, parts)
 
     def get_profile(self):
         profile_dir = "/nix/var/nix/profiles/per-user/" + getpass.getuser()
@@ -569,11 +769,40 @@ class Deployment(object):
         return profile
 
 
-    def build_configs(self, include, exclude, dry_run=False, repair=False):
-        """Build the machine configurations in the Nix store."""
+    def build_configs(self, include, exclude, dry_run=False, repair=False,
+                      incremental=False, built_fun=None, max_concurrent_build=4,
+                      max_concurrent_built_fun=-1):
+        """
+        Build the machine configurations in the Nix store.  In
+        incremental mode, each machine is built separately, and only if
+        its inputs changed since it was last built; ‘built_fun’ is then
+        called with each rebuilt machine and its configuration as soon
+        as it has been built, for at most ‘max_concurrent_built_fun’
+        machines at a time.
+        """
 
         self.logger.log("building all machine configurations...")
 
+        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        phys_expr = self._prepare_build(selected)
+
+        prebuilt = {}
+        if incremental and not repair:
+            prebuilt = self._build_changed_configs(selected, phys_expr, dry_run, built_fun,
+                                                   max_concurrent_build, max_concurrent_built_fun)
+            if dry_run: return None
+
+        with nixops.trace.span("build"):
+            return self._build_configs_path(selected, phys_expr, prebuilt, dry_run=dry_run, repair=repair)
+
+
+    def _prepare_build(self, selected):
+        """
+        Write the physical spec and set up the build environment for
+        building the configurations of the machines in ‘selected’.
+        Returns the path of the physical spec.
+        """
+
         # Set the NixOS version suffix, if we're building from Git.
         # That way ‘nixos-version’ will show something useful on the
         # target machines.
@@ -584,14 +813,11 @@ class Deployment(object):
             self.nixos_version_suffix = subprocess.check_output(["/bin/sh", get_version_script] + self._nix_path_flags()).rstrip()
 
         phys_expr = self.tempdir + "/physical.nix"
-        p = self.get_physical_spec()
+        with nixops.trace.span("physical_spec"):
+            p = self.get_physical_spec()
         nixops.util.write_file(phys_expr, p)
         if debug: print >> sys.stderr, "generated physical spec:\n" + p
 
-        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
-
-        names = map(lambda m: m.name, selected)
-
         # If we're not running on Linux, then perform the build on the
         # target machines.  FIXME: Also enable this if we're on 32-bit
         # and want to deploy to 64-bit.
@@ -620,11 +846,23 @@ class Deployment(object):
             if not os.path.exists(load_dir): os.makedirs(load_dir, 0700)
             os.environ['NIX_CURRENT_LOAD'] = load_dir
 
+        return phys_expr
+
+
+    def _build_configs_path(self, selected, phys_expr, prebuilt, dry_run=False, repair=False):
+        """
+        Build the configurations of the machines in ‘selected’, except
+        those given in ‘prebuilt’, and combine them into a single store
+        path.  The rollback profile is updated to point to the result.
+        """
+        names = [m.name for m in selected]
+
         try:
             configs_path = subprocess.check_output(
                 ["nix-build"]
                 + self._eval_flags(self.nix_exprs + [phys_expr]) +
                 ["--arg", "names", py2nix(names, inline=True),
+                 "--arg", "prebuilt", py2nix(prebuilt, inline=True),
                  "-A", "machines", "-o", self.tempdir + "/configs"]
                 + (["--dry-run"] if dry_run else [])
                 + (["--repair"] if repair else []),
@@ -640,88 +878,335 @@ class Deployment(object):
         return configs_path
 
 
-    def copy_closures(self, configs_path, include, exclude, max_concurrent_copy):
-        """Copy the closure of each machine configuration to the corresponding machine."""
+    def _get_build_keys(self, machines):
+        """
+        Compute for each of the given machines a hash of all inputs of
+        its configuration: the Nix expressions, the whole physical spec
+        (since a machine may refer to other machines and resources
+        through ‘nodes’ and ‘resources’) and its definition.  Returns
+        None if the Nix expressions cannot be fingerprinted.
+        """
+        try:
+            eval_key = nixops.eval_cache.compute_key(
+                ["nix-build"] + self._eval_flags(self.nix_exprs), self._eval_inputs())
+        except nixops.eval_cache.Uncacheable as e:
+            self.logger.log("cannot determine which machine configurations changed: {0}".format(e))
+            return None
 
-        def worker(m):
-            if not should_do(m, include, exclude): return
-            m.logger.log("copying closure...")
+        (shared_modules, parts) = self._get_physical_spec_parts()
+        physical = [py2nix(parts[r.name]) for r in sorted(self.active_resources.itervalues(), key=lambda r: r.name)]
+        physical += [[name, py2nix(value)] for (name, value) in sorted(shared_modules.iteritems())]
+        common = hashlib.sha256(json.dumps([eval_key, self.nixos_version_suffix, physical])).hexdigest()
+
+        keys = {}
+        for m in machines:
+            h = hashlib.sha256()
+            h.update(json.dumps([common, self.definitions[m.name].config], sort_keys=True))
+            keys[m.name] = h.hexdigest()
+        return keys
+
+
+    def _get_unchanged_configs(self, selected, keys):
+        """
+        Return the store paths of the previously built configurations
+        of the machines in ‘selected’ whose build key didn't change.
+        """
+        prebuilt = {}
+        for m in selected:
+            key = keys.get(m.name)
+            if key and m.build_key == key and m.built_toplevel and os.path.exists(m.built_toplevel):
+                prebuilt[m.name] = m.built_toplevel
+        if prebuilt:
+            self.logger.log("{0} of {1} machine configurations are unchanged".format(len(prebuilt), len(selected)))
+        return prebuilt
+
+
+    def _build_machine_config(self, m, phys_expr, key, dry_run=False, repair=False):
+        """
+        Build the configuration of machine ‘m’ by itself and return its
+        store path.  The path is recorded together with the build key
+        ‘key’ so that it can be reused by the next incremental build.
+        """
+        m.logger.log("building configuration...")
+        try:
+            out_link = "{0}/configs-{1}".format(self.tempdir, m.index)
+            with nixops.trace.span("build", m.name):
+                path = subprocess.check_output(
+                    ["nix-build"]
+                    + self._eval_flags(self.nix_exprs + [phys_expr]) +
+                    ["--arg", "names", py2nix([m.name], inline=True),
+                     "-A", "machines", "-o", out_link]
+                    + (["--dry-run"] if dry_run else [])
+                    + (["--repair"] if repair else []),
+                    stderr=self.logger.log_file).rstrip()
+        except subprocess.CalledProcessError:
+            raise Exception("unable to build the configuration of machine ‘{0}’".format(m.name))
+        if dry_run: return None
+        toplevel = os.path.realpath(path + "/" + m.name)
+        with self._db:
+            m.build_key = key
+            m.built_toplevel = toplevel
+        return toplevel
+
+
+    def _build_changed_configs(self, selected, phys_expr, dry_run, built_fun,
+                               max_concurrent_build, max_concurrent_built_fun=-1):
+        """
+        Build the configurations of the machines in ‘selected’ whose
+        inputs changed since they were last built, each in a separate
+        nix-build.  ‘built_fun’ runs as a separate step with its own
+        limit, so that it doesn't hold up the builds.  Returns the store
+        paths of all configurations.
+        """
+        keys = self._get_build_keys(selected) or {}
+        prebuilt = self._get_unchanged_configs(selected, keys)
+        built = {}
+
+        stages = ["build"] + (["built"] if built_fun and not dry_run else [])
+        limits = {"build": max_concurrent_build, "built": max_concurrent_built_fun}
+
+        def worker((stage, m)):
+            if stage == "build":
+                toplevel = self._build_machine_config(m, phys_expr, keys.get(m.name), dry_run=dry_run)
+                if not dry_run: built[m.name] = toplevel
+            else:
+                built_fun(m, built[m.name])
+
+        nixops.parallel.run_dag(
+            nr_workers=-1, tasks=[(stage, m) for m in selected if m.name not in prebuilt for stage in stages],
+            deps_fun=lambda (stage, m): [("build", m)] if stage == "built" else [],
+            worker_fun=worker, key_fun=lambda (stage, m): stage,
+            limits={stage: n for stage, n in limits.iteritems() if n > 0})
+
+        prebuilt.update(built)
+        return prebuilt
+
+
+    def copy_closures(self, configs_path, include, exclude, max_concurrent_copy, fan_out=0,
+                      shared_cache=False):
+        """
+        Copy the closure of each machine configuration to the
+        corresponding machine.  If ‘fan_out’ is positive, machines that
+        already have their closure pass it on to at most ‘fan_out’
+        other machines at a time (see _copy_closures_fan_out()).  If
+        ‘shared_cache’ is set, the missing paths are exported once to a
+        local binary cache from which the machines substitute them (see
+        _copy_closures_via_cache()).
+        """
+
+        machines = []
+        for m in self.active.itervalues():
+            if not should_do(m, include, exclude): continue
             m.new_toplevel = os.path.realpath(configs_path + "/" + m.name)
             if not os.path.exists(m.new_toplevel):
                 raise Exception("can't find closure of machine ‘{0}’".format(m.name))
-            m.copy_closure_to(m.new_toplevel)
+            machines.append(m)
+
+        if fan_out > 0:
+            self._copy_closures_fan_out(machines, fan_out, max_concurrent_copy)
+        elif shared_cache:
+            self._copy_closures_via_cache(machines, max_concurrent_copy)
+        else:
+            def worker(m):
+                m.logger.log("copying closure...")
+                with nixops.trace.span("copy", m.name):
+                    m.copy_closure_to(m.new_toplevel)
+
+            nixops.parallel.run_tasks(
+                nr_workers=max_concurrent_copy, tasks=machines, worker_fun=worker)
 
-        nixops.parallel.run_tasks(
-            nr_workers=max_concurrent_copy,
-            tasks=self.active.itervalues(), worker_fun=worker)
         self.logger.log(ansi_success("{0}> closures copied successfully".format(self.name), outfile=self.logger._log_file))
 
 
-    def activate_configs(self, configs_path, include, exclude, allow_reboot,
-                         force_reboot, check, sync, always_activate, dry_activate):
-        """Activate the new configuration on a machine."""
+    def _copy_closures_via_cache(self, machines, max_concurrent_copy):
+        """
+        Copy the closures of the machine configurations by exporting
+        the union of the store paths missing on the machines to a local
+        binary cache, so that each path is compressed only once, and
+        letting the machines substitute from it in parallel.  Paths
+        that could not be substituted are copied as usual.
+        """
+
+        def query(m):
+            closure = nixops.util.query_closure([m.new_toplevel])
+            return (m.name, m._query_missing_paths(m.get_ssh_for_copy_closure(), closure))
+
+        missing = dict(nixops.parallel.run_tasks(nr_workers=-1, tasks=machines, worker_fun=query))
+        all_missing = set.union(set(), *missing.values())
+
+        cache = nixops.binary_cache.LocalBinaryCache()
+        public_key = cache.get_public_key()
+        if all_missing:
+            self.logger.log("exporting {0} store paths to the binary cache in ‘{1}’..."
+                            .format(len(all_missing), cache.cache_dir))
+            start = time.time()
+            with nixops.trace.span("export_to_cache"):
+                cache.add_paths(sorted(all_missing), self.logger)
+            self.logger.log("exported store paths in {0:.1f}s".format(time.time() - start))
+
+        port = cache.serve()
+        try:
+            def worker(m):
+                with nixops.trace.span("copy", m.name):
+                    if missing[m.name]:
+                        m.logger.log("substituting {0} store paths from the local binary cache..."
+                                     .format(len(missing[m.name])))
+                        m.substitute_paths(missing[m.name], port, public_key)
+                    m.copy_closure_to(m.new_toplevel)
+
+            nixops.parallel.run_tasks(
+                nr_workers=max_concurrent_copy, tasks=machines, worker_fun=worker)
+        finally:
+            cache.stop()
+
+
+    def _copy_closures_fan_out(self, machines, fan_out, max_concurrent_copy):
+        """
+        Copy the closures of the machine configurations, using machines
+        that already have their closure as sources for the others, so
+        that not everything has to go through the uplink of the local
+        machine.  The local machine copies to at most
+        ‘max_concurrent_copy’ machines at a time, and every machine that
+        has received its closure copies to at most ‘fan_out’ others.  A
+        machine receives the store paths it is missing from the peer
+        that has most of them (if that peer can reach it); any remaining
+        paths come from the local machine.  Returns the source plan: for
+        each machine, the peer it received paths from (None for the
+        local machine), the number of paths and bytes received from
+        that peer and from the local machine, and the time it took.
+        """
+
+        # Machines get a temporary SSH key pair, used by the peers to
+        # log in to each other, which is removed afterwards.  Its file
+        # names include the deployment UUID, so that concurrent
+        # deployments to the same machines don't clobber each other's
+        # key, and authorized_keys is only changed under a lock.
+        (private_key, public_key) = nixops.util.create_key_pair(
+            key_name="NixOps closure fan-out key of {0}".format(self.uuid))
+        key_file = "/root/.ssh/id_nixops_fan_out-{0}".format(self.uuid)
+        locked = "mkdir -p /root/.ssh && (flock 9 && {0}) 9> /root/.ssh/authorized_keys.lock"
+
+        closures = {m.name: set(nixops.util.query_closure([m.new_toplevel])) for m in machines}
+        sizes = nixops.util.query_path_sizes(sorted(set.union(set(), *closures.values())))
+
+        lock = threading.Condition()
+        slots = {None: max_concurrent_copy if max_concurrent_copy > 0 else len(machines)}
+        sources = []
+        plan = {}
+
+        def pick_source(m, missing):
+            # Prefer the peer that has most of the missing paths, then
+            # the local machine.  Return False to wait for a slot.
+            best = None
+            best_overlap = 0
+            for s in sources:
+                if slots[s.name] == 0 or not s.address_to(m): continue
+                overlap = len(missing & closures[s.name])
+                if overlap > best_overlap: (best, best_overlap) = (s, overlap)
+            if best: return best
+            if slots[None] > 0: return None
+            return False
 
         def worker(m):
-            if not should_do(m, include, exclude): return
-
+            with nixops.trace.span("copy", m.name):
+                copy(m)
+
+        def copy(m):
+            # Containers share the store of their host, so they are
+            # copied to from the local machine only.
+            peered = m.get_ssh_for_copy_closure() is m.ssh
+            if peered:
+                m.run_command(locked.format("echo '{0}' >> /root/.ssh/authorized_keys".format(public_key)))
+                missing = m._query_missing_paths(m.ssh, closures[m.name])
+            else:
+                missing = set()
+
+            with lock:
+                while True:
+                    source = pick_source(m, missing) if peered else (None if slots[None] > 0 else False)
+                    if source is not False: break
+                    lock.wait()
+                slot = source.name if source else None
+                slots[slot] -= 1
+
+            start = time.time()
+            (peer_paths, peer_bytes) = (0, 0)
             try:
-                # Set the system profile to the new configuration.
-                daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
-                setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
-                if always_activate or self.definitions[m.name].always_activate:
-                    m.run_command(setprof.format(m.new_toplevel))
-                else:
-                    # Only activate if the profile has changed.
-                    new_profile_cmd = '; '.join([
-                        'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
-                        'new_gen="$(readlink -f "{0}")"',
-                        '[ "x$old_gen" != "x$new_gen" ] || exit 111',
-                        setprof
-                    ]).format(m.new_toplevel)
-
-                    ret = m.run_command(new_profile_cmd, check=False)
-                    if ret == 111:
-                        m.log("configuration already up to date")
-                        return
-                    elif ret != 0:
-                        raise Exception("unable to set new system profile")
-
-                m.send_keys()
-
-                if force_reboot or m.state == m.RESCUE:
-                    switch_method = "boot"
-                elif dry_activate:
-                    switch_method = "dry-activate"
+                if source:
+                    paths = sorted(missing & closures[source.name])
+                    m.logger.log("copying {0} store paths from ‘{1}’...".format(len(paths), source.name))
+                    m.copy_paths_from(source, paths, key_file)
+                    (peer_paths, peer_bytes) = (len(paths), sum(sizes[p] for p in paths))
                 else:
-                    switch_method = "switch"
-
-                # Run the switch script.  This will also update the
-                # GRUB boot loader.
-                res = m.switch_to_configuration(switch_method, sync)
-
-                if dry_activate: return
+                    m.logger.log("copying closure...")
+                    (local_paths, local_bytes) = m.copy_closure_to(m.new_toplevel)
+            finally:
+                with lock:
+                    slots[slot] += 1
+                    lock.notify_all()
+
+            if source:
+                # Copy whatever the peer didn't have from the local
+                # machine.  This is usually nothing, so it doesn't
+                # take one of the local machine's slots.
+                (local_paths, local_bytes) = m.copy_closure_to(m.new_toplevel)
+
+            plan[m.name] = (source.name if source else None,
+                            peer_paths, peer_bytes, local_paths, local_bytes, time.time() - start)
+
+            if peered:
+                m.run_command("umask 077 && cat > " + key_file, stdin_string=private_key)
+                with lock:
+                    sources.append(m)
+                    slots[m.name] = fan_out
+                    lock.notify_all()
+
+        def cleanup(m):
+            try:
+                m.run_command("rm -f {0}; ".format(key_file) + locked.format(
+                    "f=/root/.ssh/authorized_keys; "
+                    "if [ -f $f ]; then grep -vF '{0}' $f > $f.{1}; mv $f.{1} $f; fi"
+                    .format(public_key.split()[1], self.uuid)))
+            except Exception as e:
+                m.warn("could not remove the temporary SSH key: {0}".format(e))
 
-                if res != 0 and res != 100:
-                    raise Exception("unable to activate new configuration")
+        try:
+            nixops.parallel.run_tasks(nr_workers=-1, tasks=machines, worker_fun=worker)
+        finally:
+            nixops.parallel.run_tasks(
+                nr_workers=-1, worker_fun=cleanup,
+                tasks=[m for m in machines if m.get_ssh_for_copy_closure() is m.ssh])
+
+        total_peer = 0
+        total_local = 0
+        for m in sorted(machines, key=lambda m: m.name):
+            (source, peer_paths, peer_bytes, local_paths, local_bytes, secs) = plan[m.name]
+            total_peer += peer_bytes
+            total_local += local_bytes
+            m.logger.log("received {0} paths ({1:.1f} MiB) from {2} and {3} paths ({4:.1f} MiB) "
+                         "from the local machine in {5:.1f}s ({6:.1f} MiB/s)"
+                         .format(peer_paths, peer_bytes / 1048576.0,
+                                 "‘{0}’".format(source) if source else "no peer",
+                                 local_paths, local_bytes / 1048576.0, secs,
+                                 (peer_bytes + local_bytes) / 1048576.0 / max(secs, 0.001)))
+        self.logger.log("copied {0:.1f} MiB between machines and {1:.1f} MiB from the local machine"
+                        .format(total_peer / 1048576.0, total_local / 1048576.0))
+
+        return plan
 
-                if res == 100 or force_reboot or m.state == m.RESCUE:
-                    if not allow_reboot and not force_reboot:
-                        raise Exception("the new configuration requires a "
-                                        "reboot to take effect (hint: use "
-                                        "‘--allow-reboot’)".format(m.name))
-                    m.reboot_sync()
-                    res = 0
-                    # FIXME: should check which systemd services
-                    # failed to start after the reboot.
 
-                if res == 0:
-                    m.success("activation finished successfully")
+    def activate_configs(self, configs_path, include, exclude, allow_reboot,
+                         force_reboot, check, sync, always_activate, dry_activate):
+        """Activate the new configuration on a machine."""
 
-                # Record that we switched this machine to the new
-                # configuration.
-                m.cur_configs_path = configs_path
-                m.cur_toplevel = m.new_toplevel
+        def worker(m):
+            if not should_do(m, include, exclude): return
 
+            try:
+                with nixops.trace.span("activate", m.name):
+                    self._activate_config(m, configs_path, allow_reboot=allow_reboot,
+                                          force_reboot=force_reboot, sync=sync,
+                                          always_activate=always_activate, dry_activate=dry_activate)
             except Exception as e:
                 # This thread shouldn't throw an exception because
                 # that will cause NixOps to exit and interrupt
@@ -737,6 +1222,173 @@ class Deployment(object):
                             .format(len(failed), len(res), ", ".join(["‘{0}’".format(x) for x in failed])))
 
 
+    def _activate_config(self, m, configs_path, allow_reboot, force_reboot, sync, always_activate, dry_activate):
+        """
+        Activate the configuration ‘m.new_toplevel’ on machine ‘m’.
+        Returns True if the machine was switched to it, and records
+        ‘configs_path’ (if given) as the machine's global configuration.
+        """
+
+        # Set the system profile to the new configuration.
+        daemon_var = '' if m.state == m.RESCUE else 'env NIX_REMOTE=daemon '
+        setprof = daemon_var + 'nix-env -p /nix/var/nix/profiles/system --set "{0}"'
+        if always_activate or self.definitions[m.name].always_activate:
+            new_profile_cmd = setprof.format(m.new_toplevel)
+        else:
+            # Only activate if the profile has changed.
+            new_profile_cmd = '; '.join([
+                'old_gen="$(readlink -f /nix/var/nix/profiles/system)"',
+                'new_gen="$(readlink -f "{0}")"',
+                '[ "x$old_gen" != "x$new_gen" ] || exit 111',
+                setprof
+            ]).format(m.new_toplevel)
+
+        # Prepare for uploading the keys in the same SSH session.  This
+        # only happens if the profile was actually set.
+        prepare_keys = m._prepare_keys_commands() if m._should_send_keys() else []
+        with nixops.trace.span("set_profile", m.name):
+            res = m.run_batch([new_profile_cmd] + prepare_keys, stop_on_error=True)
+        ret = res[0][0]
+        if ret == 111:
+            m.log("configuration already up to date")
+            return False
+        elif ret != 0:
+            raise Exception("unable to set new system profile")
+
+        with nixops.trace.span("send_keys", m.name):
+            m.send_keys(prepared=res[1:])
+
+        if force_reboot or m.state == m.RESCUE:
+            switch_method = "boot"
+        elif dry_activate:
+            switch_method = "dry-activate"
+        else:
+            switch_method = "switch"
+
+        # Run the switch script.  This will also update the
+        # GRUB boot loader.
+        with nixops.trace.span("switch_to_configuration", m.name):
+            res = m.switch_to_configuration(switch_method, sync)
+
+        if dry_activate: return False
+
+        if res != 0 and res != 100:
+            raise Exception("unable to activate new configuration")
+
+        if res == 100 or force_reboot or m.state == m.RESCUE:
+            if not allow_reboot and not force_reboot:
+                raise Exception("the new configuration requires a "
+                                "reboot to take effect (hint: use "
+                                "‘--allow-reboot’)".format(m.name))
+            with nixops.trace.span("reboot", m.name):
+                m.reboot_sync()
+            res = 0
+            # FIXME: should check which systemd services
+            # failed to start after the reboot.
+
+        if res == 0:
+            m.success("activation finished successfully")
+
+        # Record that we switched this machine to the new
+        # configuration.
+        if configs_path: m.cur_configs_path = configs_path
+        m.cur_toplevel = m.new_toplevel
+        return True
+
+
+    def _deploy_pipelined(self, include, exclude, incremental, repair, copy_only,
+                          max_concurrent_build, max_concurrent_copy, max_concurrent_activate,
+                          **activate_args):
+        """
+        Build, copy and activate the machine configurations, moving each
+        machine on to the next stage as soon as it has finished the
+        previous one, rather than waiting for all machines to finish it.
+        """
+
+        self.logger.log("building, copying and activating machine configurations...")
+
+        selected = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        phys_expr = self._prepare_build(selected)
+        keys = (self._get_build_keys(selected) or {}) if incremental and not repair else {}
+        prebuilt = self._get_unchanged_configs(selected, keys)
+
+        stages = ["build", "copy"] + ([] if copy_only else ["activate"])
+        limits = {"build": max_concurrent_build, "copy": max_concurrent_copy,
+                  "activate": max_concurrent_activate}
+        activated = []
+        built = {}
+        failed = {} # machine name -> stage that failed
+
+        def deps((stage, m)):
+            n = stages.index(stage)
+            return [(stages[n - 1], m)] if n > 0 else []
+
+        def worker((stage, m)):
+            m.logger.phase = stage
+            try:
+                run_stage(stage, m)
+            except Exception:
+                failed[m.name] = stage
+                raise
+            finally:
+                m.logger.phase = None
+
+        def run_stage(stage, m):
+            if stage == "build":
+                # _build_machine_config() records the ‘build’ span.
+                m.new_toplevel = prebuilt.get(m.name) or self._build_machine_config(m, phys_expr, keys.get(m.name), repair=repair)
+                built[m.name] = m.new_toplevel
+            elif stage == "copy":
+                with nixops.trace.span("copy", m.name):
+                    m.logger.log("copying closure...")
+                    m.copy_closure_to(m.new_toplevel)
+            else:
+                # As in activate_configs(), a failed activation
+                # shouldn't interrupt activation on the other machines.
+                try:
+                    with nixops.trace.span("activate", m.name):
+                        if self._activate_config(m, None, **activate_args): activated.append(m)
+                except Exception as e:
+                    m.logger.error(traceback.format_exc() if debug else str(e))
+                    failed[m.name] = stage
+
+        def record():
+            # Combine the configurations that were built, and record
+            # the result as the global configuration of the machines
+            # that switched to it.  This is also done if some stage
+            # failed, so that the state file and the profile reflect
+            # what the activated machines are running.
+            ok = [m for m in selected if m.name in built]
+            if not ok: return
+            self.configs_path = self._build_configs_path(ok, phys_expr, built)
+            with self._db:
+                for m in activated: m.cur_configs_path = self.configs_path
+
+        def summary():
+            stages_failed = ["{0} on {1}".format(stage, ", ".join("‘{0}’".format(n) for n in sorted(failed) if failed[n] == stage))
+                             for stage in stages if stage in failed.values()]
+            return "deployment of {0} machine(s) failed ({1})".format(len(failed), "; ".join(stages_failed))
+
+        try:
+            nixops.parallel.run_dag(
+                nr_workers=-1, tasks=[(stage, m) for m in selected for stage in stages],
+                deps_fun=deps, worker_fun=worker, key_fun=lambda (stage, m): stage,
+                limits={stage: n for stage, n in limits.iteritems() if n > 0})
+        except Exception:
+            excinfo = sys.exc_info()
+            try:
+                record()
+            except Exception as e:
+                self.logger.warn("cannot record the configurations of the activated machines: {0}".format(e))
+            self.logger.log(summary())
+            raise excinfo[0], excinfo[1], excinfo[2]
+
+        record()
+
+        if failed:
+            raise Exception(summary())
+
+
     def _get_free_resource_index(self):
         index = 0
         for r in self.resources.itervalues():
@@ -747,10 +1399,11 @@ class Deployment(object):
 
     def get_backups(self, include=[], exclude=[]):
         self.evaluate_active(include, exclude) # unnecessary?
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        nixops.backends.prefetch_backups(machines)
         machine_backups = {}
-        for m in self.active.itervalues():
-            if should_do(m, include, exclude):
-                machine_backups[m.name] = m.get_backups()
+        for m in machines:
+            machine_backups[m.name] = m.get_backups()
 
         # merging machine backups into network backups
         backup_ids = [b for bs in machine_backups.values() for b in bs.keys()]
@@ -804,16 +1457,14 @@ class Deployment(object):
     def backup(self, include=[], exclude=[]):
         backup_id = datetime.now().strftime("%Y%m%d%H%M%S")
 
-        def worker(m):
-            if not should_do(m, include, exclude): return
-            if m.state != m.STOPPED:
-                ssh_name = m.get_ssh_name()
-                res = subprocess.call(["ssh", "root@" + ssh_name] + m.get_ssh_flags() + ["sync"])
-                if res != 0:
-                    m.logger.log("running sync failed on {0}.".format(m.name))
-            m.backup(self.definitions[m.name], backup_id)
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        nixops.known_hosts.flush()
 
-        nixops.parallel.run_tasks(nr_workers=5, tasks=self.active.itervalues(), worker_fun=worker)
+        # Let each backend back up all its machines at once, so that
+        # e.g. all EC2 snapshots are created concurrently.  Each machine
+        # is synced right before its own snapshots are taken.
+        nixops.backends.backup_machines(
+            [(m, self.definitions[m.name]) for m in machines], backup_id, machine_executor())
 
         return backup_id
 
@@ -847,17 +1498,18 @@ class Deployment(object):
         # Determine the set of active resources.  (We can't just
         # delete obsolete resources from ‘self.resources’ because they
         # contain important state that we don't want to forget about.)
-        for m in self.resources.values():
-            if m.name in self.definitions:
-                if m.obsolete:
-                    self.logger.log("resource ‘{0}’ is no longer obsolete".format(m.name))
-                    m.obsolete = False
-            else:
-                self.logger.log("resource ‘{0}’ is obsolete".format(m.name))
-                if not m.obsolete: m.obsolete = True
-                if not should_do(m, include, exclude): continue
-                if kill_obsolete:
-                    to_destroy.append(m.name)
+        with self._db:
+            for m in self.resources.values():
+                if m.name in self.definitions:
+                    if m.obsolete:
+                        self.logger.log("resource ‘{0}’ is no longer obsolete".format(m.name))
+                        m.obsolete = False
+                else:
+                    self.logger.log("resource ‘{0}’ is obsolete".format(m.name))
+                    if not m.obsolete: m.obsolete = True
+                    if not should_do(m, include, exclude): continue
+                    if kill_obsolete:
+                        to_destroy.append(m.name)
 
         if to_destroy:
             self._destroy_resources(include=to_destroy)
@@ -866,21 +1518,26 @@ class Deployment(object):
     def _deploy(self, dry_run=False, build_only=False, create_only=False, copy_only=False, evaluate_only=False,
                 include=[], exclude=[], check=False, kill_obsolete=False,
                 allow_reboot=False, allow_recreate=False, force_reboot=False,
-                max_concurrent_copy=5, sync=True, always_activate=False, repair=False, dry_activate=False):
+                max_concurrent_copy=5, sync=True, always_activate=False, repair=False, dry_activate=False,
+                max_concurrent_create=-1, max_concurrent_per_type={}, incremental=False,
+                pipeline=False, max_concurrent_build=4, max_concurrent_activate=-1,
+                copy_fan_out=0, shared_binary_cache=False):
         """Perform the deployment defined by the deployment specification."""
 
-        self.evaluate_active(include, exclude, kill_obsolete)
+        with nixops.trace.span("evaluate"):
+            self.evaluate_active(include, exclude, kill_obsolete)
 
         if evaluate_only:
             return
 
         # Assign each resource an index if it doesn't have one.
-        for r in self.active_resources.itervalues():
-            if r.index == None:
-                r.index = self._get_free_resource_index()
-                # FIXME: Logger should be able to do coloring without the need
-                #        for an index maybe?
-                r.logger.register_index(r.index)
+        with self._db:
+            for r in self.active_resources.itervalues():
+                if r.index == None:
+                    r.index = self._get_free_resource_index()
+                    # FIXME: Logger should be able to do coloring without the need
+                    #        for an index maybe?
+                    r.logger.register_index(r.index)
 
         self.logger.update_log_prefixes()
 
@@ -890,103 +1547,134 @@ class Deployment(object):
         # FIXME: would be nice to have a more fine-grained topological
         # sort.
         if not dry_run and not build_only:
+            self.logger.phase = "create"
 
             for r in self.active_resources.itervalues():
                 defn = self.definitions[r.name]
                 if r.get_type() != defn.get_type():
                     raise Exception("the type of resource ‘{0}’ changed from ‘{1}’ to ‘{2}’, which is currently unsupported"
                                     .format(r.name, r.get_type(), defn.get_type()))
-                r._created_event = threading.Event()
-                r._errored = False
 
-            def worker(r):
-                try:
-                    if not should_do(r, include, exclude): return
-
-                    # Sleep until all dependencies of this resource have
-                    # been created.
-                    deps = r.create_after(self.active_resources.itervalues(), self.definitions[r.name])
-                    for dep in deps:
-                        dep._created_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            r._errored = True
-                            return
-
-                    # Now create the resource itself.
-                    if not r.creation_time:
-                        r.creation_time = int(time.time())
-                    r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
-
-                    if is_machine(r):
-                        # The first time the machine is created,
-                        # record the state version. We get it from
-                        # /etc/os-release, rather than from the
-                        # configuration's state.systemVersion
-                        # attribute, because the machine may have been
-                        # booted from an older NixOS image.
-                        if not r.state_version:
-                            os_release = r.run_command("cat /etc/os-release", capture_stdout=True)
-                            match = re.search('VERSION_ID="([0-9]+\.[0-9]+).*"', os_release)
-                            if match:
-                                r.state_version = match.group(1)
-                                r.log("setting state version to {0}".format(r.state_version))
-                            else:
-                                r.warn("cannot determine NixOS version")
+            def deps(r):
+                return r.create_after(self.active_resources.itervalues(), self.definitions[r.name])
 
+            def worker(r):
+                if not should_do(r, include, exclude): return
+                with nixops.trace.span("create", r.name):
+                    create(r)
+
+            def create(r):
+                # Now create the resource itself.
+                if not r.creation_time:
+                    r.creation_time = int(time.time())
+                r.create(self.definitions[r.name], check=check, allow_reboot=allow_reboot, allow_recreate=allow_recreate)
+
+                if is_machine(r):
+                    # The first time the machine is created,
+                    # record the state version. We get it from
+                    # /etc/os-release, rather than from the
+                    # configuration's state.systemVersion
+                    # attribute, because the machine may have been
+                    # booted from an older NixOS image.
+                    if not r.state_version:
+                        os_release = r.run_command("cat /etc/os-release", capture_stdout=True)
+                        match = re.search('VERSION_ID="([0-9]+\.[0-9]+).*"', os_release)
+                        if match:
+                            r.state_version = match.group(1)
+                            r.log("setting state version to {0}".format(r.state_version))
+                        else:
+                            r.warn("cannot determine NixOS version")
+
+                    with nixops.trace.span("wait_for_ssh", r.name):
                         r.wait_for_ssh(check=check)
-                        r.generate_vpn_key(check=check)
-
-                except:
-                    r._errored = True
-                    raise
-                finally:
-                    r._created_event.set()
+                    r.generate_vpn_key(check=check)
 
-            nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=worker)
+            # Resources are created as soon as the resources they
+            # depend on have been created.
+            self._run_resource_dag(self.active_resources.itervalues(), deps, worker,
+                                   max_concurrent_create, max_concurrent_per_type)
 
         if create_only: return
 
         # Build the machine configurations.
+        self.logger.phase = "build"
         if dry_run:
-            self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude)
+            self.build_configs(dry_run=dry_run, repair=repair, include=include, exclude=exclude,
+                               incremental=incremental)
             return
 
-        # Record configs_path in the state so that the ‘info’ command
-        # can show whether machines have an outdated configuration.
-        self.configs_path = self.build_configs(repair=repair, include=include, exclude=exclude)
-
-        if build_only: return
-
-        # Copy the closures of the machine configurations to the
-        # target machines.
-        self.copy_closures(self.configs_path, include=include, exclude=exclude,
-                           max_concurrent_copy=max_concurrent_copy)
-
-        if copy_only: return
-
-        # Active the configurations.
-        self.activate_configs(self.configs_path, include=include,
-                              exclude=exclude, allow_reboot=allow_reboot,
-                              force_reboot=force_reboot, check=check,
-                              sync=sync, always_activate=always_activate, dry_activate=dry_activate)
-
-        if dry_activate: return
+        if pipeline and not build_only:
+            self._deploy_pipelined(include=include, exclude=exclude,
+                                   incremental=incremental, repair=repair, copy_only=copy_only,
+                                   max_concurrent_build=max_concurrent_build,
+                                   max_concurrent_copy=max_concurrent_copy,
+                                   max_concurrent_activate=max_concurrent_activate,
+                                   allow_reboot=allow_reboot, force_reboot=force_reboot,
+                                   sync=sync, always_activate=always_activate,
+                                   dry_activate=dry_activate)
+
+        else:
+            # In incremental mode, start copying the closure of each
+            # machine as soon as its configuration has been built.
+            copied = []
+
+            def copy_built(m, toplevel):
+                m.logger.phase = "copy"
+                try:
+                    m.logger.log("copying closure...")
+                    m.new_toplevel = toplevel
+                    with nixops.trace.span("copy", m.name):
+                        m.copy_closure_to(toplevel)
+                finally:
+                    m.logger.phase = None
+                copied.append(m.name)
+
+            # Record configs_path in the state so that the ‘info’ command
+            # can show whether machines have an outdated configuration.
+            self.configs_path = self.build_configs(repair=repair, include=include, exclude=exclude,
+                                                   incremental=incremental,
+                                                   built_fun=None if build_only else copy_built,
+                                                   max_concurrent_build=max_concurrent_build,
+                                                   max_concurrent_built_fun=max_concurrent_copy)
+
+            if build_only: return
+
+            # Copy the closures of the machine configurations to the
+            # target machines.
+            self.logger.phase = "copy"
+            self.copy_closures(self.configs_path, include=include, exclude=exclude + copied,
+                               max_concurrent_copy=max_concurrent_copy, fan_out=copy_fan_out,
+                               shared_cache=shared_binary_cache)
+
+            if not copy_only:
+                # Active the configurations.
+                self.logger.phase = "activate"
+                self.activate_configs(self.configs_path, include=include,
+                                      exclude=exclude, allow_reboot=allow_reboot,
+                                      force_reboot=force_reboot, check=check,
+                                      sync=sync, always_activate=always_activate, dry_activate=dry_activate)
+
+        if copy_only or dry_activate: return
 
         # Trigger cleanup of resources, e.g. disks that need to be detached etc. Needs to be
         # done after activation to make sure they are not in use anymore.
+        self.logger.phase = "cleanup"
         def cleanup_worker(r):
             if not should_do(r, include, exclude): return
 
             # Now create the resource itself.
             r.after_activation(self.definitions[r.name])
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=cleanup_worker)
+        with nixops.trace.span("cleanup"):
+            nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active_resources.itervalues(), worker_fun=cleanup_worker)
         self.logger.log(ansi_success("{0}> deployment finished successfully".format(self.name), outfile=self.logger._log_file))
 
     def deploy(self, **kwargs):
         with self._get_deployment_lock():
-            self._deploy(**kwargs)
+            try:
+                self._deploy(**kwargs)
+            finally:
+                self.logger.phase = None
 
 
     def _rollback(self, generation, include=[], exclude=[], check=False,
@@ -1035,35 +1723,36 @@ class Deployment(object):
 
     def _destroy_resources(self, include=[], exclude=[], wipe=False):
 
+        # A resource can only be destroyed after the resources that
+        # must be destroyed before it.
+        wait_for = defaultdict(list)
         for r in self.resources.itervalues():
-            r._destroyed_event = threading.Event()
-            r._errored = False
             for rev_dep in r.destroy_before(self.resources.itervalues()):
-                try:
-                    rev_dep._wait_for.append(r)
-                except AttributeError:
-                    rev_dep._wait_for = [ r ]
+                wait_for[rev_dep].append(r)
 
         def worker(m):
-            try:
-                if not should_do(m, include, exclude): return
-                try:
-                    for dep in m._wait_for:
-                        dep._destroyed_event.wait()
-                        # !!! Should we print a message here?
-                        if dep._errored:
-                            m._errored = True
-                            return
-                except AttributeError:
-                    pass
-                if m.destroy(wipe=wipe): self.delete_resource(m)
-            except:
-                m._errored = True
-                raise
-            finally:
-                m._destroyed_event.set()
+            if not should_do(m, include, exclude): return
+            if m.destroy(wipe=wipe): self.delete_resource(m)
+
+        self._run_resource_dag(self.resources.values(), lambda r: wait_for[r], worker)
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.resources.values(), worker_fun=worker)
+
+    def _run_resource_dag(self, resources, deps, worker, max_concurrent=-1, max_concurrent_per_type={}):
+        """
+        Run ‘worker’ on each resource after it has been run on the
+        resources returned by ‘deps’.  ‘max_concurrent_per_type’ limits
+        the number of resources of a given type being processed at the
+        same time (e.g. to avoid API rate limits).
+        """
+        timings = {}
+        try:
+            nixops.parallel.run_dag(
+                nr_workers=max_concurrent, tasks=resources, deps_fun=deps, worker_fun=worker,
+                key_fun=lambda r: r.get_type(), limits=max_concurrent_per_type, timings=timings)
+        finally:
+            if debug:
+                for r, (start, end) in sorted(timings.iteritems(), key=lambda (r, t): t):
+                    r.logger.log("took {0:.1f}s".format(end - start))
 
     def destroy_resources(self, include=[], exclude=[], wipe=False):
         """Destroy all active and obsolete resources."""
@@ -1091,36 +1780,48 @@ class Deployment(object):
                         rescue=False, hard=False):
         """Reboot all active machines."""
 
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        rebooted = []
+
+        # Wait for all machines to go down and come back up from a
+        # single thread, rather than one thread per machine.  Each
+        # machine is probed as soon as its own reboot() has returned,
+        # so that a quick reboot isn't missed.
+        probe = nixops.wait.TCPProbe()
+        probe.hold(len(machines))
+
         def worker(m):
-            if not should_do(m, include, exclude): return
-            if rescue:
-                m.reboot_rescue(hard=hard)
-            elif wait:
-                m.reboot_sync(hard=hard)
-            else:
-                m.reboot(hard=hard)
+            if m is None:
+                if wait: probe.run(timeout=REBOOT_TIMEOUT)
+                return
+            try:
+                if rescue:
+                    m.reboot_rescue(hard=hard)
+                else:
+                    m.reboot(hard=hard)
+                    if wait:
+                        m._probe_reboot(probe)
+                        rebooted.append(m)
+            finally:
+                probe.release()
 
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        nixops.parallel.run_tasks(nr_workers=-1, tasks=[None] + machines, worker_fun=worker)
+
+        nixops.parallel.run_tasks(nr_workers=-1, tasks=rebooted, worker_fun=lambda m: m._rebooted())
 
 
     def stop_machines(self, include=[], exclude=[]):
         """Stop all active machines."""
 
-        def worker(m):
-            if not should_do(m, include, exclude): return
-            m.stop()
-
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        machine_executor().run(machines, lambda m: m.stop())
 
 
     def start_machines(self, include=[], exclude=[]):
         """Start all active machines."""
 
-        def worker(m):
-            if not should_do(m, include, exclude): return
-            m.start()
-
-        nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
+        machines = [m for m in self.active.itervalues() if should_do(m, include, exclude)]
+        machine_executor().run(machines, lambda m: m.start())
 
 
     def is_valid_resource_name(self, name):
@@ -1155,6 +1856,15 @@ class Deployment(object):
         nixops.parallel.run_tasks(nr_workers=-1, tasks=self.active.itervalues(), worker_fun=worker)
 
 
+def machine_executor(nr_workers=nixops.parallel.DEFAULT_MAX_WORKERS, fail_fast=False):
+    """
+    Return an executor for operations on machines.  The tasks are not
+    rate limited themselves; the cloud API calls they make are (see
+    nixops.parallel.throttle()).
+    """
+    return nixops.parallel.Executor(nr_workers=nr_workers, fail_fast=fail_fast)
+
+
 def should_do(m, include, exclude):
     return should_do_n(m.name, include, exclude)
 
@@ -5,7 +5,9 @@ import boto.ec2
 import boto.vpc
 import time
 import random
+import threading
 import nixops.util
+import nixops.parallel
 
 from boto.exception import EC2ResponseError
 from boto.exception import SQSError
@@ -13,11 +15,25 @@ from boto.exception import BotoServerError
 
 from boto.pyami.config import Config
 
+_cache_lock = threading.RLock()
+_credentials = {}
+_connections = {}
+_connection_stats = {'created': 0, 'reused': 0}
+
+
 def fetch_aws_secret_key(access_key_id):
     """
         Fetch the secret access key corresponding to the given access key ID from ~/.ec2-keys,
         or from ~/.aws/credentials, or from the environment (in that priority).
+        The result is cached for the lifetime of the process.
     """
+    with _cache_lock:
+        if access_key_id not in _credentials:
+            _credentials[access_key_id] = _fetch_aws_secret_key(access_key_id)
+        return _credentials[access_key_id]
+
+
+def _fetch_aws_secret_key(access_key_id):
 
     def parse_ec2_keys():
         path = os.path.expanduser("~/.ec2-keys")
@@ -59,25 +75,59 @@ def fetch_aws_secret_key(access_key_id):
 
     return credentials
 
+def get_connection(service, region, access_key_id, connect_fun):
+    """
+    Return a connection to the AWS service ‘service’ in ‘region’ (None
+    for global services) using the given access key.  The connection
+    is created by calling ‘connect_fun’ (e.g. boto.sqs.connect_to_region)
+    with the region and credentials as keyword arguments, but only the
+    first time; after that it is shared by all callers and threads, so
+    that its HTTP connections are kept alive and reused.  Requests to
+    the EC2 API are rate limited per region and access key (see
+    nixops.parallel.throttle()).
+    """
+    key = (service, region, access_key_id)
+    limit_key = ("ec2", region, access_key_id)
+    with _cache_lock:
+        conn = _connections.get(key)
+        if conn:
+            _connection_stats['reused'] += 1
+            return conn
+        (access_key_id, secret_access_key) = fetch_aws_secret_key(access_key_id)
+        kwargs = {'aws_access_key_id': access_key_id, 'aws_secret_access_key': secret_access_key}
+        if region is not None: kwargs['region_name'] = region
+        conn = connect_fun(**kwargs)
+        if not conn:
+            raise Exception("invalid {0} region ‘{1}’".format(service.upper(), region))
+        if service in ("ec2", "vpc"):
+            conn.make_request = nixops.parallel.rate_limited(conn.make_request, limit_key)
+        _connections[key] = conn
+        _connection_stats['created'] += 1
+        return conn
+
+
+def get_connection_stats():
+    """Return the number of AWS connections created and reused."""
+    with _cache_lock:
+        return dict(_connection_stats)
+
+
+def clear_connection_cache():
+    """Forget all cached AWS connections and credentials."""
+    with _cache_lock:
+        _connections.clear()
+        _credentials.clear()
+
+
 def connect(region, access_key_id):
     """Connect to the specified EC2 region using the given access key."""
     assert region
-    (access_key_id, secret_access_key) = fetch_aws_secret_key(access_key_id)
-    conn = boto.ec2.connect_to_region(
-        region_name=region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
-    if not conn:
-        raise Exception("invalid EC2 region ‘{0}’".format(region))
-    return conn
+    return get_connection("ec2", region, access_key_id, boto.ec2.connect_to_region)
 
 def connect_vpc(region, access_key_id):
     """Connect to the specified VPC region using the given access key."""
     assert region
-    (access_key_id, secret_access_key) = fetch_aws_secret_key(access_key_id)
-    conn = boto.vpc.connect_to_region(
-        region_name=region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
-    if not conn:
-        raise Exception("invalid VPC region ‘{0}’".format(region))
-    return conn
+    return get_connection("vpc", region, access_key_id, boto.vpc.connect_to_region)
 
 
 def get_access_key_id():
@@ -131,6 +181,75 @@ def get_volume_by_id(conn, volume_id, allow_missing=False):
     return None
 
 
+# The maximum number of values of a filter in a describe call.
+MAX_FILTER_VALUES = 200
+
+
+def describe_by_ids(describe, ids, not_found_code, id_filter=None, batch_size=1000):
+    """
+    Describe the EC2 objects (instances, volumes, ...) with the given
+    IDs using as few API calls as possible, and return a dictionary
+    mapping the IDs of the objects that exist to the objects.
+    ‘describe’ is called with a list of at most ‘batch_size’ IDs, or
+    with None and a dictionary of filters, e.g.
+
+      lambda ids, filters=None: conn.get_all_volumes(ids, filters=filters)
+
+    EC2 fails the whole call if one of the IDs doesn't exist (with
+    error code ‘not_found_code’).  In that case the batch is described
+    again using the filter ‘id_filter’, which ignores missing IDs, or
+    ID by ID if there is no such filter.
+    """
+    ids = sorted(set(ids))
+    res = {}
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        try:
+            objs = describe(batch)
+        except EC2ResponseError as e:
+            if e.error_code != not_found_code: raise
+            objs = []
+            if id_filter:
+                for j in range(0, len(batch), MAX_FILTER_VALUES):
+                    objs += describe(None, filters={id_filter: batch[j:j + MAX_FILTER_VALUES]})
+            else:
+                for id in batch:
+                    try:
+                        objs += describe([id])
+                    except EC2ResponseError as e:
+                        if e.error_code != not_found_code: raise
+        for obj in objs:
+            res[obj.id] = obj
+    return res
+
+
+def create_tags_batched(conn, tags_by_id, logger=None, batch_size=1000):
+    """
+    Apply tags to many resources, given a dictionary mapping resource
+    IDs to tag dictionaries.  Since CreateTags applies the same tags to
+    all resources passed to it, tags are grouped by the set of resources
+    that get them, and each group is applied with one call per batch of
+    ‘batch_size’ IDs.  Returns the number of calls made.
+    """
+    ids_by_tag = {}
+    for (id, tags) in tags_by_id.iteritems():
+        for tag in tags.iteritems():
+            ids_by_tag.setdefault(tag, set()).add(id)
+
+    tags_by_ids = {}
+    for ((k, v), ids) in ids_by_tag.iteritems():
+        tags_by_ids.setdefault(frozenset(ids), {})[k] = v
+
+    calls = 0
+    for (ids, tags) in sorted(tags_by_ids.iteritems(), key=lambda (ids, tags): sorted(tags.items())):
+        ids = sorted(ids)
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            retry(lambda: conn.create_tags(batch, tags), logger=logger)
+            calls += 1
+    return calls
+
+
 def wait_for_volume_available(conn, volume_id, logger, states=['available']):
     """Wait for an EBS volume to become available."""
 
@@ -142,7 +261,7 @@ def wait_for_volume_available(conn, volume_id, logger, states=['available']):
         logger.log_continue("[{0}] ".format(volume.status))
         return volume.status in states
 
-    nixops.util.check_wait(check_available, max_tries=90)
+    nixops.util.check_wait(check_available, max_tries=90, category="ec2")
 
     logger.log_end('')
 
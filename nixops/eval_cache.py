@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+
+__all__ = ['EvalCache', 'Uncacheable', 'compute_key']
+
+
+class Uncacheable(Exception):
+    """Raised if the inputs of an evaluation cannot be fingerprinted."""
+    pass
+
+
+# Don't try to fingerprint directory trees with more files than this
+# (e.g. a Nixpkgs checkout); evaluations depending on them are simply
+# not cached.
+MAX_FILES = 2000
+
+
+def get_default_cache_dir():
+    return os.environ.get("HOME", "") + "/.nixops/eval-cache"
+
+
+class EvalCache(object):
+    """
+    On-disk cache of nix-instantiate evaluation results.
+
+    An entry is keyed on a hash of the command line, the relevant
+    environment and a fingerprint of every file or directory tree the
+    evaluation may read.  Paths in the Nix store are immutable, so they
+    are fingerprinted by name; other trees are fingerprinted by the
+    names and contents of the files in them.  Only the latest entry is
+    kept for each name (e.g. per deployment and attribute), so the
+    cache doesn't grow without bound.
+
+    Files outside the given trees (e.g. imports from a parent directory
+    or keys read with builtins.readFile) and the environment seen by
+    builtins.getEnv are not part of the key, so a cached result can be
+    stale; that's why the cache has to be enabled explicitly.
+
+    Evaluation results may contain secrets (such as the contents of
+    ‘deployment.keys’), so the cache is only readable by its owner.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'uncacheable': self.uncacheable}
+
+    def compute_key(self, command, paths, env_vars=["NIX_PATH"]):
+        """
+        Return the cache key for running ‘command’, which depends on
+        the files or directories in ‘paths’.  Raises Uncacheable if some
+        input cannot be fingerprinted.
+        """
+        return compute_key(command, paths, env_vars)
+
+    def _entry_path(self, name):
+        return "{0}/{1}".format(self.cache_dir, hashlib.sha256(name.encode("utf-8")).hexdigest())
+
+    def open(self, name, key):
+        """
+        Return a file object from which the cached result for ‘name’
+        can be read if it has key ‘key’, or None.
+        """
+        try:
+            f = open(self._entry_path(name))
+        except IOError:
+            f = None
+        if f:
+            if f.readline().rstrip("\n") == key:
+                self.hits += 1
+                return f
+            f.close()
+        self.misses += 1
+        return None
+
+    def get(self, name, key):
+        """Return the cached result for ‘name’ if it has key ‘key’, or None."""
+        f = self.open(name, key)
+        if f is None: return None
+        with f:
+            return f.read()
+
+    def put(self, name, key, value):
+        """Store ‘value’ as the result for ‘name’ with key ‘key’."""
+        self._write(name, key, lambda f: f.write(value))
+
+    def put_file(self, name, key, path):
+        """Store the contents of the file ‘path’ as the result for ‘name’."""
+        def copy(f):
+            with open(path) as src:
+                shutil.copyfileobj(src, f)
+        self._write(name, key, copy)
+
+    def _write(self, name, key, write_fun):
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir, 0700)
+        path = self._entry_path(name)
+        tmp = "{0}.tmp-{1}".format(path, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "w") as f:
+            f.write(key + "\n")
+            write_fun(f)
+        os.rename(tmp, path)
+
+
+def compute_key(command, paths, env_vars=["NIX_PATH"]):
+    """See EvalCache.compute_key()."""
+    h = hashlib.sha256()
+    h.update(json.dumps([command, [os.environ.get(v) for v in env_vars]]))
+    for path in paths:
+        _fingerprint(h, path)
+    return h.hexdigest()
+
+
+def _fingerprint(h, path):
+    if "://" in path:
+        raise Uncacheable("cannot fingerprint ‘{0}’".format(path))
+    if isinstance(path, unicode): path = path.encode("utf-8")
+    path = os.path.realpath(path)
+    h.update(path + "\0")
+    if path.startswith("/nix/store/"): return
+    if not os.path.exists(path):
+        h.update("missing\0")
+        return
+    if not os.path.isdir(path):
+        _fingerprint_file(h, path)
+        return
+    nr_files = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for fn in sorted(filenames):
+            nr_files += 1
+            if nr_files > MAX_FILES:
+                raise Uncacheable("too many files in ‘{0}’".format(path))
+            _fingerprint_file(h, os.path.join(dirpath, fn))
+
+
+def _fingerprint_file(h, path):
+    try:
+        f = open(path)
+    except IOError:
+        h.update(path + "\0missing\0")
+        return
+    with f:
+        contents = hashlib.sha256()
+        while True:
+            data = f.read(65536)
+            if not data: break
+            contents.update(data)
+    h.update("{0}\0{1}\0".format(path, contents.hexdigest()))
@@ -4,6 +4,7 @@ import os
 import re
 
 from nixops.util import attr_property
+import nixops.parallel
 import nixops.resources
 
 from libcloud.compute.types import Provider
@@ -92,7 +93,13 @@ class ResourceState(nixops.resources.ResourceState):
         nixops.resources.ResourceState.__init__(self, depl, name, id)
         self._conn = None
 
+    def get_rate_limit_key(self):
+        return ("gce", self.project)
+
     def connect(self):
+        # The driver is fetched for each API call, so this is where the
+        # calls are rate limited.
+        nixops.parallel.throttle(self.get_rate_limit_key())
         if not self._conn:
             self._conn = get_driver(Provider.GCE)(self.service_account, self.access_key_path, project = self.project)
         return self._conn
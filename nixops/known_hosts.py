@@ -1,59 +1,118 @@
+# -*- coding: utf-8 -*-
 import os
 import sys
 import threading
 import fcntl
+from contextlib import contextmanager
 
 
 # Allow only one thread to rewrite known_hosts at a time.
 lock = threading.Lock()
 
+# Changes that haven't been written to known_hosts yet, as (address,
+# add, public host key) triples, and the number of active batch()
+# blocks.
+_pending = []
+_batch_depth = 0
 
-def _rewrite(ip_address, add, public_host_key):
+
+def _apply(lines, changes):
+    '''
+    Apply ‘changes’ to the lines of a known_hosts file, in order.  An
+    index from addresses to the lines that mention them avoids scanning
+    the whole file for each change.
+    '''
+    entries = [] # [names, rest], or [None, line] for lines we don't parse
+    index = {}
+    for l in lines:
+        if ' ' not in l:
+            entries.append([None, l])
+            continue
+        (first, rest) = l.split(' ', 1)
+        names = first.split(',')
+        for n in set(names): index.setdefault(n, []).append(len(entries))
+        entries.append([names, rest])
+
+    for (ip_address, add, public_host_key) in changes:
+        keep = []
+        for i in index.get(ip_address, []):
+            (names, rest) = entries[i]
+            if not add and public_host_key is not None and public_host_key != rest:
+                keep.append(i)
+                continue
+            entries[i][0] = [n for n in names if n != ip_address]
+        if add:
+            keep.append(len(entries))
+            entries.append([[ip_address], public_host_key])
+        index[ip_address] = keep
+
+    return [rest if names is None else ','.join(names) + " " + rest
+            for (names, rest) in entries if names != []]
+
+
+def flush():
+    '''Write all pending changes to known_hosts in a single rewrite.'''
     with lock:
+        if not _pending: return
+        changes = list(_pending)
+        del _pending[:]
+
         path = os.path.expanduser("~/.ssh/known_hosts")
         if not os.path.isfile(path): return
 
         with open(os.path.expanduser("~/.ssh/.known_hosts.lock"), 'w') as lockfile:
             fcntl.flock(lockfile, fcntl.LOCK_EX) #unlock is implicit at the end of the with
-            f = open(path, 'r')
-            contents = f.read()
-            f.close()
-
-            def rewrite(l):
-                if ' ' not in l: return l
-                (first, rest) = l.split(' ', 1)
-                names = first.split(',')
-                if ip_address not in names: return l
-                if not add and public_host_key is not None and public_host_key != rest: return l
-                new_names = [ n for n in names  if n != ip_address ]
-                return ','.join(new_names) + " " + rest if new_names != [] else None
+            with open(path, 'r') as f:
+                contents = f.read()
 
-            new = [ l for l in [ rewrite(l) for l in contents.splitlines() ] if l is not None ]
-
-            if add:
-                new.append(ip_address + " " + public_host_key)
+            new = _apply(contents.splitlines(), changes)
 
             tmp = "{0}.tmp-{1}".format(path, os.getpid())
-            f = open(tmp, 'w')
-            f.write('\n'.join(new + [""]))
-            f.close()
+            with open(tmp, 'w') as f:
+                f.write('\n'.join(new + [""]))
             os.rename(tmp, path)
 
 
+@contextmanager
+def batch():
+    '''
+    Collect the changes made in the block and write them to known_hosts
+    at the end, in a single rewrite.  New SSH connections call flush()
+    first, so they never see stale entries.
+    '''
+    global _batch_depth
+    with lock:
+        _batch_depth += 1
+    try:
+        yield
+    finally:
+        with lock:
+            _batch_depth -= 1
+        flush()
+
+
+def _change(changes):
+    with lock:
+        _pending.extend(changes)
+        if _batch_depth > 0: return
+    flush()
+
+
 def remove(ip_address, public_host_key):
     '''Remove a specific known host key.'''
-    _rewrite(ip_address, False, public_host_key)
+    _change([(ip_address, False, public_host_key)])
 
 
 def add(ip_address, public_host_key):
     '''Add a known host key.'''
-    _rewrite(ip_address, True, public_host_key)
+    _change([(ip_address, True, public_host_key)])
 
 
 def update(prev_address, new_address, public_host_key):
     assert public_host_key is not None
-    # FIXME: this rewrites known_hosts twice.
+    changes = []
     if prev_address is not None and prev_address != new_address:
-        remove(prev_address, public_host_key)
+        changes.append((prev_address, False, public_host_key))
     if new_address is not None:
-        add(new_address, public_host_key)
+        changes.append((new_address, True, public_host_key))
+    _change(changes)
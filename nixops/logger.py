@@ -1,55 +1,251 @@
 # -*- coding: utf-8 -*-
+import re
 import sys
+import json
+import time
+import atexit
 import threading
+import collections
 
 from nixops.util import ansi_warn, ansi_error, ansi_success
 
-__all__ = ['Logger']
+__all__ = ['Logger', 'configure']
+
+
+# Defaults for new loggers, set by configure().
+_options = {'asynchronous': False, 'json_file': None}
+
+# Serialises writes to a JSON sink shared by several loggers.
+_json_lock = threading.Lock()
+
+_ansi_escape = re.compile(r'\033\[[0-9;]*m')
+
+# Asynchronous loggers whose writer thread has been started.
+_started = []
+_started_lock = threading.Lock()
+
+# Set by _stop_all(); from then on, loggers write synchronously.
+_exiting = False
+
+
+def configure(asynchronous=False, json_file=None):
+    """
+    Set the defaults for loggers created afterwards: whether lines are
+    written by a background thread, and a file object that receives a
+    JSON object per line (with the time, machine, phase and message).
+    """
+    _options['asynchronous'] = asynchronous
+    _options['json_file'] = json_file
+
+
+def flush_all():
+    """Wait until all asynchronous loggers have written their queued lines."""
+    with _started_lock:
+        loggers = list(_started)
+    for logger in loggers:
+        logger.flush()
+
+
+def _stop_all():
+    """
+    Write the queued lines and stop the writer threads, so that none
+    of them is still waiting while the interpreter shuts down.  Lines
+    logged afterwards are written synchronously.
+    """
+    global _exiting
+    with _started_lock:
+        _exiting = True
+        loggers = list(_started)
+        del _started[:]
+    for logger in loggers:
+        logger._stop_writer()
+
+
+atexit.register(_stop_all)
 
 
 class Logger(object):
-    def __init__(self, log_file):
+    """
+    Writes the output of NixOps and of the machines it manages to
+    ‘log_file’.  If ‘asynchronous’ is set, logging a line only appends
+    it to a queue, and a writer thread writes the queued lines in
+    batches, so that threads producing lots of output don't wait for
+    each other or for the terminal.  Call flush() to wait until the
+    queued lines have been written.
+    """
+
+    def __init__(self, log_file, asynchronous=None, json_file=None):
         self._last_log_prefix = None  # XXX!
         self._log_lock = threading.Lock()
         self._log_file = log_file
         self._auto_response = None
         self.machine_loggers = []
+        self.phase = None
+        self._asynchronous = _options['asynchronous'] if asynchronous is None else asynchronous
+        self._json_file = _options['json_file'] if json_file is None else json_file
+        self._json_partial = {}
+        # deque.append() and popleft() are atomic, so producers never
+        # block on the queue.
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._stopping = False
 
     @property
     def log_file(self):
         # XXX: Remove me soon!
+        # Callers write to the file directly (e.g. by passing it to a
+        # subprocess), so write the queued lines first.
+        self.flush()
         return self._log_file
 
     def isatty(self):
         return self._log_file.isatty()
 
-    def log(self, msg):
+    def _emit(self, kind, prefix, msg, machine=None, phase=None):
+        event = (time.time(), kind, prefix, msg, machine, phase or self.phase)
+        if not self._asynchronous or _exiting:
+            self._write_sync([event])
+            return
+        self._queue.append(event)
+        self._wakeup.set()
+        if self._writer is None: self._start_writer()
+
+    def _write_sync(self, events):
+        """
+        Write ‘events’ from the calling thread, after the lines still
+        queued for the writer thread, which is stopped first.
+        """
+        self._stop_writer()
         with self._log_lock:
-            if self._last_log_prefix is not None:
-                self._log_file.write("\n")
+            queued = []
+            while self._queue:
+                queued.append(self._queue.popleft())
+            self._write_events(queued + events)
+
+    def _start_writer(self):
+        if _exiting:
+            # Don't start a thread while shutting down; write the queued
+            # lines right away instead.
+            self._write_sync([])
+            return
+        with self._writer_lock:
+            if self._writer is not None: return
+            self._writer = threading.Thread(target=self._writer_loop, name="nixops-logger")
+            self._writer.daemon = True
+            self._writer.start()
+        with _started_lock:
+            _started.append(self)
+
+    def _stop_writer(self):
+        with self._writer_lock:
+            writer = self._writer
+            if writer is None: return
+            self._stopping = True
+        self._wakeup.set()
+        writer.join()
+        with self._writer_lock:
+            self._writer = None
+            self._stopping = False
+
+    def _writer_loop(self):
+        while True:
+            if self._stopping and not self._queue: return
+            self._wakeup.wait()
+            self._wakeup.clear()
+            events = []
+            while self._queue:
+                events.append(self._queue.popleft())
+            if events:
+                with self._log_lock:
+                    try:
+                        self._write_events(events)
+                    except Exception:
+                        # Don't let a failing write (e.g. a closed
+                        # pipe) kill the writer thread.
+                        pass
+
+    def flush(self):
+        """Wait until all lines logged so far have been written."""
+        writer = self._writer
+        if not self._asynchronous or writer is None:
+            return
+        if _exiting:
+            self._write_sync([])
+            return
+        done = threading.Event()
+        self._queue.append((None, 'flush', None, done, None, None))
+        self._wakeup.set()
+        # Wait with a timeout, so that Ctrl-C works, and write the
+        # queued lines ourselves if the writer thread has died.
+        while not done.wait(0.5):
+            if not writer.is_alive():
+                self._write_sync([])
+                return
+
+    def _write_events(self, events):
+        """Format ‘events’ and write them with a single write per file."""
+        out = []
+        json_out = []
+        flushed = []
+        for (timestamp, kind, prefix, msg, machine, phase) in events:
+            if kind == 'flush':
+                flushed.append(msg)
+            elif kind == 'log':
+                if self._last_log_prefix is not None:
+                    out.append("\n")
+                    self._last_log_prefix = None
+                out.append(prefix + msg + "\n")
+                json_out.append(self._json_line(timestamp, machine, phase, msg))
+            elif kind == 'start':
+                if self._last_log_prefix != prefix:
+                    if self._last_log_prefix is not None:
+                        out.append("\n")
+                    out.append(prefix)
+                out.append(msg)
+                self._last_log_prefix = prefix
+                if self._json_file is not None:
+                    self._json_partial[machine] = self._json_partial.get(machine, "") + msg
+            elif kind == 'end':
+                last = self._last_log_prefix
                 self._last_log_prefix = None
-            self._log_file.write(msg + "\n")
+                line = self._json_partial.pop(machine, "") + msg
+                if last != prefix:
+                    if last is not None:
+                        out.append("\n")
+                    if msg == "":
+                        if line != "": json_out.append(self._json_line(timestamp, machine, phase, line))
+                        continue
+                    out.append(prefix)
+                out.append(msg + "\n")
+                json_out.append(self._json_line(timestamp, machine, phase, line))
+
+        try:
+            if out:
+                self._log_file.write("".join(out))
+                if self._asynchronous: self._log_file.flush()
+            if self._json_file is not None and json_out:
+                with _json_lock:
+                    self._json_file.write("".join(json_out))
+                    self._json_file.flush()
+        finally:
+            for done in flushed:
+                done.set()
+
+    def _json_line(self, timestamp, machine, phase, msg):
+        if self._json_file is None: return ""
+        return json.dumps({'time': round(timestamp, 3), 'machine': machine, 'phase': phase,
+                           'message': _ansi_escape.sub("", msg)}) + "\n"
+
+    def log(self, msg):
+        self._emit('log', "", msg)
 
     def log_start(self, prefix, msg):
-        with self._log_lock:
-            if self._last_log_prefix != prefix:
-                if self._last_log_prefix is not None:
-                    self._log_file.write("\n")
-                self._log_file.write(prefix)
-            self._log_file.write(msg)
-            self._last_log_prefix = prefix
+        self._emit('start', prefix, msg)
 
     def log_end(self, prefix, msg):
-        with self._log_lock:
-            last = self._last_log_prefix
-            self._last_log_prefix = None
-            if last != prefix:
-                if last is not None:
-                    self._log_file.write("\n")
-                if msg == "":
-                    return
-                self._log_file.write(prefix)
-            self._log_file.write(msg + "\n")
+        self._emit('end', prefix, msg)
 
     def get_logger_for(self, machine_name):
         """
@@ -80,6 +276,7 @@ class Logger(object):
         self.log(ansi_error("error: " + msg, outfile=self._log_file))
 
     def confirm_once(self, question):
+        self.flush()
         with self._log_lock:
             if self._last_log_prefix is not None:
                 self._log_file.write("\n")
@@ -114,6 +311,9 @@ class MachineLogger(object):
         self.main_logger = main_logger
         self.machine_name = machine_name
         self.index = None
+        # The phase (e.g. ‘copy’) this machine is in, if it differs
+        # from the phase of the main logger.
+        self.phase = None
         self.update_log_prefix(0)
 
     def register_index(self, index):
@@ -131,16 +331,16 @@ class MachineLogger(object):
             )
 
     def log(self, msg):
-        self.main_logger.log(self._log_prefix + msg)
+        self.main_logger._emit('log', self._log_prefix, msg, self.machine_name, self.phase)
 
     def log_start(self, msg):
-        self.main_logger.log_start(self._log_prefix, msg)
+        self.main_logger._emit('start', self._log_prefix, msg, self.machine_name, self.phase)
 
     def log_continue(self, msg):
-        self.main_logger.log_start(self._log_prefix, msg)
+        self.main_logger._emit('start', self._log_prefix, msg, self.machine_name, self.phase)
 
     def log_end(self, msg):
-        self.main_logger.log_end(self._log_prefix, msg)
+        self.main_logger._emit('end', self._log_prefix, msg, self.machine_name, self.phase)
 
     def warn(self, msg):
         self.log(ansi_warn("warning: " + msg,
@@ -3,7 +3,7 @@ import string
 
 from textwrap import dedent
 
-__all__ = ['py2nix', 'nix2py', 'nixmerge', 'expand_dict',
+__all__ = ['py2nix', 'nix2py', 'nixmerge', 'nixmerge_all', 'expand_dict',
            'RawValue', 'Function']
 
 
@@ -288,7 +288,7 @@ def expand_dict(unexpanded):
             strings[key] = val
 
     return {key: (expand_dict(val) if isinstance(val, dict) else val)
-            for key, val in reduce(nixmerge, paths + [strings]).iteritems()}
+            for key, val in nixmerge_all(paths + [strings]).iteritems()}
 
 
 def nixmerge(expr1, expr2):
@@ -319,6 +319,39 @@ def nixmerge(expr1, expr2):
     return _merge(expr1, expr2)
 
 
+def nixmerge_all(exprs):
+    """
+    Merge all of the given expressions like reduce(nixmerge, exprs, {}),
+    but in time linear in their total size: instead of copying the
+    result of every step, each dictionary that needs merging is copied
+    once and merged into in place.  The expressions themselves are not
+    modified.
+    """
+    copied = set() # ids of the dictionaries owned by the result
+
+    def _merge_into(out, key, e2):
+        if key not in out:
+            out[key] = e2
+            return
+        e1 = out[key]
+        if isinstance(e1, dict) and isinstance(e2, dict):
+            if id(e1) not in copied:
+                e1 = out[key] = dict(e1)
+                copied.add(id(e1))
+            for (k, v) in e2.iteritems():
+                _merge_into(e1, k, v)
+        elif isinstance(e1, list) and isinstance(e2, list):
+            out[key] = list(set(e1).union(e2))
+        else:
+            err = "unable to merge {0} with {1}".format(type(e1), type(e2))
+            raise ValueError(err)
+
+    root = {None: {}}
+    for expr in exprs:
+        _merge_into(root, None, expr)
+    return root[None]
+
+
 def nix2py(source):
     """
     Dedent the given Nix source code and encode it into multiple raw values
@@ -1,8 +1,12 @@
+# -*- coding: utf-8 -*-
+
 import threading
 import sys
 import Queue
 import random
 import traceback
+import time
+from collections import defaultdict
 
 class MultipleExceptions(Exception):
     def __init__(self, exceptions=[]):
@@ -74,3 +78,355 @@ def run_tasks(nr_workers, tasks, worker_fun):
         raise MultipleExceptions(exceptions)
 
     return results
+
+
+# The default maximum number of worker threads of an Executor.
+DEFAULT_MAX_WORKERS = 32
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter, allowing ‘rate’ operations per second
+    on average, in bursts of at most ‘burst’ operations.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancelled=None):
+        """
+        Take a token, waiting until one is available.  Returns False if
+        the event ‘cancelled’ got set while waiting.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if cancelled is None:
+                time.sleep(wait)
+            elif cancelled.wait(wait):
+                return False
+
+
+def _lookup_limit(rate_limits, key):
+    """Return the limit for ‘key’ or, for tuples, its first element."""
+    limit = rate_limits.get(key)
+    if limit is None and isinstance(key, tuple) and key:
+        limit = rate_limits.get(key[0])
+    return limit
+
+
+# Limits on the rate of API calls per cloud provider account (see
+# ResourceState.get_rate_limit_key()), as (calls per second, burst
+# size).
+RATE_LIMITS = {'ec2': (20, 100), 'gce': (20, 50), 'azure': (3, 10)}
+
+_api_buckets = {}
+_api_buckets_lock = threading.Lock()
+
+
+def throttle(key):
+    """
+    Wait until another API call may be made to the cloud provider
+    account identified by ‘key’, according to RATE_LIMITS.  The limit
+    is shared by all threads.
+    """
+    limit = _lookup_limit(RATE_LIMITS, key)
+    if limit is None: return
+    with _api_buckets_lock:
+        bucket = _api_buckets.get(key)
+        if bucket is None:
+            bucket = _api_buckets[key] = TokenBucket(*limit)
+    bucket.acquire()
+
+
+def rate_limited(fun, key):
+    """Return a function that calls ‘fun’ after throttle(‘key’)."""
+    def wrapper(*args, **kwargs):
+        throttle(key)
+        return fun(*args, **kwargs)
+    return wrapper
+
+
+class TaskResult(object):
+    """The outcome of running a task (the ‘index’th one) in an Executor."""
+
+    def __init__(self, index, task, result, excinfo, start, end):
+        self.index = index
+        self.task = task
+        self.result = result
+        self.excinfo = excinfo
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Executor(object):
+    """
+    Runs a function on many tasks in a bounded pool of worker threads
+    (at most ‘nr_workers’, -1 meaning one per task).
+
+    If ‘key_fun’ is given, tasks are started at a rate limited per key,
+    e.g. per cloud provider account, by a TokenBucket.  ‘rate_limits’
+    maps keys to (rate, burst) pairs; for keys that are tuples, the
+    first element (e.g. the provider) is also looked up.  Tasks with
+    other keys are not rate limited.
+
+    Pending tasks are cancelled by cancel(), on Ctrl-C and, if
+    ‘fail_fast’ is set, as soon as a task fails.  Tasks that are
+    already running are not interrupted.
+    """
+
+    def __init__(self, nr_workers=DEFAULT_MAX_WORKERS, key_fun=None, rate_limits={}, fail_fast=False):
+        if nr_workers != -1 and nr_workers < 1:
+            raise Exception("number of worker threads must be at least 1")
+        self.nr_workers = nr_workers
+        self.key_fun = key_fun
+        self.rate_limits = rate_limits
+        self.fail_fast = fail_fast
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def _get_bucket(self, key):
+        limit = _lookup_limit(self.rate_limits, key)
+        if limit is None: return None
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(*limit)
+            return self._buckets[key]
+
+    def cancel(self):
+        """Don't start any more tasks."""
+        self._cancelled.set()
+
+    def stream(self, tasks, worker_fun):
+        """
+        Run ‘worker_fun’ on each of ‘tasks’, yielding a TaskResult for
+        each task in the order in which they finish.  Exceptions raised
+        by ‘worker_fun’ are returned in the ‘excinfo’ field rather than
+        raised.  Closing the generator cancels the remaining tasks.
+        """
+        tasks = list(tasks)
+        if not tasks: return
+        self._cancelled.clear()
+        cancelled = self._cancelled
+
+        task_queue = Queue.Queue()
+        for n, t in enumerate(tasks): task_queue.put((n, t))
+        result_queue = Queue.Queue()
+
+        def thread_fun():
+            while not cancelled.is_set():
+                try:
+                    (n, t) = task_queue.get(False)
+                except Queue.Empty:
+                    break
+                bucket = self._get_bucket(self.key_fun(t)) if self.key_fun else None
+                if bucket and not bucket.acquire(cancelled): break
+                start = time.time()
+                try:
+                    res = (worker_fun(t), None)
+                except Exception:
+                    res = (None, sys.exc_info())
+                    if self.fail_fast: cancelled.set()
+                result_queue.put(TaskResult(n, t, res[0], res[1], start, time.time()))
+            result_queue.put(None)
+
+        nr_workers = len(tasks) if self.nr_workers == -1 else min(self.nr_workers, len(tasks))
+        for n in range(nr_workers):
+            thr = threading.Thread(target=thread_fun)
+            thr.daemon = True
+            thr.start()
+
+        running = nr_workers
+        try:
+            while running:
+                try:
+                    # Use a timeout to allow keyboard interrupts to be
+                    # processed.
+                    res = result_queue.get(True, 1)
+                except Queue.Empty:
+                    continue
+                if res is None:
+                    running -= 1
+                    continue
+                yield res
+        finally:
+            cancelled.set()
+
+    def run(self, tasks, worker_fun, timings=None):
+        """
+        Run ‘worker_fun’ on each of ‘tasks’ and return the results in
+        the order of ‘tasks’.  Raises the exception of the failed task,
+        or MultipleExceptions if several tasks failed.  Fills in
+        ‘timings’ (if given) with the (start, end) times of each task.
+        """
+        tasks = list(tasks)
+        results = {}
+        exceptions = []
+        for res in self.stream(tasks, worker_fun):
+            if timings is not None: timings[res.task] = (res.start, res.end)
+            if res.excinfo:
+                exceptions.append(res.excinfo)
+            else:
+                results[res.index] = res.result
+
+        if len(exceptions) == 1:
+            excinfo = exceptions[0]
+            raise excinfo[0], excinfo[1], excinfo[2]
+
+        if len(exceptions) > 1:
+            raise MultipleExceptions(exceptions)
+
+        return [results.get(n) for n in range(len(tasks))]
+
+
+class DependencyCycle(Exception):
+    pass
+
+
+def run_dag(nr_workers, tasks, deps_fun, worker_fun, key_fun=None, limits={}, timings=None):
+    """
+    Run ‘worker_fun’ on each of ‘tasks’, but only after it has been run
+    on all the tasks returned by ‘deps_fun’ for that task.  Tasks are
+    started in the order in which they become ready, by at most
+    ‘nr_workers’ threads (-1 meaning no limit).  Worker threads are only
+    started for tasks that are ready, so tasks that are waiting on their
+    dependencies don't occupy a thread.
+
+    If ‘key_fun’ is given, at most ‘limits[key_fun(t)]’ tasks with the
+    same key run concurrently.  If a task fails, the tasks that depend
+    on it (transitively) are skipped.  Returns a dictionary mapping each
+    task that ran to its result, and fills in ‘timings’ (if given) with
+    the (start, end) times of each task.
+    """
+    tasks = list(tasks)
+    if nr_workers == -1: nr_workers = max(len(tasks), 1)
+    if nr_workers < 1: raise Exception("number of worker threads must be at least 1")
+
+    index = {t: n for n, t in enumerate(tasks)}
+    deps = [set(index[d] for d in deps_fun(t) if d in index and d is not t) for t in tasks]
+    rdeps = [[] for t in tasks]
+    for n, ds in enumerate(deps):
+        for d in ds: rdeps[d].append(n)
+
+    # Reject cycles up front, since they would otherwise hang forever.
+    waiting = [len(ds) for ds in deps]
+    ready = [n for n in range(len(tasks)) if waiting[n] == 0]
+    ordered = 0
+    left = list(waiting)
+    queue = list(ready)
+    while queue:
+        n = queue.pop()
+        ordered += 1
+        for r in rdeps[n]:
+            left[r] -= 1
+            if left[r] == 0: queue.append(r)
+    if ordered < len(tasks):
+        raise DependencyCycle("dependency cycle between {0}".format(
+            ", ".join(sorted("‘{0}’".format(getattr(tasks[n], "name", tasks[n]))
+                             for n in range(len(tasks)) if left[n] > 0))))
+
+    lock = threading.Condition()
+    running = defaultdict(int)
+    state = {'threads': 0, 'active': 0, 'done': 0}
+    results = {}
+    exceptions = []
+    failed = set()
+
+    def key(n):
+        return key_fun(tasks[n]) if key_fun else None
+
+    def next_task():
+        # Return the first ready task whose key has capacity left.
+        for i, n in enumerate(ready):
+            k = key(n)
+            if k in limits and running[k] >= limits[k]: continue
+            del ready[i]
+            running[k] += 1
+            return n
+        return None
+
+    def finish(n, ok):
+        running[key(n)] -= 1
+        state['done'] += 1
+        todo = [] if ok else [n]
+        while todo:
+            m = todo.pop()
+            for r in rdeps[m]:
+                if r in failed: continue
+                failed.add(r)
+                state['done'] += 1
+                todo.append(r)
+        if ok:
+            for r in rdeps[n]:
+                waiting[r] -= 1
+                if waiting[r] == 0 and r not in failed: ready.append(r)
+
+    def thread_fun():
+        with lock:
+            while True:
+                n = next_task()
+                if n is None:
+                    if state['done'] == len(tasks) or state['active'] == 0 and not ready:
+                        break
+                    lock.wait()
+                    continue
+                state['active'] += 1
+                lock.release()
+                start = time.time()
+                try:
+                    res = (worker_fun(tasks[n]), None)
+                except Exception:
+                    res = (None, sys.exc_info())
+                end = time.time()
+                lock.acquire()
+                state['active'] -= 1
+                if timings is not None: timings[tasks[n]] = (start, end)
+                if res[1]:
+                    exceptions.append(res[1])
+                else:
+                    results[tasks[n]] = res[0]
+                finish(n, res[1] is None)
+                spawn()
+                lock.notify_all()
+            state['threads'] -= 1
+            lock.notify_all()
+
+    def spawn():
+        # Start additional threads for ready tasks, up to the limit.
+        idle = state['threads'] - state['active']
+        while state['threads'] < nr_workers and len(ready) > idle:
+            thr = threading.Thread(target=thread_fun)
+            thr.daemon = True
+            state['threads'] += 1
+            idle += 1
+            thr.start()
+
+    with lock:
+        spawn()
+        while state['threads'] > 0:
+            # Use a timeout to allow keyboard interrupts to be processed.
+            lock.wait(1)
+
+    if len(exceptions) == 1:
+        excinfo = exceptions[0]
+        raise excinfo[0], excinfo[1], excinfo[2]
+
+    if len(exceptions) > 1:
+        raise MultipleExceptions(exceptions)
+
+    return results
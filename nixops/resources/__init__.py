@@ -2,6 +2,7 @@
 
 import re
 import nixops.util
+import nixops.wait
 
 
 class ResourceDefinition(object):
@@ -59,19 +60,41 @@ class ResourceState(object):
         self.depl = depl
         self.name = name
         self.id = id
+        # In-memory copy of this resource's rows in ResourceAttrs.  It
+        # is normally filled in bulk by the deployment; None means that
+        # it has to be (re)loaded from the state file.
+        self._attrs = depl._take_resource_attrs(id)
         self.logger = depl.logger.get_logger_for(name)
         self.logger.register_index(self.index)
 
+    def _load_attrs(self):
+        """Load all machine attributes from the state file."""
+        with self.depl._db:
+            self.depl._db.flush_writes()
+            c = self.depl._db.cursor()
+            c.execute("select name, value from ResourceAttrs where machine = ?", (self.id,))
+            self._attrs = dict(c.fetchall())
+            return self._attrs
+
+    def _invalidate_attrs(self):
+        self._attrs = None
+
     def _set_attrs(self, attrs):
         """Update machine attributes in the state file."""
         with self.depl._db:
-            c = self.depl._db.cursor()
+            cache = self._attrs if self._attrs is not None else self._load_attrs()
             for n, v in attrs.iteritems():
                 if v == None:
-                    c.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, n))
+                    if n not in cache: continue
+                    self.depl._db.queue_write("delete from ResourceAttrs where machine = ? and name = ?", (self.id, n))
+                    del cache[n]
                 else:
-                    c.execute("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
-                              (self.id, n, v))
+                    v = nixops.util.state_file_value(v)
+                    if cache.get(n) == v: continue
+                    self.depl._db.queue_write("insert or replace into ResourceAttrs(machine, name, value) values (?, ?, ?)",
+                                              (self.id, n, v))
+                    cache[n] = v
+                self.depl._db.on_rollback(self._invalidate_attrs)
 
     def _set_attr(self, name, value):
         """Update one machine attribute in the state file."""
@@ -79,21 +102,18 @@ class ResourceState(object):
 
     def _del_attr(self, name):
         """Delete a machine attribute from the state file."""
-        with self.depl._db:
-            self.depl._db.execute("delete from ResourceAttrs where machine = ? and name = ?", (self.id, name))
+        self._set_attrs({name: None})
 
     def _get_attr(self, name, default=nixops.util.undefined):
         """Get a machine attribute from the state file."""
-        with self.depl._db:
-            c = self.depl._db.cursor()
-            c.execute("select value from ResourceAttrs where machine = ? and name = ?", (self.id, name))
-            row = c.fetchone()
-            if row != None: return row[0]
-            return nixops.util.undefined
+        attrs = self._attrs
+        if attrs is None: attrs = self._load_attrs()
+        return attrs.get(name, nixops.util.undefined)
 
     def export(self):
         """Export the resource to move between databases"""
         with self.depl._db:
+            self.depl._db.flush_writes()
             c = self.depl._db.cursor()
             c.execute("select name, value from ResourceAttrs where machine = ?", (self.id,))
             rows = c.fetchall()
@@ -133,6 +153,23 @@ class ResourceState(object):
         elif state == self.RESCUE: return "Rescue"
         else: raise Exception("machine is in unknown state")
 
+    def get_rate_limit_key(self):
+        """
+        Return a key identifying the cloud provider account whose API
+        this resource uses, so that operations on many resources can
+        be rate limited per account (see nixops.parallel.throttle()), or
+        None.  The first element of the key is the provider.
+        """
+        return None
+
+    def backoff(self, initial=1, max_delay=15, **kwargs):
+        """
+        Return a nixops.wait.Backoff for polling the cloud provider,
+        with the time spent waiting accounted to this resource type.
+        """
+        return nixops.wait.Backoff(initial=initial, max_delay=max_delay,
+                                   category=self.get_type(), **kwargs)
+
     def prefix_definiton(self, attr):
         """Prefix the resource set with a py2nixable attrpath"""
         raise Exception("not implemented")
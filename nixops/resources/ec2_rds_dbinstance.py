@@ -86,9 +86,7 @@ class EC2RDSDbInstanceState(nixops.resources.ResourceState):
 
     def _connect(self):
         if self._conn: return
-        (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(self.access_key_id)
-        self._conn = boto.rds.connect_to_region(
-            region_name=self.region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+        self._conn = nixops.ec2_utils.get_connection("rds", self.region, self.access_key_id, boto.rds.connect_to_region)
 
     def _exists(self):
         return self.state != self.MISSING and self.state != self.UNKNOWN
@@ -72,9 +72,7 @@ class SQSQueueState(nixops.resources.ResourceState):
     def connect(self):
         if self._conn: return
         assert self.region
-        (access_key_id, secret_access_key) = nixops.ec2_utils.fetch_aws_secret_key(self.access_key_id)
-        self._conn = boto.sqs.connect_to_region(
-            region_name=self.region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+        self._conn = nixops.ec2_utils.get_connection("sqs", self.region, self.access_key_id, boto.sqs.connect_to_region)
 
 
     def _destroy(self):
@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 import atexit
+import collections
+import hashlib
 import os
 import shlex
 import subprocess
 import sys
+import threading
 import time
 import weakref
 from tempfile import mkdtemp
 import nixops.util
+import nixops.known_hosts
 
-__all__ = ['SSHConnectionFailed', 'SSHCommandFailed', 'SSH']
+__all__ = ['SSHConnectionFailed', 'SSHCommandFailed', 'SSH', 'SSHMasterPool']
 
 
 class SSHConnectionFailed(Exception):
@@ -20,13 +24,155 @@ class SSHCommandFailed(nixops.util.CommandFailed):
     pass
 
 
+def run_batch(run_fun, commands, stop_on_error=False):
+    """
+    Run the shell commands in ‘commands’ one after another as a single
+    script, rather than starting a remote session for each of them.
+    ‘run_fun’ is called with the script and must return its standard
+    output.  Returns a list containing a tuple (exit status, standard
+    output) for each command.  If ‘stop_on_error’ is set, the commands
+    after the first one that fails are not run, and their result is
+    None.
+    """
+    # Each command's output is preceded by a line containing a random
+    # marker, its exit status and its length, so arbitrary output can
+    # be separated reliably.
+    marker = "nixops-batch-" + os.urandom(8).encode("hex")
+    script = ['t="$(mktemp)" || exit 1']
+    for command in commands:
+        script.append('(\n{0}\n) > "$t"; rc=$?; printf "\\n{1} %d %d\\n" $rc $(wc -c < "$t"); cat "$t"'
+                      .format(command, marker))
+        if stop_on_error:
+            script.append('[ $rc = 0 ] || { rm -f "$t"; exit 0; }')
+    script.append('rm -f "$t"')
+
+    out = run_fun("\n".join(script))
+
+    results = []
+    pos = 0
+    header = "\n" + marker + " "
+    while True:
+        start = out.find(header, pos)
+        if start == -1: break
+        end = out.index("\n", start + 1)
+        (status, length) = map(int, out[start + len(header):end].split())
+        pos = end + 1 + length
+        results.append((status, out[end + 1:pos]))
+    if len(results) < len(commands) and not (stop_on_error and results and results[-1][0] != 0):
+        raise SSHCommandFailed("incomplete output from a batch of commands", 1)
+    return results + [None] * (len(commands) - len(results))
+
+
+class SSHMasterPool(object):
+    """
+    Keeps track of the SSH master connections of this process.  At
+    most ‘max_masters’ masters (-1 meaning no limit) are kept running;
+    when a new one is needed, the least recently used one is stopped.
+    If ‘persist_dir’ is set, the control sockets are kept in that
+    directory rather than in a temporary one, and the masters are left
+    running when NixOps exits, so that later invocations can reuse them
+    until they time out (see ‘ControlPersist’).
+    """
+
+    def __init__(self):
+        self.max_masters = -1
+        self.persist_dir = None
+        self._lock = threading.Lock()
+        self._masters = collections.OrderedDict()
+        self.started = 0
+        self.reused = 0
+        self.evicted = 0
+        self.setup_times = []
+
+    def configure(self, max_masters=-1, persist_dir=None):
+        self.max_masters = max_masters
+        self.persist_dir = persist_dir
+        if persist_dir and not os.path.exists(persist_dir):
+            os.makedirs(persist_dir, 0700)
+
+    def get_control_socket(self, target, ssh_flags, host_id=None):
+        """
+        Return the stable control socket path for a connection, if
+        any.  ‘host_id’ identifies the machine behind ‘target’ (e.g. its
+        host key), so that a master to a machine that was since replaced
+        by another one with the same address is not reused.
+        """
+        if not self.persist_dir: return None
+        key = hashlib.sha256("\0".join([target, host_id or ""] + ssh_flags)).hexdigest()[:16]
+        return "{0}/{1}".format(self.persist_dir, key)
+
+    def touch(self, master):
+        """Mark ‘master’ as the most recently used master."""
+        with self._lock:
+            self._masters.pop(id(master), None)
+            self._masters[id(master)] = weakref.ref(master)
+
+    def add(self, master, setup_time):
+        """
+        Register a new master, stopping the least recently used ones
+        if there are too many.
+        """
+        victims = []
+        with self._lock:
+            if master.reused:
+                self.reused += 1
+            else:
+                self.started += 1
+                self.setup_times.append(setup_time)
+            self._masters[id(master)] = weakref.ref(master)
+            while self.max_masters > 0 and len(self._masters) > self.max_masters:
+                (key, ref) = self._masters.popitem(last=False)
+                victim = ref()
+                if victim is not None and victim.is_alive():
+                    victims.append(victim)
+                    self.evicted += 1
+        for victim in victims:
+            victim.stop()
+
+    def remove(self, master):
+        with self._lock:
+            self._masters.pop(id(master), None)
+
+    def stats(self):
+        """Return statistics about the master connections."""
+        with self._lock:
+            times = list(self.setup_times)
+            return {
+                'started': self.started,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'mean_setup_time': sum(times) / len(times) if times else None,
+                'max_setup_time': max(times) if times else None,
+            }
+
+
+# The connection pool of this process.
+pool = SSHMasterPool()
+
+
+def get_default_persist_dir():
+    return os.environ.get("HOME", "") + "/.nixops/ssh"
+
+
 class SSHMaster(object):
-    def __init__(self, target, logger, ssh_flags, passwd, user):
+    def __init__(self, target, logger, ssh_flags, passwd, user, host_id=None):
         self._running = False
+        self._persistent = pool.persist_dir is not None
         self._tempdir = nixops.util.SelfDeletingDir(mkdtemp(prefix="nixops-ssh-tmp"))
         self._askpass_helper = None
-        self._control_socket = self._tempdir + "/master-socket"
+        self._control_socket = pool.get_control_socket(target, ssh_flags, host_id) or self._tempdir + "/master-socket"
         self._ssh_target = target
+        self.opts = ["-oControlPath={0}".format(self._control_socket)]
+        self.reused = False
+
+        # Reuse a master left running by a previous invocation.
+        if self._persistent and self.is_alive() and subprocess.call(
+                ["ssh", target, "-S", self._control_socket, "-O", "check"],
+                stdout=nixops.util.devnull, stderr=nixops.util.devnull) == 0:
+            self.reused = True
+            self._running = True
+            return
+
         pass_prompts = 0 if "-i" in ssh_flags and user is None else 3
         kwargs = {}
 
@@ -49,30 +195,34 @@ class SSHMaster(object):
                '-oServerAliveInterval=60',
                '-oControlPersist=600']
 
+        # Make sure ssh sees the host keys of machines whose address
+        # changed in the current batch.
+        nixops.known_hosts.flush()
         res = subprocess.call(cmd + ssh_flags, **kwargs)
         if res != 0:
             raise SSHConnectionFailed(
                 "unable to start SSH master connection to "
                 "‘{0}’".format(target)
             )
-        self.opts = ["-oControlPath={0}".format(self._control_socket)]
-
-        timeout = 60.0
+        # The socket usually appears right away, so poll quickly at
+        # first.
+        deadline = time.time() + 60
+        delay = 0.005
         while not self.is_alive():
-            if timeout < 0:
+            if time.time() > deadline:
                 raise SSHConnectionFailed(
                     "could not establish an SSH master socket to "
                     "‘{0}’ within 60 seconds".format(target)
                 )
-            time.sleep(0.1)
-            timeout -= 0.1
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
 
         self._running = True
 
         weakself = weakref.ref(self)
         def maybe_shutdown():
             realself = weakself()
-            if realself is not None:
+            if realself is not None and not realself._persistent:
                 realself.shutdown()
         atexit.register(maybe_shutdown)
 
@@ -96,19 +246,34 @@ sys.stdout.write(os.environ['NIXOPS_SSH_PASSWORD'])""".format(sys.executable))
         os.close(fd)
         return path
 
+    def stop(self):
+        """
+        Make the master stop accepting new sessions, while letting the
+        running ones finish.  The temporary directory is kept until this
+        object goes away, since those sessions may still need it.
+        """
+        if not self._running: return
+        self._running = False
+        pool.remove(self)
+        subprocess.call(["ssh", self._ssh_target, "-S",
+                         self._control_socket, "-O", "stop"],
+                        stderr=nixops.util.devnull)
+
     def shutdown(self):
         """
         Shutdown master process and clean up temporary files.
         """
         if not self._running: return
         self._running = False
+        pool.remove(self)
         subprocess.call(["ssh", self._ssh_target, "-S",
                          self._control_socket, "-O", "exit"],
                         stderr=nixops.util.devnull)
         self._tempdir = None
 
     def __del__(self):
-        self.shutdown()
+        if not self._persistent:
+            self.shutdown()
 
 
 class SSH(object):
@@ -120,9 +285,13 @@ class SSH(object):
         self._flag_fun = lambda: []
         self._host_fun = None
         self._passwd_fun = lambda: None
+        self._host_id_fun = lambda: None
         self._logger = logger
         self._ssh_master = None
 
+        # Time it took to set up the last master connection.
+        self.connect_time = None
+
     def register_host_fun(self, host_fun):
         """
         Register a function which returns the hostname or IP to connect to. The
@@ -159,6 +328,14 @@ class SSH(object):
     def _get_passwd(self):
         return self._passwd_fun()
 
+    def register_host_id_fun(self, host_id_fun):
+        """
+        Register a function that returns a string identifying the remote
+        machine (such as its host key), or None.  It requires no
+        arguments and is used to name persistent control sockets.
+        """
+        self._host_id_fun = host_id_fun
+
     def reset(self):
         """
         Reset SSH master connection.
@@ -176,6 +353,7 @@ class SSH(object):
         if self._ssh_master is not None:
             master = weakref.proxy(self._ssh_master)
             if master.is_alive():
+                pool.touch(self._ssh_master)
                 return master
             else:
                 master.shutdown()
@@ -194,7 +372,10 @@ class SSH(object):
                 started_at = time.time()
                 self._ssh_master = SSHMaster(self._get_target(user),
                                              self._logger, flags,
-                                             self._get_passwd(), user)
+                                             self._get_passwd(), user,
+                                             self._host_id_fun())
+                self.connect_time = time.time() - started_at
+                pool.add(self._ssh_master, self.connect_time)
                 break
             except Exception:
                 tries = tries - 1
@@ -208,6 +389,16 @@ class SSH(object):
 
         return weakref.proxy(self._ssh_master)
 
+    def run_batch(self, commands, flags=[], stop_on_error=False, **kwargs):
+        """
+        Run the shell commands in ‘commands’ on the target host in a
+        single SSH session.  See run_batch() for the return value; the
+        other arguments are the same as for run_command().
+        """
+        return run_batch(
+            lambda script: self.run_command(script, flags=flags, capture_stdout=True, **kwargs),
+            commands, stop_on_error)
+
     @classmethod
     def split_openssh_args(self, args):
         """
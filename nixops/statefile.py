@@ -6,6 +6,7 @@ import os.path
 from pysqlite2 import dbapi2 as sqlite3
 import sys
 import threading
+import time
 
 
 class Connection(sqlite3.Connection):
@@ -18,32 +19,79 @@ class Connection(sqlite3.Connection):
         self.db_file = db_file
         self.nesting = 0
         self.lock = threading.RLock()
+        self.pending_writes = []
+        self.rollback_hooks = []
 
     # Implement Python's context management protocol so that "with db"
-    # automatically commits or rolls back.  The difference with the
-    # parent's "with" implementation is that we nest, i.e. a commit or
-    # rollback is only done at the outer "with".
+    # automatically commits.  The difference with the parent's "with"
+    # implementation is that we nest, i.e. a commit is only done at the
+    # outer "with".
     def __enter__(self):
         self.lock.acquire()
         if self.nesting == 0:
-            self.must_rollback = False
+            self.rollback_hooks = []
         self.nesting = self.nesting + 1
         sqlite3.Connection.__enter__(self)
 
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
-        if exception_type != None: self.must_rollback = True
         self.nesting = self.nesting - 1
         assert self.nesting >= 0
-        if self.nesting == 0:
-            if self.must_rollback:
+        try:
+            if self.nesting == 0:
+                # Queued writes are flushed even if the block raised an
+                # exception (including KeyboardInterrupt): they record
+                # the state of resources that may already exist (like
+                # the ID of a newly created VM), which must not be lost.
                 try:
-                    self.rollback()
-                except sqlite3.ProgrammingError:
-                    pass
-            else:
-                sqlite3.Connection.__exit__(self, exception_type, exception_value, exception_traceback)
-        self.lock.release()
+                    self.flush_writes()
+                    sqlite3.Connection.__exit__(self, exception_type, exception_value, exception_traceback)
+                except:
+                    self._run_rollback_hooks()
+                    raise
+                self.rollback_hooks = []
+        finally:
+            self.lock.release()
+
+    def queue_write(self, sql, args):
+        """
+        Queue a statement that updates the state file.  Queued statements
+        are executed in a single transaction when the outermost "with"
+        block exits, whether or not it raised an exception, or
+        immediately if there is none.
+        """
+        with self:
+            self.pending_writes.append((sql, args))
+
+    def flush_writes(self):
+        """Execute all queued statements in a single transaction."""
+        with self.lock:
+            writes = self.pending_writes
+            self.pending_writes = []
+            if not writes: return
+            self.execute("begin")
+            try:
+                for (sql, args) in writes:
+                    self.execute(sql, args)
+            except:
+                self.execute("rollback")
+                raise
+            self.execute("commit")
+
+    def on_rollback(self, fun):
+        """
+        Call ‘fun’ if the queued statements of the current transaction
+        fail.  This is used to invalidate in-memory copies of the state
+        file.
+        """
+        assert self.nesting > 0
+        if fun not in self.rollback_hooks:
+            self.rollback_hooks.append(fun)
+
+    def _run_rollback_hooks(self):
+        hooks = self.rollback_hooks
+        self.rollback_hooks = []
+        for fun in hooks: fun()
 
 
 def get_default_state_file():
@@ -67,6 +115,7 @@ class StateFile(object):
 
     def __init__(self, db_file):
         self.db_file = db_file
+        self.load_timings = []
 
         if os.path.splitext(db_file)[1] not in ['.nixops', '.charon']:
             raise Exception("state file ‘{0}’ should have extension ‘.nixops’".format(db_file))
@@ -113,14 +162,47 @@ class StateFile(object):
         return [x[0] for x in res]
 
     def get_all_deployments(self):
-        """Return Deployment objects for every deployment in the database."""
-        uuids = self.query_deployments()
+        """
+        Return Deployment objects for every deployment in the database.
+        The state of all deployments is read with one query per table.
+        """
+        start = time.time()
+        with self._db:
+            self._db.flush_writes()
+            c = self._db.cursor()
+            c.execute("select uuid from Deployments")
+            uuids = [row[0] for row in c.fetchall()]
+            attrs = {uuid: {} for uuid in uuids}
+            resources = {uuid: [] for uuid in uuids}
+            resource_attrs = {}
+            c.execute("select deployment, name, value from DeploymentAttrs")
+            for (uuid, name, value) in c.fetchall():
+                attrs[uuid][name] = value
+            c.execute("select id, deployment, name, type from Resources")
+            for (id, uuid, name, type) in c.fetchall():
+                resources[uuid].append((id, name, type))
+                resource_attrs[id] = {}
+            c.execute("select machine, name, value from ResourceAttrs")
+            for (id, name, value) in c.fetchall():
+                resource_attrs[id][name] = value
+        queried = time.time()
+
         res = []
         for uuid in uuids:
+            preloaded = (attrs[uuid], resources[uuid],
+                         {id: resource_attrs[id] for (id, name, type) in resources[uuid]})
             try:
-                res.append(self.open_deployment(uuid=uuid))
+                res.append(nixops.deployment.Deployment(self, uuid, sys.stderr, preloaded=preloaded))
             except nixops.deployment.UnknownBackend as e:
                 sys.stderr.write("skipping deployment ‘{0}’: {1}\n".format(uuid, str(e)))
+        end = time.time()
+
+        # Keep the timing breakdown around for ‘--debug’ and profiling.
+        self.load_timings = [("query", queried - start), ("construct", end - queried)]
+        if nixops.deployment.debug:
+            sys.stderr.write("loaded {0} deployments with {1} resources in {2:.3f}s ({3})\n".format(
+                len(uuids), len(resource_attrs), end - start,
+                ", ".join(["{0} {1:.3f}s".format(phase, t) for (phase, t) in self.load_timings])))
         return res
 
     def _find_deployment(self, uuid=None):
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the steps of a deployment (evaluation, creating resources,
+building, copying and activating each machine, ...) as spans with a
+start and end time, optionally per machine.  Recording is off unless
+enable() has been called; when on, a span costs two calls to
+time.time() and a list append.  The spans can be summarised as a
+table or written in the Chrome trace format for a trace viewer
+(chrome://tracing, Perfetto).
+"""
+
+import json
+import time
+
+__all__ = ['enable', 'span', 'get_spans', 'summary', 'write_chrome_trace']
+
+
+_enabled = False
+_spans = []  # (name, machine, start, end, failed)
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    del _spans[:]
+
+
+class _Span(object):
+    __slots__ = ('name', 'machine', 'start')
+
+    def __init__(self, name, machine):
+        self.name = name
+        self.machine = machine
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # list.append() is atomic, so no lock is needed.
+        _spans.append((self.name, self.machine, self.start, time.time(), exc_type is not None))
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(name, machine=None):
+    """
+    Return a context manager that records the time spent in its block
+    as a span called ‘name’, for ‘machine’ (a machine name) or for the
+    deployment as a whole.
+    """
+    return _Span(name, machine) if _enabled else _no_span
+
+
+def get_spans():
+    """Return the recorded spans as (name, machine, start, end, failed) tuples, by start time."""
+    return sorted(_spans, key=lambda s: (s[2], -s[3]))
+
+
+def _top_level(spans):
+    """Return the spans that are not nested in another span of the same machine."""
+    res = []
+    ends = {}
+    for s in sorted(spans, key=lambda s: (s[2], -s[3])):
+        if s[3] <= ends.get(s[1], 0): continue
+        ends[s[1]] = s[3]
+        res.append(s)
+    return res
+
+
+def critical_path(spans):
+    """
+    Return the chain of spans that determined the total time, found
+    by starting from the span that ended last and repeatedly taking
+    the span that ended last before the current one started.  Only
+    top-level spans are considered.
+    """
+    spans = sorted(_top_level(spans), key=lambda s: s[3])
+    path = []
+    while spans:
+        cur = spans.pop()
+        path.append(cur)
+        spans = [s for s in spans if s[3] <= cur[2]]
+    path.reverse()
+    return path
+
+
+def _machine_name(machine):
+    return "‘{0}’".format(machine) if machine is not None else "(deployment)"
+
+
+def summary(spans=None, nr_slowest=5):
+    """Return a table with the time per step, the slowest machines and the critical path."""
+    if spans is None: spans = get_spans()
+    if not spans: return "no timing information was recorded\n"
+
+    start = min(s[2] for s in spans)
+    end = max(s[3] for s in spans)
+    lines = ["total time: {0:.1f}s".format(end - start), ""]
+
+    steps = {}
+    for (name, machine, s, e, failed) in spans:
+        step = steps.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'machine': None})
+        step['count'] += 1
+        step['total'] += e - s
+        if e - s >= step['max']:
+            step['max'] = e - s
+            step['machine'] = machine
+    lines.append("{0:<24} {1:>6} {2:>10} {3:>10}  {4}".format("step", "count", "total (s)", "max (s)", "slowest"))
+    for (name, step) in sorted(steps.iteritems(), key=lambda (n, st): -st['total']):
+        lines.append("{0:<24} {1:>6} {2:>10.1f} {3:>10.1f}  {4}".format(
+            name, step['count'], step['total'], step['max'], _machine_name(step['machine'])))
+
+    machines = {}
+    for (name, machine, s, e, failed) in _top_level(spans):
+        if machine is None: continue
+        m = machines.setdefault(machine, {'start': s, 'end': e, 'steps': {}})
+        m['start'] = min(m['start'], s)
+        m['end'] = max(m['end'], e)
+        m['steps'][name] = m['steps'].get(name, 0.0) + e - s
+    if machines:
+        lines += ["", "slowest machines:"]
+        slowest = sorted(machines.iteritems(), key=lambda (n, m): m['start'] - m['end'])[:nr_slowest]
+        for (machine, m) in slowest:
+            lines.append("  {0:<30} {1:>8.1f}s  ({2})".format(
+                _machine_name(machine), m['end'] - m['start'],
+                ", ".join("{0} {1:.1f}s".format(n, t) for (n, t) in sorted(m['steps'].iteritems(), key=lambda (n, t): -t))))
+
+    lines += ["", "critical path:"]
+    for (name, machine, s, e, failed) in critical_path(spans):
+        lines.append("  {0:>8.1f}s  {1:>8.1f}s  {2} {3}".format(s - start, e - s, name, _machine_name(machine)))
+
+    return "\n".join(lines) + "\n"
+
+
+def write_chrome_trace(path, spans=None):
+    """Write the spans to ‘path’ in the Chrome trace event format, with a row per machine."""
+    if spans is None: spans = get_spans()
+    start = min([s[2] for s in spans] or [0])
+    tids = {None: 0}
+    for m in sorted(set(s[1] for s in spans if s[1] is not None)):
+        tids[m] = len(tids)
+    events = [{'name': "thread_name", 'ph': "M", 'pid': 0, 'tid': tid,
+               'args': {'name': machine if machine is not None else "deployment"}}
+              for (machine, tid) in tids.iteritems()]
+    for (name, machine, s, e, failed) in spans:
+        events.append({'name': name, 'cat': "nixops", 'ph': "X", 'pid': 0, 'tid': tids[machine],
+                       'ts': int((s - start) * 1e6), 'dur': int((e - s) * 1e6),
+                       'args': {'machine': machine, 'failed': failed}})
+    with open(path, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, f)
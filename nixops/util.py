@@ -5,6 +5,7 @@ import sys
 import time
 import json
 import copy
+import errno
 import fcntl
 import base64
 import select
@@ -16,22 +17,23 @@ import subprocess
 import logging
 import atexit
 from StringIO import StringIO
+import nixops.wait
 
 devnull = open(os.devnull, 'rw')
 
 
-def check_wait(test, initial=10, factor=1, max_tries=60, exception=True):
-    """Call function ‘test’ periodically until it returns True or a timeout occurs."""
-    wait = initial
-    tries = 0
-    while tries < max_tries and not test():
-        wait = wait * factor
-        tries = tries + 1
-        if tries == max_tries:
-            if exception: raise Exception("operation timed out")
-            return False
-        time.sleep(wait)
-    return True
+def check_wait(test, initial=10, factor=1, max_tries=60, exception=True, category=None):
+    """
+    Call function ‘test’ periodically until it returns True or a timeout
+    occurs.  The timeout is the total time that sleeping ‘initial’
+    seconds, growing by ‘factor’, between ‘max_tries’ calls would take,
+    but the test is done more often at first, backing off to at most
+    ‘initial’ seconds (or the last of those sleeps) between calls.
+    """
+    sleeps = [initial * factor ** i for i in range(1, max_tries)]
+    return nixops.wait.wait_until(
+        test, initial=min(1, initial), factor=2, max_delay=max(sleeps + [initial]),
+        timeout=sum(sleeps), exception=exception, category=category)
 
 
 class CommandFailed(Exception):
@@ -68,65 +70,96 @@ def logged_exec(command, logger, check=True, capture_stdout=False, stdin=None,
         process = subprocess.Popen(command, env=env, stdin=stdin,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
-        fds = [process.stdout, process.stderr]
-        log_fd = process.stderr
+        log_fd = process.stderr.fileno()
     else:
         process = subprocess.Popen(command, env=env, stdin=stdin,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.STDOUT)
-        fds = [process.stdout]
-        log_fd = process.stdout
+        log_fd = process.stdout.fileno()
+    stdout_fd = process.stdout.fileno()
 
-    # FIXME: this can deadlock if stdin_string doesn't fit in the
-    # kernel pipe buffer.
+    poller = select.poll()
+    open_fds = set([stdout_fd, log_fd])
+    for fd in open_fds:
+        make_non_blocking(fd)
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    # Write stdin_string as the pipe accepts it, interleaved with
+    # reading the output, so that neither side can fill up its pipe
+    # and block forever.
+    stdin_fd = None
+    stdin_offset = 0
     if stdin_string is not None:
-        process.stdin.write(stdin_string)
-        process.stdin.close()
+        if isinstance(stdin_string, unicode): stdin_string = stdin_string.encode("utf-8")
+        stdin_fd = process.stdin.fileno()
+        make_non_blocking(stdin_fd)
+        poller.register(stdin_fd, select.POLLOUT)
 
-    for fd in fds:
-        make_non_blocking(fd)
+    def close_stdin():
+        poller.unregister(stdin_fd)
+        process.stdin.close()
+        return None
 
+    stdout = []
     at_new_line = True
-    stdout = ""
-
-    while len(fds) > 0:
-        # The timeout/poll is to deal with processes (like
-        # VBoxManage) that start children that go into the
-        # background but keep the parent's stdout/stderr open,
-        # preventing an EOF.  FIXME: Would be better to catch
-        # SIGCHLD.
-        (r, w, x) = select.select(fds, [], [], 1)
-        if len(r) == 0 and process.poll() is not None:
-            break
-        if capture_stdout and process.stdout in r:
-            data = process.stdout.read()
-            if data == "":
-                fds.remove(process.stdout)
-            else:
-                stdout += data
-        if log_fd in r:
-            data = log_fd.read()
+
+    # Some processes (like VBoxManage) start children that go into the
+    # background but keep the parent's stdout/stderr open, preventing
+    # an EOF.  So when there is no output, check whether the process
+    # has exited, at first often so that it is reaped right away, then
+    # backing off to once per second.  (A SIGCHLD handler can't be
+    # used, since it can only be set from the main thread.)
+    idle_timeout = 0.005
+
+    while open_fds or stdin_fd is not None:
+        events = poller.poll(idle_timeout * 1000)
+        if not events:
+            if process.poll() is not None: break
+            idle_timeout = min(idle_timeout * 2, 1)
+            continue
+        idle_timeout = 0.005
+
+        for (fd, event) in events:
+            if fd == stdin_fd:
+                if event & (select.POLLERR | select.POLLHUP):
+                    stdin_fd = close_stdin()
+                    continue
+                try:
+                    stdin_offset += os.write(fd, stdin_string[stdin_offset:stdin_offset + 65536])
+                except OSError as e:
+                    if e.errno == errno.EAGAIN: continue
+                    if e.errno != errno.EPIPE: raise
+                    stdin_offset = len(stdin_string)
+                if stdin_offset >= len(stdin_string):
+                    stdin_fd = close_stdin()
+                continue
+
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN: continue
+                raise
+
             if data == "":
-                if not at_new_line:
+                poller.unregister(fd)
+                open_fds.discard(fd)
+                if fd == log_fd and not at_new_line:
                     logger.log_end("")
-                fds.remove(log_fd)
-            else:
-                start = 0
-                while start < len(data):
-                    end = data.find('\n', start)
-                    if end == -1:
-                        logger.log_start(data[start:])
-                        at_new_line = False
+            elif fd == log_fd:
+                lines = data.split('\n')
+                for line in lines[:-1]:
+                    if at_new_line:
+                        logger.log(line)
                     else:
-                        s = data[start:end]
-                        if at_new_line:
-                            logger.log(s)
-                        else:
-                            logger.log_end(s)
-                        at_new_line = True
-                    if end == -1:
-                        break
-                    start = end + 1
+                        logger.log_end(line)
+                    at_new_line = True
+                if lines[-1] != "":
+                    logger.log_start(lines[-1])
+                    at_new_line = False
+            else:
+                stdout.append(data)
+
+    if stdin_fd is not None: close_stdin()
 
     res = process.wait()
 
@@ -134,7 +167,7 @@ def logged_exec(command, logger, check=True, capture_stdout=False, stdin=None,
         msg = "command ‘{0}’ failed on machine ‘{1}’"
         err = msg.format(command, logger.machine_name)
         raise CommandFailed(err, res)
-    return stdout if capture_stdout else res
+    return "".join(stdout) if capture_stdout else res
 
 
 def generate_random_string(length=256):
@@ -166,16 +199,18 @@ def ping_tcp_port(ip, port, timeout=1, ensure_timeout=False):
     return True
 
 
-def wait_for_tcp_port(ip, port, timeout=-1, open=True, callback=None):
-    """Wait until the specified TCP port is open or closed."""
-    n = 0
-    while True:
-        if ping_tcp_port(ip, port, ensure_timeout=True) == open: return True
-        if not open: time.sleep(1)
-        n = n + 1
-        if timeout != -1 and n >= timeout: break
-        if callback: callback()
-    raise Exception("timed out waiting for port {0} on ‘{1}’".format(port, ip))
+def wait_for_tcp_port(ip, port, timeout=-1, open=True, callback=None, category=None):
+    """
+    Wait until the specified TCP port is open or closed.  ‘timeout’ is
+    in seconds, or -1 to wait forever.
+    """
+    try:
+        nixops.wait.wait_for_tcp_ports(
+            [(ip, port)], open=open, timeout=None if timeout == -1 else timeout,
+            callback=callback, category=category)
+    except nixops.wait.WaitTimeout:
+        raise Exception("timed out waiting for port {0} on ‘{1}’".format(port, ip))
+    return True
 
 
 def ansi_highlight(s, outfile=sys.stderr):
@@ -208,6 +243,17 @@ def abs_nix_path(x):
 
 undefined = object()
 
+def state_file_value(x):
+    """
+    Return ‘x’ as it would be read back from the NixOps state file, where
+    attribute values are stored in text columns.  This is used to keep
+    the in-memory attribute caches identical to the state file.
+    """
+    if isinstance(x, bool): x = int(x)
+    if isinstance(x, unicode): return x
+    if isinstance(x, str): return x.decode("utf-8")
+    return unicode(x)
+
 def attr_property(name, default, type=str):
     """Define a property that corresponds to a value in the NixOps state file."""
     def get(self):
@@ -247,42 +293,50 @@ class SelfDeletingDir(str):
         shutil.rmtree(self)
 
 
-class TeeStderr(StringIO):
+class _Tee(StringIO):
+    """
+    Replaces a standard stream, passing everything written to it on to
+    the original stream and, line by line, to the ‘root’ logger (i.e.
+    syslog).  Partial lines are kept until they are complete, so that
+    each line is logged once rather than once per write.
+    """
+    def __init__(self, stream, log_fun):
+        StringIO.__init__(self)
+        self.stream = stream
+        self.log_fun = log_fun
+        self._partial = ""
+    def write(self, data):
+        self.stream.write(data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for l in lines:
+            self.log_fun(l)
+    def flush(self):
+        self.stream.flush()
+    def fileno(self):
+        return self.stream.fileno()
+    def isatty(self):
+        return self.stream.isatty()
+
+
+class TeeStderr(_Tee):
     stderr = None
     def __init__(self):
-        StringIO.__init__(self)
+        _Tee.__init__(self, sys.stderr, logging.getLogger('root').warning)
         self.stderr = sys.stderr
-        self.logger = logging.getLogger('root')
         sys.stderr = self
     def __del__(self):
         sys.stderr = self.stderr
-    def write(self, data):
-        self.stderr.write(data)
-        for l in data.split('\n'):
-            self.logger.warning(l)
-    def fileno(self):
-        return self.stderr.fileno()
-    def isatty(self):
-        return self.stderr.isatty()
 
 
-class TeeStdout(StringIO):
+class TeeStdout(_Tee):
     stdout = None
     def __init__(self):
-        StringIO.__init__(self)
+        _Tee.__init__(self, sys.stdout, logging.getLogger('root').info)
         self.stdout = sys.stdout
-        self.logger = logging.getLogger('root')
         sys.stdout = self
     def __del__(self):
         sys.stdout = self.stdout
-    def write(self, data):
-        self.stdout.write(data)
-        for l in data.split('\n'):
-            self.logger.info(l)
-    def fileno(self):
-        return self.stdout.fileno()
-    def isatty(self):
-        return self.stdout.isatty()
 
 
 # Borrowed from http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python.
@@ -315,6 +369,17 @@ def write_file(path, contents):
     f.close()
 
 
+def query_closure(paths):
+    """Return the closure of the given store paths in the local Nix store."""
+    if not paths: return []
+    return subprocess.check_output(["nix-store", "-qR"] + paths).splitlines()
+
+def query_path_sizes(paths):
+    """Return the NAR sizes of the given store paths in the local Nix store."""
+    if not paths: return {}
+    sizes = subprocess.check_output(["nix-store", "-q", "--size"] + paths).split()
+    return dict(zip(paths, map(int, sizes)))
+
 def xml_expr_to_python(node):
     if node.tag == "attrs":
         res = {}
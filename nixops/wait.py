@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Waiting for things to happen: polling with exponential backoff and
+deadlines, and waiting for TCP ports on many machines at once from a
+single thread.  The time spent waiting is accounted per category
+(typically the machine type), so that it can be reported.
+"""
+
+import errno
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+__all__ = ['WaitTimeout', 'Backoff', 'wait_until', 'TCPProbe', 'wait_for_tcp_ports', 'get_wait_times']
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+_wait_times = {}
+_wait_times_lock = threading.Lock()
+
+
+def record_wait(category, seconds):
+    """Add ‘seconds’ to the time spent waiting in ‘category’."""
+    if category is None: category = "other"
+    with _wait_times_lock:
+        _wait_times[category] = _wait_times.get(category, 0.0) + seconds
+
+
+def get_wait_times():
+    """Return a dictionary mapping categories to the seconds spent waiting."""
+    with _wait_times_lock:
+        return dict(_wait_times)
+
+
+def reset_wait_times():
+    with _wait_times_lock:
+        _wait_times.clear()
+
+
+class Backoff(object):
+    """
+    Exponentially growing delays between ‘initial’ and ‘max_delay’
+    seconds, each randomised by up to ‘jitter’ (as a fraction) so that
+    many waiters don't poll in lock step.  If ‘timeout’ is set, sleep()
+    raises WaitTimeout once that many seconds have passed.
+    """
+
+    def __init__(self, initial=1, factor=2, max_delay=30, jitter=0.2, timeout=None,
+                 category=None, message="operation timed out"):
+        self.delay = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self.category = category
+        self.message = message
+
+    def next_delay(self):
+        delay = min(self.delay, self.max_delay)
+        self.delay = delay * self.factor
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def sleep(self):
+        """Sleep for the next delay, but not past the deadline."""
+        if self.expired(): raise WaitTimeout(self.message)
+        delay = self.next_delay()
+        if self.deadline is not None: delay = min(delay, self.remaining())
+        if delay > 0:
+            time.sleep(delay)
+            record_wait(self.category, delay)
+
+
+def wait_until(test, initial=1, factor=2, max_delay=30, timeout=None, max_tries=None,
+               exception=True, category=None, message="operation timed out"):
+    """
+    Call function ‘test’ with exponential backoff until it returns True,
+    or until ‘timeout’ seconds or ‘max_tries’ calls have passed.  In the
+    latter case, raise WaitTimeout if ‘exception’ is set, and return
+    False otherwise.
+    """
+    backoff = Backoff(initial=initial, factor=factor, max_delay=max_delay, timeout=timeout,
+                      category=category, message=message)
+    tries = 0
+    while True:
+        if test(): return True
+        tries += 1
+        if (max_tries is not None and tries >= max_tries) or backoff.expired():
+            if exception: raise WaitTimeout(message)
+            return False
+        backoff.sleep()
+
+
+def _start_connect(host, port):
+    """
+    Start a non-blocking connection to ‘host’:‘port’.  Returns the
+    socket if the connection is in progress, True if it succeeded
+    immediately and False if it failed.
+    """
+    try:
+        addr = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+    except socket.error:
+        return False
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    s.setblocking(0)
+    err = s.connect_ex(addr)
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        return s
+    s.close()
+    return err == 0
+
+
+class TCPProbe(object):
+    """
+    Probes the TCP ports of any number of targets from a single thread,
+    using non-blocking connects and poll().  Each target goes through a
+    sequence of states, e.g. [False, True] to wait until a machine has
+    gone down and come back up while rebooting.  A port counts as
+    closed if the connection is refused or doesn't succeed within
+    ‘connect_timeout’ seconds.  Each target is probed with exponential
+    backoff between ‘initial’ and ‘max_delay’ seconds, which restarts
+    whenever the target reaches a state.
+
+    Targets can be added by other threads while run() is running.  To
+    keep run() from returning before they have been added, call hold()
+    beforehand and release() once for each hold.
+    """
+
+    def __init__(self, connect_timeout=1, initial=0.1, max_delay=2):
+        self.connect_timeout = connect_timeout
+        self.initial = initial
+        self.max_delay = max_delay
+        self._targets = []
+        self._lock = threading.Lock()
+        self._holds = 0
+
+    def hold(self, n=1):
+        """Keep run() going until release() has been called ‘n’ times."""
+        with self._lock:
+            self._holds += n
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+
+    def add(self, host, port, states=[True], on_change=None, category=None):
+        """
+        Add a target that must go through ‘states’ (True for open).
+        ‘on_change’ is called with the state each time the target
+        reaches the next one.
+        """
+        t = {'target': (host, port), 'states': list(states), 'on_change': on_change,
+             'category': category, 'due': 0,
+             'backoff': Backoff(initial=self.initial, max_delay=self.max_delay)}
+        with self._lock:
+            self._targets.append(t)
+
+    def _reached(self, t, is_open, now):
+        if is_open == t['states'][0]:
+            t['states'].pop(0)
+            t['backoff'] = Backoff(initial=self.initial, max_delay=self.max_delay)
+            if t['on_change']: t['on_change'](is_open)
+            t['due'] = now
+        else:
+            t['due'] = now + t['backoff'].next_delay()
+
+    def run(self, timeout=None, callback=None):
+        """
+        Probe until all targets have gone through their states.  Raises
+        WaitTimeout if that doesn't happen within ‘timeout’ seconds.
+        ‘callback’ is called about once per second while waiting.
+        """
+        start = time.time()
+        deadline = start + timeout if timeout is not None else None
+        in_progress = {}  # file descriptor -> (socket, target, connect deadline)
+        poller = select.poll()
+        last_callback = start
+
+        try:
+            while True:
+                now = time.time()
+                with self._lock:
+                    targets = list(self._targets)
+                    held = self._holds > 0
+                pending = [t for t in targets if t['states']]
+                if not pending and not held: break
+                if deadline is not None and now >= deadline:
+                    raise WaitTimeout("timed out waiting for {0}".format(
+                        ", ".join("port {1} on ‘{0}’".format(*t['target']) for t in pending)
+                        or "targets to be added"))
+
+                connecting = {id(t) for (s, t, d) in in_progress.itervalues()}
+                for t in pending:
+                    if t['due'] > now or id(t) in connecting: continue
+                    res = _start_connect(*t['target'])
+                    if isinstance(res, bool):
+                        self._reached(t, res, now)
+                    else:
+                        in_progress[res.fileno()] = (res, t, now + self.connect_timeout)
+                        poller.register(res, select.POLLOUT)
+
+                # Sleep until a connection completes or times out, or
+                # the next probe is due.
+                connecting = {id(t) for (s, t, d) in in_progress.itervalues()}
+                wake = [d for (s, t, d) in in_progress.itervalues()]
+                wake += [t['due'] for t in pending if id(t) not in connecting]
+                if deadline is not None: wake.append(deadline)
+                # Look for new targets now and then while held.
+                if held: wake.append(now + 0.1)
+                wait = max(0, min(wake) - time.time()) if wake else 0
+                events = poller.poll(wait * 1000)
+                now = time.time()
+
+                for (fd, event) in events:
+                    (s, t, d) = in_progress.pop(fd)
+                    poller.unregister(fd)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    s.close()
+                    self._reached(t, err == 0, now)
+
+                for (fd, (s, t, d)) in in_progress.items():
+                    if d <= now:
+                        del in_progress[fd]
+                        poller.unregister(fd)
+                        s.close()
+                        self._reached(t, False, now)
+
+                if callback and now - last_callback >= 1:
+                    last_callback = now
+                    callback()
+        finally:
+            for (s, t, d) in in_progress.itervalues():
+                s.close()
+            elapsed = time.time() - start
+            for category in {t['category'] for t in list(self._targets)}:
+                record_wait(category, elapsed)
+
+
+def wait_for_tcp_ports(targets, open=True, timeout=None, callback=None, category=None, **kwargs):
+    """
+    Wait until the TCP ports of all (host, port) pairs in ‘targets’ are
+    open (or closed, if ‘open’ is false), probing them with a TCPProbe.
+    The remaining keyword arguments are passed to TCPProbe.
+    """
+    probe = TCPProbe(**kwargs)
+    for (host, port) in targets:
+        probe.add(host, port, states=[open], category=category)
+    probe.run(timeout=timeout, callback=callback)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the compression work of copying a closure to N machines with
+‘nix-copy-closure --gzip’ (one compressed stream per machine) with
+exporting it once to a shared binary cache (‘--shared-binary-cache’).
+
+Usage: python tests/bench/binary_cache.py [--machines N] [STORE-PATH]
+
+Only the local side is measured, so no machines are needed.  The
+default store path is the closure of the ‘nix-store’ binary.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import nixops.util
+from nixops.binary_cache import LocalBinaryCache
+from nixops.logger import Logger
+
+
+def gzip_stream(closure):
+    """Run the pipeline that nix-copy-closure --gzip runs for one machine."""
+    export = subprocess.Popen(["nix-store", "--export"] + closure, stdout=subprocess.PIPE)
+    gzip = subprocess.Popen(["gzip"], stdin=export.stdout, stdout=subprocess.PIPE)
+    export.stdout.close()
+    size = 0
+    while True:
+        data = gzip.stdout.read(1 << 16)
+        if not data: break
+        size += len(data)
+    if gzip.wait() != 0 or export.wait() != 0:
+        raise Exception("nix-store --export failed")
+    return size
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, fn))
+               for (dirpath, dirnames, filenames) in os.walk(path) for fn in filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark closure compression")
+    parser.add_argument("--machines", type=int, default=10, metavar="N")
+    parser.add_argument("path", nargs="?")
+    args = parser.parse_args()
+
+    path = os.path.realpath(args.path or nixops.util.which("nix-store"))
+    if not path.startswith("/nix/store/"):
+        parser.error("‘{0}’ is not in the Nix store".format(path))
+    path = "/nix/store/" + path[len("/nix/store/"):].split("/")[0]
+    closure = nixops.util.query_closure([path])
+    nar_size = sum(nixops.util.query_path_sizes(closure).itervalues())
+    print "closure of {0}: {1} paths, {2:.1f} MiB".format(path, len(closure), nar_size / 1048576.0)
+
+    start = time.time()
+    gzip_size = gzip_stream(closure)
+    gzip_time = time.time() - start
+
+    tmpdir = tempfile.mkdtemp(prefix="nixops-bench-")
+    try:
+        cache = LocalBinaryCache(os.path.join(tmpdir, "cache"))
+        logger = Logger(open(os.devnull, "w"))
+        cache.get_public_key()
+        start = time.time()
+        cache.add_paths([path], logger.get_logger_for("cache"))
+        cold_time = time.time() - start
+        start = time.time()
+        cache.add_paths([path], logger.get_logger_for("cache"))
+        warm_time = time.time() - start
+        cache_size = dir_size(cache.cache_dir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    n = args.machines
+    print "{0:<40} {1:>10} {2:>12}".format("method", "time (s)", "output (MiB)")
+    print "{0:<40} {1:>10.1f} {2:>12.1f}".format(
+        "--gzip, {0} machines".format(n), gzip_time * n, gzip_size * n / 1048576.0)
+    print "{0:<40} {1:>10.1f} {2:>12.1f}".format(
+        "shared binary cache, cold", cold_time, cache_size / 1048576.0)
+    print "{0:<40} {1:>10.1f} {2:>12.1f}".format(
+        "shared binary cache, warm", warm_time, 0.0)
+
+
+if __name__ == "__main__":
+    main()
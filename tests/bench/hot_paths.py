@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how the pure-Python hot paths of a deployment scale with the
+number of machines: evaluating the network (parsing the XML output of
+nix-instantiate), computing the physical spec, nixmerge/py2nix,
+xml_expr_to_python, state file access through attr_property,
+run_tasks/Executor and logged_exec.
+
+Usage: python tests/bench/hot_paths.py [--sizes 10,100,1000] [--resources M]
+           [--only NAME,...] [--save-baseline] [--check]
+
+Each size is a synthetic deployment of N machines of type ‘none’ plus
+N × M SSH key pair resources.  A stub ‘nix-instantiate’ that prints
+the generated XML is put in $PATH, so everything runs offline and no
+Nix installation is needed.
+
+The results are compared with tests/bench/baseline.json (or the file
+given with --baseline); cases that got more than --threshold times
+slower are reported as regressions, and --check makes them fail the
+run.  The baseline is only meaningful on the machine where it was
+recorded, so record one with --save-baseline before making changes.
+A case whose time at the previous size predicts that it would take
+longer than --budget seconds is skipped.
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+import nixops.parallel
+import nixops.statefile
+import nixops.util
+from nixops.backends.none import NoneState
+from nixops.logger import Logger
+from nixops.nix_expr import py2nix, nixmerge_all
+
+
+MACHINE = """
+<attr name="{name}"><attrs>
+  <attr name="targetEnv"><string value="none" /></attr>
+  <attr name="targetHost"><string value="{name}.example.org" /></attr>
+  <attr name="targetPort"><int value="22" /></attr>
+  <attr name="nixosRelease"><string value="16.09" /></attr>
+  <attr name="storeKeysOnMachine"><bool value="false" /></attr>
+  <attr name="alwaysActivate"><bool value="true" /></attr>
+  <attr name="hasFastConnection"><bool value="false" /></attr>
+  <attr name="owners"><list /></attr>
+  <attr name="keys"><attrs>
+    <attr name="secret"><attrs><attr name="text"><string value="s3cr3t" /></attr></attrs></attr>
+  </attrs></attr>
+</attrs></attr>"""
+
+KEY_PAIR = """
+<attr name="{name}"><attrs><attr name="name"><string value="{name}" /></attr></attrs></attr>"""
+
+INFO = """<?xml version='1.0' encoding='utf-8'?>
+<expr><attrs>
+  <attr name="machines"><attrs>{machines}</attrs></attr>
+  <attr name="network"><attrs>
+    <attr name="description"><string value="Benchmark network" /></attr>
+    <attr name="enableRollback"><bool value="false" /></attr>
+  </attrs></attr>
+  <attr name="resources"><attrs>
+    <attr name="sshKeyPairs"><attrs>{key_pairs}</attrs></attr>
+  </attrs></attr>
+</attrs></expr>
+"""
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Times below this are too noisy to call a regression.
+MIN_TIME = 0.005
+
+
+class BenchState(NoneState):
+    """
+    A ‘none’ machine that also has a private address and a public host
+    key, like the machines of most other backends.
+    """
+    private_ipv4 = nixops.util.attr_property("privateIpv4", None)
+    public_host_key = nixops.util.attr_property("bench.publicHostKey", None)
+
+
+class Fixture(object):
+    """A state file with an evaluated and ‘deployed’ synthetic network of ‘n’ machines."""
+
+    def __init__(self, n, m):
+        self.n = n
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-bench-")
+
+        self.info = INFO.format(
+            machines="".join(MACHINE.format(name="machine-{0}".format(i)) for i in range(n)),
+            key_pairs="".join(KEY_PAIR.format(name="kp-{0}-{1}".format(i, j)) for i in range(n) for j in range(m)))
+        info_file = os.path.join(self.tmpdir, "info.xml")
+        with open(info_file, "w") as f: f.write(self.info)
+
+        bin_dir = os.path.join(self.tmpdir, "bin")
+        os.mkdir(bin_dir)
+        stub = os.path.join(bin_dir, "nix-instantiate")
+        with open(stub, "w") as f:
+            f.write("#! /bin/sh\nexec cat '{0}'\n".format(info_file))
+        os.chmod(stub, 0755)
+        self.old_path = os.environ.get("PATH", "")
+        os.environ["PATH"] = bin_dir + ":" + self.old_path
+
+        self.db_file = os.path.join(self.tmpdir, "bench.nixops")
+        self.sf = nixops.statefile.StateFile(self.db_file)
+        self.depl = self.sf.create_deployment()
+        self.depl.logger = Logger(open(os.devnull, "w"))
+        self.depl.eval_cache = None
+        self.depl.nix_exprs = [os.path.join(self.tmpdir, "network.nix")]
+        self.depl.evaluate()
+
+        with self.depl._db:
+            for (i, name) in enumerate(sorted(self.depl.definitions)):
+                r = self.depl._create_resource(name, self.depl.definitions[name].get_type())
+                if not isinstance(r, NoneState): continue
+                r.__class__ = BenchState
+                r.index = i
+                r.vm_id = "nixops-bench-{0}".format(i)
+                r.target_host = "{0}.example.org".format(name)
+                r.public_ipv4 = "10.{0}.{1}.{2}".format(i / 65536, i / 256 % 256, i % 256)
+                r.private_ipv4 = "172.{0}.{1}.{2}".format(16 + i / 65536, i / 256 % 256, i % 256)
+                r.public_host_key = "ssh-ed25519 HOSTKEY{0}".format(i)
+                r._ssh_public_key = "ssh-ed25519 CLIENTKEY{0}".format(i)
+                r.state_version = "16.09"
+
+        self.machines = sorted(self.depl.active.itervalues(), key=lambda m: m.index)
+
+    def close(self):
+        os.environ["PATH"] = self.old_path
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+
+def bench_evaluate(fx):
+    return fx.depl.evaluate
+
+
+def bench_xml_expr_to_python(fx):
+    root = ElementTree.fromstring(fx.info)
+    return lambda: nixops.util.xml_expr_to_python(root[0])
+
+
+def bench_get_physical_spec(fx):
+    return fx.depl.get_physical_spec
+
+
+def bench_physical_spec_parts(fx):
+    return fx.depl._get_physical_spec_parts
+
+
+def bench_nixmerge(fx):
+    (shared, parts) = fx.depl._get_physical_spec_parts()
+    return lambda: nixmerge_all(parts.values())
+
+
+def bench_py2nix(fx):
+    (shared, parts) = fx.depl._get_physical_spec_parts()
+    spec = nixmerge_all(parts.values())
+    return lambda: py2nix(spec)
+
+
+def bench_state_read(fx):
+    def f():
+        # A fresh state file, so nothing is cached yet.
+        sf = nixops.statefile.StateFile(fx.db_file)
+        try:
+            depl = sf.open_deployment(uuid=fx.depl.uuid)
+            for m in depl.active.itervalues():
+                (m.index, m.vm_id, m.target_host, m.public_ipv4, m.state_version)
+        finally:
+            sf.close()
+    return f
+
+
+def bench_state_write(fx):
+    def f():
+        with fx.depl._db:
+            for m in fx.machines:
+                m.state_version = "17.03" if m.state_version == "16.09" else "16.09"
+    return f
+
+
+def bench_run_tasks(fx):
+    return lambda: nixops.parallel.run_tasks(
+        nr_workers=nixops.parallel.DEFAULT_MAX_WORKERS, tasks=fx.machines, worker_fun=lambda m: m.name)
+
+
+def bench_executor(fx):
+    executor = nixops.parallel.Executor()
+    return lambda: executor.run(fx.machines, lambda m: m.name)
+
+
+def bench_logged_exec(fx):
+    logger = Logger(open(os.devnull, "w")).get_logger_for("bench")
+    # About 100 lines of output per machine, as from a build.
+    return lambda: nixops.util.logged_exec(["seq", str(fx.n * 100)], logger)
+
+
+BENCHMARKS = [
+    ("evaluate", bench_evaluate),
+    ("xml_expr_to_python", bench_xml_expr_to_python),
+    ("get_physical_spec", bench_get_physical_spec),
+    ("physical_spec_parts", bench_physical_spec_parts),
+    ("nixmerge", bench_nixmerge),
+    ("py2nix", bench_py2nix),
+    ("state_read", bench_state_read),
+    ("state_write", bench_state_write),
+    ("run_tasks", bench_run_tasks),
+    ("executor", bench_executor),
+    ("logged_exec", bench_logged_exec),
+]
+
+
+def best_of(runs, f):
+    times = []
+    for n in range(runs):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+        # Don't repeat slow cases, one run is accurate enough.
+        if times[-1] > 1: break
+    return min(times)
+
+
+def exponent(n1, t1, n2, t2):
+    """The k in t ~ n^k between two measurements."""
+    if not t1 or not t2 or t1 < MIN_TIME / 10: return None
+    return math.log(t2 / t1) / math.log(float(n2) / n1)
+
+
+def predict(results, name, sizes, n):
+    """Extrapolate the time of case ‘name’ at size ‘n’ from the previous sizes (at least linearly)."""
+    done = [(s, results[name][s]) for s in sizes if results[name].get(s) is not None]
+    if not done: return 0
+    (n2, t2) = done[-1]
+    k = 1
+    if len(done) >= 2:
+        k = max(k, exponent(done[-2][0], done[-2][1], n2, t2) or 1)
+    return t2 * (float(n) / n2) ** k
+
+
+def format_time(t):
+    return "{0:>10}".format("skipped" if t is None else "{0:.4f}".format(t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the NixOps hot paths")
+    parser.add_argument("--sizes", default="10,100,1000", metavar="N,...", help="numbers of machines")
+    parser.add_argument("--resources", type=int, default=1, metavar="M", help="SSH key pairs per machine")
+    parser.add_argument("--only", metavar="NAME,...", help="run only these cases")
+    parser.add_argument("--runs", type=int, default=3, metavar="N")
+    parser.add_argument("--budget", type=float, default=60, metavar="SECONDS",
+                        help="skip a case if it would take longer than this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, metavar="FILE")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--threshold", type=float, default=1.5, metavar="RATIO")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 if there are regressions")
+    args = parser.parse_args()
+
+    sizes = sorted(int(s) for s in args.sizes.split(","))
+    cases = BENCHMARKS
+    if args.only:
+        only = args.only.split(",")
+        unknown = set(only) - set(name for (name, f) in BENCHMARKS)
+        if unknown: parser.error("unknown case(s): {0}".format(", ".join(sorted(unknown))))
+        cases = [(name, f) for (name, f) in BENCHMARKS if name in only]
+
+    results = {name: {} for (name, f) in cases}
+    for n in sizes:
+        print >> sys.stderr, "setting up {0} machines...".format(n)
+        fx = Fixture(n, args.resources)
+        try:
+            for (name, setup) in cases:
+                if predict(results, name, sizes, n) > args.budget:
+                    results[name][n] = None
+                    continue
+                results[name][n] = best_of(args.runs, setup(fx))
+        finally:
+            fx.close()
+
+    print "{0} SSH key pair(s) per machine, best of {1} runs, times in seconds".format(args.resources, args.runs)
+    print "{0:<22}".format("case") + "".join("{0:>10}".format(n) for n in sizes) + "  scaling"
+    for (name, f) in cases:
+        ts = results[name]
+        ks = [exponent(n1, ts[n1], n2, ts[n2]) for (n1, n2) in zip(sizes, sizes[1:])]
+        print "{0:<22}".format(name) + "".join(format_time(ts[n]) for n in sizes) + "  " + \
+            " ".join("-" if k is None else "n^{0:.1f}".format(k) for k in ks)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f: baseline = json.load(f)
+        baseline["resources"] = args.resources
+        for (name, ts) in results.iteritems():
+            baseline.setdefault("results", {}).setdefault(name, {}).update(
+                {str(n): t for (n, t) in ts.iteritems()})
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, separators=(",", ": "), sort_keys=True)
+            f.write("\n")
+        print "baseline written to ‘{0}’".format(args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print "no baseline in ‘{0}’, run with --save-baseline to create one".format(args.baseline)
+        return
+    with open(args.baseline) as f: baseline = json.load(f)
+    if baseline.get("resources") != args.resources:
+        print "warning: the baseline was recorded with {0} SSH key pair(s) per machine".format(baseline.get("resources"))
+
+    regressions = []
+    for (name, f) in cases:
+        for n in sizes:
+            old = baseline.get("results", {}).get(name, {}).get(str(n))
+            new = results[name][n]
+            if old is None: continue
+            if new is None:
+                regressions.append("{0} at {1} machines: skipped, was {2:.4f}s".format(name, n, old))
+            elif new > MIN_TIME and new > old * args.threshold:
+                regressions.append("{0} at {1} machines: {2:.4f}s, was {3:.4f}s".format(name, n, new, old))
+
+    if regressions:
+        print "regressions compared to ‘{0}’:".format(args.baseline)
+        for r in regressions: print "  " + r
+        if args.check: sys.exit(1)
+    else:
+        print "no regressions compared to ‘{0}’".format(args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of nixops.util.logged_exec for commands with
+large outputs (like ‘nix-store -qR’ of a big closure) and large
+stdin_string inputs, compared to plain subprocess.communicate().
+
+Usage: python tests/bench/logged_exec.py [--mib N] [--runs N]
+"""
+
+import argparse
+import os
+import subprocess
+import time
+
+import nixops.util
+from nixops.logger import Logger
+
+
+def output_command(size):
+    """A command printing ‘size’ bytes of store-path-like lines."""
+    line = "/nix/store/" + "x" * 32 + "-some-package-1.0\n"
+    return ["sh", "-c", "yes {0} | head -c {1}".format(line.strip(), size)]
+
+
+def best_of(runs, f):
+    times = []
+    for n in range(runs):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark logged_exec")
+    parser.add_argument("--mib", type=int, default=64, metavar="N")
+    parser.add_argument("--runs", type=int, default=3, metavar="N")
+    args = parser.parse_args()
+
+    size = args.mib * 1048576
+    logger = Logger(open(os.devnull, "w")).get_logger_for("bench")
+    command = output_command(size)
+    stdin_data = "x" * 79 + "\n"
+    stdin_data = stdin_data * (size / len(stdin_data))
+
+    def communicate(**kwargs):
+        p = subprocess.Popen(command if not kwargs else ["cat"], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.communicate(**kwargs)
+
+    cases = [
+        ("subprocess.communicate, capture", lambda: communicate()),
+        ("logged_exec, capture", lambda: nixops.util.logged_exec(command, logger, capture_stdout=True)),
+        ("logged_exec, log lines", lambda: nixops.util.logged_exec(command, logger)),
+        ("subprocess.communicate, stdin + capture", lambda: communicate(input=stdin_data)),
+        ("logged_exec, stdin_string + capture",
+         lambda: nixops.util.logged_exec(["cat"], logger, capture_stdout=True, stdin_string=stdin_data)),
+    ]
+
+    print "{0} MiB, best of {1} runs".format(args.mib, args.runs)
+    print "{0:<45} {1:>10} {2:>10}".format("case", "time (s)", "MiB/s")
+    for (name, f) in cases:
+        t = best_of(args.runs, f)
+        print "{0:<45} {1:>10.2f} {2:>10.1f}".format(name, t, args.mib / t)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from nixops.binary_cache import LocalBinaryCache
+
+
+class LocalBinaryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.cache = LocalBinaryCache(os.path.join(self.tmpdir, "cache"))
+        os.makedirs(os.path.join(self.tmpdir, "cache", "nar"))
+        with open(os.path.join(self.tmpdir, "cache", "nar", "x.nar.xz"), "w") as f:
+            f.write("nar")
+        with open(os.path.join(self.tmpdir, "secret"), "w") as f:
+            f.write("secret")
+
+    def tearDown(self):
+        self.cache.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_serve(self):
+        port = self.cache.serve()
+        url = "http://127.0.0.1:{0}/".format(port)
+        self.assertEqual(urllib2.urlopen(url + "nar/x.nar.xz").read(), "nar")
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + "nix-cache-info")
+        # Files outside of the cache are not accessible.
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + "../secret")
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + "nar/%2e%2e/%2e%2e/secret")
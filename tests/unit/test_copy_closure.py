@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.statefile
+import nixops.util
+
+
+class FakeSSH(object):
+    def __init__(self, valid):
+        self.valid = valid
+        self.queries = []
+
+    opts = []
+
+    def _get_flags(self):
+        return []
+
+    def _get_target(self):
+        return "root@machine"
+
+    def get_master(self):
+        return self
+
+    def run_command(self, command, stdin, capture_stdout):
+        paths = stdin.read().splitlines()
+        self.queries.append(paths)
+        return "".join(p + "\n" for p in paths if p not in self.valid)
+
+
+class CopyClosureTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tmpdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+        self.m = self.depl._create_resource("machine", "none")
+        self.m.has_fast_connection = True
+
+        # A fake local store: each path is a file in ‘tmpdir’.
+        self.refs = {}
+        self.copied = []
+        self.m._logged_exec = lambda command, env: self.copied.extend(command[3:])
+
+        self.orig = (nixops.util.query_closure, nixops.util.query_path_sizes)
+        nixops.util.query_closure = self.closure
+        nixops.util.query_path_sizes = lambda paths: {p: 1024 for p in paths}
+
+    def tearDown(self):
+        (nixops.util.query_closure, nixops.util.query_path_sizes) = self.orig
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def add_path(self, name, refs=[]):
+        path = os.path.join(self.tmpdir, name)
+        open(path, "w").close()
+        self.refs[path] = [os.path.join(self.tmpdir, r) for r in refs]
+        return path
+
+    def closure(self, paths):
+        res = set()
+        todo = list(paths)
+        while todo:
+            p = todo.pop()
+            if p in res: continue
+            res.add(p)
+            todo.extend(self.refs[p])
+        return sorted(res)
+
+    def copy(self, path, ssh):
+        self.copied = []
+        self.m.get_ssh_for_copy_closure = lambda: ssh
+        self.m.copy_closure_to(path)
+
+    def test_delta(self):
+        glibc = self.add_path("glibc")
+        foo = self.add_path("foo", ["glibc"])
+        sys1 = self.add_path("system-1", ["foo", "glibc"])
+        ssh = FakeSSH(valid=set([glibc]))
+        self.copy(sys1, ssh)
+        self.assertEqual(ssh.queries, [sorted([glibc, foo, sys1])])
+        self.assertEqual(sorted(self.copied), sorted([foo, sys1]))
+        self.assertEqual(self.m.valid_roots, [sys1])
+
+        # The second time, only the paths that are not in the closure
+        # of ‘system-1’ are checked (as well as ‘system-1’ itself).
+        bar = self.add_path("bar", ["glibc"])
+        sys2 = self.add_path("system-2", ["bar", "foo", "glibc"])
+        ssh.valid |= set([foo, sys1])
+        self.copy(sys2, ssh)
+        self.assertEqual(ssh.queries[-1], sorted([bar, sys1, sys2]))
+        self.assertEqual(sorted(self.copied), sorted([bar, sys2]))
+        self.assertEqual(self.m.valid_roots, [sys2, sys1])
+
+        # Nothing is copied if everything is present.
+        ssh.valid |= set([bar, sys2])
+        self.copy(sys2, ssh)
+        self.assertEqual(self.copied, [])
+
+    def test_garbage_collected(self):
+        glibc = self.add_path("glibc")
+        sys1 = self.add_path("system-1", ["glibc"])
+        sys2 = self.add_path("system-2", ["glibc"])
+        self.m.valid_roots = [sys1]
+
+        # ‘system-1’ has been garbage-collected on the machine, so all
+        # paths have to be checked.
+        ssh = FakeSSH(valid=set())
+        self.copy(sys2, ssh)
+        self.assertEqual(ssh.queries, [sorted([sys1, sys2]), sorted([glibc, sys2])])
+        self.assertEqual(sorted(self.copied), sorted([glibc, sys2]))
+        self.assertEqual(self.m.valid_roots, [sys2])
+
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tmpdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+        self.commands = []
+        self.copies = []
+        for name in ["a", "b", "c", "d"]:
+            m = self.depl._create_resource(name, "none")
+            m.new_toplevel = "/nix/store/system"
+            m.run_command = lambda command, m=m, **kwargs: self.commands.append((m.name, command))
+            m._query_missing_paths = lambda ssh, paths: set(paths)
+            m.copy_closure_to = lambda path, m=m: self.copied(m, None, ["/nix/store/system"])
+            m.copy_paths_from = lambda source, paths, key_file, m=m: self.copied(m, source, paths)
+            m.address_to = lambda r: "10.0.0.1"
+
+        self.orig = (nixops.util.query_closure, nixops.util.query_path_sizes, nixops.util.create_key_pair)
+        nixops.util.query_closure = lambda paths: ["/nix/store/glibc", "/nix/store/system"]
+        nixops.util.query_path_sizes = lambda paths: {p: 1024 for p in paths}
+        nixops.util.create_key_pair = lambda key_name: ("private", "ssh-ed25519 AAAA " + key_name)
+
+    def tearDown(self):
+        (nixops.util.query_closure, nixops.util.query_path_sizes, nixops.util.create_key_pair) = self.orig
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def copied(self, m, source, paths):
+        if source:
+            self.copies.append((source.name, m.name))
+            return
+        if m.name not in [t for (s, t) in self.copies]:
+            self.copies.append((None, m.name))
+            return (len(paths), 1024 * len(paths))
+        return (0, 0)
+
+    def test_fan_out(self):
+        machines = sorted(self.depl.active.values(), key=lambda m: m.name)
+        plan = self.depl._copy_closures_fan_out(machines, fan_out=2, max_concurrent_copy=1)
+
+        # At least one machine is copied to from the local machine, and
+        # every machine receives its closure once.
+        self.assertEqual(sorted(t for (s, t) in self.copies), ["a", "b", "c", "d"])
+        self.assertIn(None, [s for (s, t) in self.copies])
+        for (s, t) in self.copies:
+            self.assertEqual(plan[t][0], s)
+            if s: self.assertEqual(plan[t][1:5], (2, 2048, 0, 0))
+            else: self.assertEqual(plan[t][1:5], (0, 0, 1, 1024))
+
+        # The temporary key is installed and removed on every machine.
+        for name in ["a", "b", "c", "d"]:
+            commands = [c for (n, c) in self.commands if n == name]
+            self.assertIn("authorized_keys", commands[0])
+            self.assertIn("rm -f /root/.ssh/id_nixops_fan_out-" + self.depl.uuid, commands[-1])
+            self.assertIn("flock", commands[-1])
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+from StringIO import StringIO
+
+import nixops.deployment
+import nixops.trace
+
+from tests.unit.test_evaluate import EvaluateTestCase, INFO, MACHINE
+
+
+class PipelineTest(EvaluateTestCase):
+    def setUp(self):
+        EvaluateTestCase.setUp(self)
+        machines = "".join(MACHINE.format(name=n, port=22) for n in ["a", "b"])
+        self.depl._parse_info(StringIO(INFO.format(machines=machines)))
+        for defn in self.depl.definitions.itervalues():
+            self.depl._create_resource(defn.name, defn.get_type())
+        self.events = []
+        self.a_activated = threading.Event()
+
+        self.depl._prepare_build = lambda selected: "physical.nix"
+        self.depl._build_machine_config = self.build
+        self.depl._activate_config = self.activate
+        self.depl._build_configs_path = self.build_configs_path
+        self.fail_build = None
+        for m in self.depl.active.itervalues():
+            m.copy_closure_to = lambda path, m=m: self.events.append(("copy", m.name))
+
+    def build_configs_path(self, selected, phys_expr, prebuilt):
+        self.combined = sorted(m.name for m in selected)
+        return "/nix/store/configs"
+
+    def build(self, m, phys_expr, key, repair=False):
+        # ‘b’ can only finish building after ‘a’ has been activated,
+        # so this deadlocks (and times out) if there are barriers.
+        if m.name == "b": self.assertTrue(self.a_activated.wait(10))
+        if m.name == self.fail_build: raise Exception("build failed")
+        self.events.append(("build", m.name))
+        return "/nix/store/" + m.name
+
+    def activate(self, m, configs_path, **kwargs):
+        if m.name == "b" and self.fail_b: raise Exception("oops")
+        self.events.append(("activate", m.name))
+        if m.name == "a": self.a_activated.set()
+        return True
+
+    def deploy(self):
+        self.depl._deploy_pipelined(
+            include=[], exclude=[], incremental=False, repair=False, copy_only=False,
+            max_concurrent_build=2, max_concurrent_copy=1, max_concurrent_activate=-1,
+            allow_reboot=False, force_reboot=False, sync=True, always_activate=False,
+            dry_activate=False)
+
+    def test_pipeline(self):
+        self.fail_b = False
+        self.deploy()
+        self.assertLess(self.events.index(("activate", "a")), self.events.index(("build", "b")))
+        self.assertEqual(self.events[-1], ("activate", "b"))
+        for m in self.depl.active.itervalues():
+            self.assertEqual(m.new_toplevel, "/nix/store/" + m.name)
+            self.assertEqual(m.cur_configs_path, "/nix/store/configs")
+        self.assertEqual(self.depl.configs_path, "/nix/store/configs")
+
+    def test_trace(self):
+        # Use the real _build_machine_config(), which records the
+        # ‘build’ span, with nix-build stubbed out.
+        self.fail_b = False
+        del self.depl._build_machine_config
+        self.a_activated.set()
+        orig = nixops.deployment.subprocess.check_output
+        nixops.deployment.subprocess.check_output = lambda cmd, **kwargs: "/nix/store/machines"
+        nixops.trace.reset()
+        nixops.trace.enable()
+        try:
+            self.deploy()
+        finally:
+            nixops.trace.enable(False)
+            nixops.deployment.subprocess.check_output = orig
+        # Each stage is recorded once per machine.
+        self.assertEqual(sorted((s[0], s[1]) for s in nixops.trace.get_spans()),
+                         [(stage, m) for stage in ["activate", "build", "copy"] for m in ["a", "b"]])
+        nixops.trace.reset()
+
+    def test_failed_activation(self):
+        self.fail_b = True
+        with self.assertRaises(Exception) as cm:
+            self.deploy()
+        self.assertIn("‘b’", str(cm.exception))
+        self.assertEqual(self.depl.resources["a"].cur_configs_path, "/nix/store/configs")
+        self.assertEqual(self.depl.resources["b"].cur_configs_path, None)
+        self.assertIn("activate on ‘b’", str(cm.exception))
+
+    def test_failed_build(self):
+        # ‘a’ is already running its new configuration when the build
+        # of ‘b’ fails, so that must be recorded.
+        self.fail_b = False
+        self.fail_build = "b"
+        with self.assertRaises(Exception) as cm:
+            self.deploy()
+        self.assertEqual(str(cm.exception), "build failed")
+        self.assertEqual(self.combined, ["a"])
+        self.assertEqual(self.depl.resources["a"].cur_configs_path, "/nix/store/configs")
+        self.assertEqual(self.depl.resources["b"].cur_configs_path, None)
+        self.assertEqual(self.depl.configs_path, "/nix/store/configs")
+
+
+class IncrementalBuildTest(EvaluateTestCase):
+    def test_built_fun_limit(self):
+        machines = "".join(MACHINE.format(name=n, port=22) for n in ["a", "b", "c", "d"])
+        self.depl._parse_info(StringIO(INFO.format(machines=machines)))
+        for defn in self.depl.definitions.itervalues():
+            self.depl._create_resource(defn.name, defn.get_type())
+        self.depl._get_build_keys = lambda selected: {}
+        all_built = threading.Event()
+        built = []
+        running = []
+        lock = threading.Lock()
+
+        def build(m, phys_expr, key, dry_run=False):
+            with lock:
+                built.append(m.name)
+                if len(built) == 4: all_built.set()
+            return "/nix/store/" + m.name
+
+        def built_fun(m, toplevel):
+            # The builds don't wait for this step.
+            self.assertTrue(all_built.wait(10))
+            with lock: running.append(m.name)
+            self.assertEqual(len(running), 1)
+            with lock: running.remove(m.name)
+
+        self.depl._build_machine_config = build
+        res = self.depl._build_changed_configs(
+            self.depl.active.values(), "physical.nix", False, built_fun,
+            max_concurrent_build=4, max_concurrent_built_fun=1)
+        self.assertEqual(res, {n: "/nix/store/" + n for n in ["a", "b", "c", "d"]})
+
+
+class RebootTest(EvaluateTestCase):
+    def setUp(self):
+        EvaluateTestCase.setUp(self)
+        machines = "".join(MACHINE.format(name=n, port=22) for n in ["a", "b"])
+        self.depl._parse_info(StringIO(INFO.format(machines=machines)))
+        self.listeners = {}
+        self.rebooted = []
+        for defn in self.depl.definitions.itervalues():
+            m = self.depl._create_resource(defn.name, defn.get_type())
+            self.listen(m.name, 0)
+            m.ssh_port = self.listeners[m.name].getsockname()[1]
+            m.get_ssh_name = lambda: "127.0.0.1"
+            m.reboot = lambda hard, m=m: self.reboot(m)
+            m._rebooted = lambda m=m: self.rebooted.append(m.name)
+        self.orig_timeout = nixops.deployment.REBOOT_TIMEOUT
+        nixops.deployment.REBOOT_TIMEOUT = 10
+
+    def tearDown(self):
+        nixops.deployment.REBOOT_TIMEOUT = self.orig_timeout
+        for l in self.listeners.itervalues(): l.close()
+        EvaluateTestCase.tearDown(self)
+
+    def listen(self, name, port):
+        l = socket.socket()
+        l.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        l.bind(("127.0.0.1", port))
+        l.listen(5)
+        self.listeners[name] = l
+
+    def reboot(self, m):
+        # ‘a’ comes back up quickly, while ‘b’ is still being told
+        # to reboot.
+        if m.name == "b": time.sleep(1)
+        self.listeners[m.name].close()
+        timer = threading.Timer(0.3, self.listen, (m.name, m.ssh_port))
+        timer.start()
+
+    def test_fast_reboot(self):
+        self.depl.reboot_machines(wait=True)
+        self.assertEqual(sorted(self.rebooted), ["a", "b"])
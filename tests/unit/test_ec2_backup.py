@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import nixops.statefile
+import nixops.backends
+import nixops.parallel
+from nixops.ec2_utils import create_tags_batched, EC2ResponseError
+
+
+class Snapshot(object):
+    def __init__(self, id, progress):
+        self.id = id
+        self.progress = progress
+
+
+class Definition(object):
+    tags = {'owner': "me"}
+
+
+class FakeEC2(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.tags = {}
+        self.calls = []
+        self.order = []
+
+    def create_snapshot(self, volume_id):
+        with self.lock:
+            self.calls.append("create_snapshot")
+            self.order.append(volume_id)
+            s = Snapshot("snap-" + volume_id, "0%")
+            self.snapshots[s.id] = s
+            return s
+
+    def create_tags(self, ids, tags):
+        with self.lock:
+            self.calls.append("create_tags")
+            for id in ids: self.tags.setdefault(id, {}).update(tags)
+
+    def get_all_snapshots(self, snapshot_ids, filters=None):
+        self.calls.append("describe_snapshots")
+        if any(id not in self.snapshots for id in snapshot_ids or []):
+            e = EC2ResponseError.__new__(EC2ResponseError)
+            e.error_code = "InvalidSnapshot.NotFound"
+            raise e
+        return [self.snapshots[id] for id in snapshot_ids or filters["snapshot-id"] if id in self.snapshots]
+
+
+class CreateTagsBatchedTest(unittest.TestCase):
+    def test_grouping(self):
+        conn = FakeEC2()
+        tags = {"a": {'x': "1", 'dev': "sda"}, "b": {'x': "1", 'dev': "sdb"}, "c": {'x': "1", 'dev': "sda"}}
+        self.assertEqual(create_tags_batched(conn, tags), 3)
+        self.assertEqual(conn.tags, tags)
+        self.assertEqual(create_tags_batched(conn, {str(n): {'x': "1"} for n in range(2500)}), 3)
+
+
+class BackupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tmpdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+        self.conn = FakeEC2()
+        self.machines = []
+        for n in range(3):
+            m = self.depl._create_resource("m{0}".format(n), "ec2")
+            m.region = "eu-west-1"
+            m.access_key_id = "key"
+            m.block_device_mapping = {d: {'volumeId': "vol-{0}{1}".format(n, d[-1])} for d in ["/dev/sda", "/dev/sdb"]}
+            m._conn = self.conn
+            m.sync_disks = lambda m=m: self.conn.order.append(m.name)
+            self.machines.append(m)
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_backup_and_status(self):
+        nixops.backends.backup_machines([(m, Definition()) for m in self.machines], "b1",
+                                        nixops.parallel.Executor(key_fun=lambda t: None))
+        self.assertEqual(self.conn.calls.count("create_snapshot"), 6)
+        # Each machine is synced right before its own snapshots.
+        for (n, m) in enumerate(self.machines):
+            self.assertLess(self.conn.order.index(m.name), self.conn.order.index("vol-{0}a".format(n)))
+        # Common tags, one call per machine, one per device and one
+        # per snapshot for its name.
+        self.assertEqual(self.conn.calls.count("create_tags"), 12)
+        self.assertEqual(self.machines[1].backups, {"b1": {"/dev/sda": "snap-vol-1a", "/dev/sdb": "snap-vol-1b"}})
+        tags = self.conn.tags["snap-vol-1b"]
+        self.assertEqual(tags['owner'], "me")
+        self.assertEqual(tags['CharonMachineName'], "m1")
+        self.assertEqual(tags['CharonDevice'], "/dev/sdb")
+        self.assertEqual(tags['Name'], "{0} - b1 [m1 - /dev/sdb]".format(self.depl.description))
+
+        self.conn.snapshots["snap-vol-0a"].progress = "100%"
+        self.conn.snapshots["snap-vol-0b"].progress = "100%"
+        del self.conn.snapshots["snap-vol-2a"]
+        self.conn.calls = []
+        nixops.backends.prefetch_backups(self.machines)
+        backups = [m.get_backups()["b1"] for m in self.machines]
+        self.assertEqual(self.conn.calls, ["describe_snapshots"] * 2)
+        self.assertEqual([b['status'] for b in backups], ["complete", "running", "unavailable"])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.statefile
+import nixops.backends
+import nixops.ec2_utils
+from nixops.ec2_utils import describe_by_ids, EC2ResponseError
+
+
+def not_found(code):
+    e = EC2ResponseError.__new__(EC2ResponseError)
+    e.error_code = code
+    return e
+
+
+class Obj(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeEC2(object):
+    def __init__(self, instances, volumes):
+        self.instances = instances
+        self.volumes = volumes
+        self.calls = []
+
+    def _describe(self, name, existing, ids, filters, code, filter_name):
+        self.calls.append(name)
+        if ids is None:
+            ids = filters[filter_name]
+        elif any(id not in existing for id in ids):
+            raise not_found(code)
+        return [Obj(id) for id in ids if id in existing]
+
+    def get_only_instances(self, instance_ids, filters=None):
+        return self._describe("instances", self.instances, instance_ids, filters,
+                              "InvalidInstanceID.NotFound", "instance-id")
+
+    def get_all_instance_status(self, instance_ids, filters=None):
+        return self._describe("status", self.instances, instance_ids, filters,
+                              "InvalidInstanceID.NotFound", None)
+
+    def get_all_volumes(self, volume_ids, filters=None):
+        return self._describe("volumes", self.volumes, volume_ids, filters,
+                              "InvalidVolume.NotFound", "volume-id")
+
+
+class DescribeByIdsTest(unittest.TestCase):
+    def test_batches(self):
+        conn = FakeEC2(["i-{0}".format(n) for n in range(2500)], [])
+        res = describe_by_ids(lambda ids, filters=None: conn.get_only_instances(ids, filters),
+                              ["i-{0}".format(n) for n in range(2500)], "InvalidInstanceID.NotFound")
+        self.assertEqual(len(res), 2500)
+        self.assertEqual(conn.calls, ["instances"] * 3)
+
+    def test_missing_ids(self):
+        conn = FakeEC2(["i-1", "i-3"], [])
+        describe = lambda ids, filters=None: conn.get_only_instances(ids, filters)
+        res = describe_by_ids(describe, ["i-1", "i-2", "i-3"], "InvalidInstanceID.NotFound",
+                              id_filter="instance-id")
+        self.assertEqual(sorted(res.keys()), ["i-1", "i-3"])
+        self.assertEqual(conn.calls, ["instances"] * 2)
+        conn.calls = []
+        res = describe_by_ids(describe, ["i-1", "i-2", "i-3"], "InvalidInstanceID.NotFound")
+        self.assertEqual(sorted(res.keys()), ["i-1", "i-3"])
+        self.assertEqual(conn.calls, ["instances"] * 4)
+
+
+class PrefetchCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tmpdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_prefetch(self):
+        conn = FakeEC2(["i-{0}".format(n) for n in range(1, 50)], ["vol-1"])
+        machines = []
+        for n in range(50):
+            m = self.depl._create_resource("m{0}".format(n), "ec2")
+            m.vm_id = "i-{0}".format(n)
+            m.region = "eu-west-1"
+            m.access_key_id = "key"
+            m.block_device_mapping = {"/dev/xvdf": {"volumeId": "vol-{0}".format(n)}}
+            m._conn = conn
+            machines.append(m)
+        nixops.backends.prefetch_check(machines)
+        self.assertEqual(conn.calls.count("instances"), 2)
+        self.assertEqual(conn.calls.count("volumes"), 2)
+        self.assertEqual(conn.calls.count("status"), 1)
+        self.assertEqual(machines[0]._cached_instance, None)
+        self.assertEqual(machines[1]._cached_instance.id, "i-1")
+        self.assertEqual(machines[1]._prefetched['volumes']["vol-1"].id, "vol-1")
+        self.assertEqual(machines[2]._prefetched['volumes'], {"vol-2": None})
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import nixops.ec2_utils
+
+
+class ConnectionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.env = dict(os.environ)
+        os.environ["HOME"] = self.tmpdir
+        os.environ["AWS_SHARED_CREDENTIALS_FILE"] = os.path.join(self.tmpdir, "credentials")
+        with open(os.path.join(self.tmpdir, ".ec2-keys"), "w") as f:
+            f.write("key1 secret1\nkey2 secret2\n")
+        nixops.ec2_utils.clear_connection_cache()
+        self.connects = []
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        nixops.ec2_utils.clear_connection_cache()
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self, **kwargs):
+        self.connects.append(kwargs)
+        return object()
+
+    def test_reuse(self):
+        stats = nixops.ec2_utils.get_connection_stats()
+        get = nixops.ec2_utils.get_connection
+        conns = []
+        def worker():
+            for n in range(10):
+                conns.append(get("sqs", "eu-west-1", "key1", self.connect))
+        threads = [threading.Thread(target=worker) for n in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(len(set(conns)), 1)
+        self.assertEqual(self.connects, [{'region_name': "eu-west-1", 'aws_access_key_id': "key1",
+                                          'aws_secret_access_key': "secret1"}])
+
+        self.assertNotEqual(get("sqs", "us-east-1", "key1", self.connect), conns[0])
+        self.assertNotEqual(get("sqs", "eu-west-1", "key2", self.connect), conns[0])
+        get("iam", None, "key2", self.connect)
+        self.assertEqual(self.connects[-1], {'aws_access_key_id': "key2", 'aws_secret_access_key': "secret2"})
+
+        new_stats = nixops.ec2_utils.get_connection_stats()
+        self.assertEqual(new_stats['created'] - stats['created'], 4)
+        self.assertEqual(new_stats['reused'] - stats['reused'], 39)
+
+    def test_credentials_cached(self):
+        self.assertEqual(nixops.ec2_utils.fetch_aws_secret_key("key1"), ("key1", "secret1"))
+        os.remove(os.path.join(self.tmpdir, ".ec2-keys"))
+        self.assertEqual(nixops.ec2_utils.fetch_aws_secret_key("key1"), ("key1", "secret1"))
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nixops.eval_cache import EvalCache, Uncacheable
+
+
+class EvalCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.cache = EvalCache(os.path.join(self.tmpdir, "cache"))
+        self.src = os.path.join(self.tmpdir, "src")
+        os.mkdir(self.src)
+        self.write("network.nix", "{ }")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.src, name), "w") as f:
+            f.write(contents)
+
+    def key(self, command=["nix-instantiate"]):
+        return self.cache.compute_key(command, [self.src])
+
+    def test_hit_and_miss(self):
+        key = self.key()
+        self.assertEqual(self.cache.get("d/info", key), None)
+        self.cache.put("d/info", key, "<expr/>\n")
+        self.assertEqual(self.cache.get("d/info", key), "<expr/>\n")
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'uncacheable': 0})
+
+    def test_put_file(self):
+        key = self.key()
+        out = os.path.join(self.tmpdir, "out.xml")
+        with open(out, "w") as f: f.write("<expr/>\n")
+        self.cache.put_file("d/info", key, out)
+        with self.cache.open("d/info", key) as f:
+            self.assertEqual(f.read(), "<expr/>\n")
+        self.assertEqual(self.cache.open("d/info", "other"), None)
+
+    def test_inputs_change_key(self):
+        key = self.key()
+        self.assertNotEqual(self.key(["nix-instantiate", "--arg", "x", "1"]), key)
+        self.write("machine.nix", "{ }")
+        key2 = self.key()
+        self.assertNotEqual(key2, key)
+        self.write("machine.nix", "{ x = 1; }")
+        self.assertNotEqual(self.key(), key2)
+
+    def test_uncacheable(self):
+        self.assertRaises(Uncacheable, self.cache.compute_key, [],
+                          ["https://example.org/nixpkgs.tar.gz"])
+
+    def test_same_size_and_mtime(self):
+        path = os.path.join(self.src, "network.nix")
+        st = os.stat(path)
+        key = self.key()
+        self.write("network.nix", "{a}")
+        os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertEqual(os.stat(path).st_size, st.st_size)
+        self.assertNotEqual(self.key(), key)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import nixops.statefile
+import nixops.util
+from nixops.backends.none import NoneState
+
+
+MACHINE = """
+<attr name="{name}"><attrs>
+  <attr name="targetEnv"><string value="none" /></attr>
+  <attr name="targetHost"><string value="{name}.example.org" /></attr>
+  <attr name="targetPort"><int value="{port}" /></attr>
+  <attr name="nixosRelease"><string value="16.09" /></attr>
+  <attr name="storeKeysOnMachine"><bool value="false" /></attr>
+  <attr name="alwaysActivate"><bool value="true" /></attr>
+  <attr name="hasFastConnection"><bool value="false" /></attr>
+  <attr name="owners"><list /></attr>
+  <attr name="keys"><attrs>
+    <attr name="secret"><attrs><attr name="text"><string value="s3cr3t" /></attr></attrs></attr>
+  </attrs></attr>
+</attrs></attr>
+"""
+
+INFO = """<?xml version='1.0' encoding='utf-8'?>
+<expr><attrs>
+  <attr name="machines"><attrs>{machines}</attrs></attr>
+  <attr name="network"><attrs>
+    <attr name="description"><string value="Test network" /></attr>
+    <attr name="enableRollback"><bool value="true" /></attr>
+  </attrs></attr>
+  <attr name="resources"><attrs>
+    <attr name="sshKeyPairs"><attrs>
+      <attr name="kp"><attrs><attr name="name"><string value="kp" /></attr></attrs></attr>
+    </attrs></attr>
+  </attrs></attr>
+</attrs></expr>
+"""
+
+
+class EvaluateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tmpdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+        self.depl.definitions = {}
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+
+class ParseInfoTest(EvaluateTestCase):
+    def test_parse_info(self):
+        machines = "".join(MACHINE.format(name=n, port=22) for n in ["a", "b"])
+        network = self.depl._parse_info(StringIO(INFO.format(machines=machines)))
+        self.assertEqual(network, {"description": "Test network", "enableRollback": True})
+        self.assertEqual(sorted(self.depl.definitions.keys()), ["a", "b", "kp"])
+        a = self.depl.definitions["a"]
+        self.assertEqual(a.get_type(), "none")
+        self.assertEqual(a._target_host, "a.example.org")
+        self.assertEqual(a.ssh_port, 22)
+        self.assertTrue(a.always_activate)
+        self.assertEqual(a.keys, {"secret": {"text": "s3cr3t"}})
+        self.assertEqual(a.config["keys"], {"secret": {"text": "s3cr3t"}})
+        self.assertEqual(self.depl.definitions["kp"].get_type(), "ssh-keypair")
+
+
+class BuildKeyTest(EvaluateTestCase):
+    def evaluate(self, ports):
+        self.depl.definitions = {}
+        machines = "".join(MACHINE.format(name=n, port=p) for (n, p) in sorted(ports.items()))
+        self.depl._parse_info(StringIO(INFO.format(machines=machines)))
+        for defn in self.depl.definitions.itervalues():
+            if defn.name not in self.depl.resources:
+                self.depl._create_resource(defn.name, defn.get_type())
+        return self.depl._get_build_keys(self.depl.active.values())
+
+    def test_build_keys(self):
+        self.depl._eval_inputs = lambda: [self.tmpdir + "/network.nix"]
+        keys = self.evaluate({"a": 22, "b": 22})
+        self.assertEqual(sorted(keys.keys()), ["a", "b"])
+        self.assertNotEqual(keys["a"], keys["b"])
+        self.assertEqual(self.evaluate({"a": 22, "b": 22}), keys)
+
+        # A change to the definition of ‘a’ only affects ‘a’.
+        keys2 = self.evaluate({"a": 2222, "b": 22})
+        self.assertNotEqual(keys2["a"], keys["a"])
+        self.assertEqual(keys2["b"], keys["b"])
+
+        # A change to the physical spec of ‘a’ affects all machines,
+        # since ‘b’ may refer to it through ‘nodes.a’.
+        self.depl.resources["a"].state_version = "16.03"
+        keys3 = self.evaluate({"a": 2222, "b": 22})
+        self.assertNotEqual(keys3["a"], keys2["a"])
+        self.assertNotEqual(keys3["b"], keys2["b"])
+
+        # A change to the network expressions affects all machines.
+        with open(self.tmpdir + "/network.nix", "w") as f: f.write("{ }")
+        keys4 = self.evaluate({"a": 2222, "b": 22})
+        self.assertNotEqual(keys4["a"], keys3["a"])
+        self.assertNotEqual(keys4["b"], keys3["b"])
+
+
+class HostKeyState(NoneState):
+    public_host_key = nixops.util.attr_property("test.publicHostKey", None)
+
+
+class PhysicalSpecTest(EvaluateTestCase):
+    def setUp(self):
+        EvaluateTestCase.setUp(self)
+        machines = "".join(MACHINE.format(name=n, port=22) for n in ["a", "b", "c"])
+        self.depl._parse_info(StringIO(INFO.format(machines=machines)))
+        with self.depl._db:
+            for (i, name) in enumerate(sorted(self.depl.definitions)):
+                r = self.depl._create_resource(name, self.depl.definitions[name].get_type())
+                if name == "kp": continue
+                r.__class__ = HostKeyState
+                r.index = i
+                r.public_ipv4 = "10.0.0.{0}".format(i)
+                r.public_host_key = "ssh-ed25519 KEY-" + name
+
+    def flatten(self):
+        """Return the extraHosts lines and the knownHosts of each machine, with the shared modules imported."""
+        (shared, parts) = self.depl._get_physical_spec_parts()
+        res = {}
+        for name in ["a", "b", "c"]:
+            module = parts[name][name].body
+            configs = [module['config']] + [shared[i.value].body for i in module['imports'][:-1]]
+            lines = []
+            known_hosts = {}
+            for config in configs:
+                lines += config.get(('networking', 'extraHosts'), "").splitlines()
+                known_hosts.update(config.get(('services', 'openssh', 'knownHosts'), {}))
+            res[name] = (sorted(lines), sorted(known_hosts))
+        return (shared, res)
+
+    def test_shared_modules(self):
+        (shared, res) = self.flatten()
+        self.assertEqual(sorted(shared), ["nixopsHosts0", "nixopsKnownHosts"])
+        for name in ["a", "b", "c"]:
+            self.assertEqual(res[name], (
+                ["10.0.0.0 a a-unencrypted", "10.0.0.1 b b-unencrypted", "10.0.0.2 c c-unencrypted",
+                 "127.0.0.1 {0}-encrypted".format(name)],
+                ["a", "b", "c"]))
+        spec = self.depl.get_physical_spec()
+        self.assertTrue(spec.startswith("let\n  nixopsHosts0 = { config, lib, pkgs, ... }: {\n"))
+        self.assertEqual(spec.count("KEY-a"), 1)
+        self.assertIn("imports = [ nixopsKnownHosts nixopsHosts0 {} ];", spec)
+
+    def test_address_collision(self):
+        # An address that is also in a machine's own entries ends up
+        # on the same line, so the machine doesn't use the shared
+        # hosts module.
+        self.depl.resources["c"].public_ipv4 = "127.0.0.1"
+        (shared, res) = self.flatten()
+        self.assertEqual(sorted(shared), ["nixopsKnownHosts"])
+        self.assertEqual(res["a"][0], ["10.0.0.0 a a-unencrypted", "10.0.0.1 b b-unencrypted",
+                                       "127.0.0.1 c c-unencrypted a-encrypted"])
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.known_hosts as known_hosts
+
+
+class KnownHostsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.home = os.environ.get("HOME")
+        os.environ["HOME"] = self.tmpdir
+        os.mkdir(os.path.join(self.tmpdir, ".ssh"))
+        self.path = os.path.join(self.tmpdir, ".ssh", "known_hosts")
+        self.write("# comment line\n1.2.3.4,host ssh-ed25519 KEY1\n5.6.7.8 ssh-ed25519 KEY2\n")
+
+    def tearDown(self):
+        os.environ["HOME"] = self.home
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, s):
+        with open(self.path, "w") as f: f.write(s)
+
+    def read(self):
+        with open(self.path) as f: return f.read()
+
+    def test_add_remove(self):
+        known_hosts.add("5.6.7.8", "ssh-ed25519 KEY3")
+        known_hosts.remove("1.2.3.4", "ssh-ed25519 OTHER")
+        known_hosts.remove("1.2.3.4", None)
+        self.assertEqual(self.read(), "# comment line\nhost ssh-ed25519 KEY1\n5.6.7.8 ssh-ed25519 KEY3\n")
+
+    def test_update(self):
+        known_hosts.update("5.6.7.8", "9.9.9.9", "ssh-ed25519 KEY2")
+        self.assertEqual(self.read(), "# comment line\n1.2.3.4,host ssh-ed25519 KEY1\n9.9.9.9 ssh-ed25519 KEY2\n")
+
+    def test_batch(self):
+        before = self.read()
+        with known_hosts.batch():
+            for n in range(100):
+                known_hosts.update("10.0.0.{0}".format(n), "10.0.1.{0}".format(n), "ssh-ed25519 K{0}".format(n))
+            known_hosts.remove("1.2.3.4", "ssh-ed25519 KEY1")
+            self.assertEqual(self.read(), before)
+        lines = self.read().splitlines()
+        self.assertEqual(lines[:3], ["# comment line", "host ssh-ed25519 KEY1", "5.6.7.8 ssh-ed25519 KEY2"])
+        self.assertEqual(len(lines), 103)
+        self.assertEqual(lines[-1], "10.0.1.99 ssh-ed25519 K99")
+
+    def test_matches_sequential_rewrites(self):
+        lines = ["a,b k1", "b,c k2", "c k1", "d k3"]
+        changes = [("b", False, "k2"), ("c", True, "k4"), ("a", False, None), ("d", False, "k9")]
+        self.assertEqual(known_hosts._apply(lines, changes), ["b k1", "d k3", "c k4"])
@@ -0,0 +1,47 @@
+import time
+import unittest
+
+from nixops.util import logged_exec, CommandFailed
+
+
+class FakeLogger(object):
+    machine_name = "machine"
+
+    def __init__(self):
+        self.lines = []
+        self.partial = None
+
+    def log(self, msg):
+        self.lines.append(msg)
+
+    def log_start(self, msg):
+        self.partial = (self.partial or "") + msg
+
+    def log_end(self, msg):
+        self.lines.append((self.partial or "") + msg)
+        self.partial = None
+
+
+class LoggedExecTest(unittest.TestCase):
+    def test_log_lines(self):
+        logger = FakeLogger()
+        res = logged_exec(["sh", "-c", "echo one; printf 'tw'; sleep 0.1; printf 'o\\nthree'"], logger)
+        self.assertEqual(res, 0)
+        self.assertEqual(logger.lines, ["one", "two", "three"])
+
+    def test_capture_and_large_stdin(self):
+        data = "".join("line {0}\n".format(n) for n in range(200000))
+        logger = FakeLogger()
+        out = logged_exec(["sh", "-c", "cat; echo done >&2"], logger, capture_stdout=True, stdin_string=data)
+        self.assertEqual(out, data)
+        self.assertEqual(logger.lines, ["done"])
+
+    def test_failure(self):
+        self.assertRaises(CommandFailed, logged_exec, ["false"], FakeLogger())
+        self.assertEqual(logged_exec(["sh", "-c", "exit 3"], FakeLogger(), check=False), 3)
+
+    def test_background_child_keeps_output_open(self):
+        start = time.time()
+        out = logged_exec(["sh", "-c", "sleep 3 & echo hi"], FakeLogger(), capture_stdout=True)
+        self.assertEqual(out, "hi\n")
+        self.assertTrue(time.time() - start < 2)
@@ -1,7 +1,10 @@
+import json
+import threading
 import unittest
 
 from StringIO import StringIO
 
+import nixops.logger
 from nixops.logger import Logger
 
 class RootLoggerTest(unittest.TestCase):
@@ -65,3 +68,65 @@ class MachineLoggerTest(RootLoggerTest):
                         "machine1> .\nmachine2> .\nmachine1> .\nmachine2> .\n"
                         "machine1> .\nmachine2> .\nmachine1> .\nmachine2> .\n"
                         "machine1> end 1.\nmachine2> end 2.\n")
+
+class AsyncLoggerTest(MachineLoggerTest):
+    def setUp(self):
+        self.logfile = StringIO()
+        self.jsonfile = StringIO()
+        self.root_logger = Logger(self.logfile, asynchronous=True, json_file=self.jsonfile)
+        self.m1_logger = self.root_logger.get_logger_for("machine1")
+        self.m2_logger = self.root_logger.get_logger_for("machine2")
+
+    def assert_log(self, value):
+        self.root_logger.flush()
+        MachineLoggerTest.assert_log(self, value)
+
+    def test_json(self):
+        self.m1_logger.phase = "copy"
+        self.m1_logger.log_start("copying...")
+        self.m2_logger.log("hello")
+        self.m1_logger.log_end("done")
+        self.root_logger.log("finished")
+        self.root_logger.flush()
+        events = [json.loads(l) for l in self.jsonfile.getvalue().splitlines()]
+        self.assertEqual([(e['machine'], e['phase'], e['message']) for e in events],
+                         [("machine2", None, "hello"), ("machine1", "copy", "copying...done"),
+                          (None, None, "finished")])
+
+    def test_threads(self):
+        loggers = [self.root_logger.get_logger_for("m{0}".format(n)) for n in range(8)]
+        def worker(l):
+            for n in range(200): l.log("line {0}".format(n))
+        threads = [threading.Thread(target=worker, args=(l,)) for l in loggers]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.root_logger.flush()
+        lines = self.logfile.getvalue().splitlines()
+        self.assertEqual(len(lines), 1600)
+        self.assertEqual([l for l in lines if l.startswith("m3")][-1], "m3......> line 199")
+
+    def test_log_file_flushes(self):
+        self.m1_logger.log("before")
+        self.root_logger.log_file.write("subprocess output\n")
+        self.assert_log("machine1> before\nsubprocess output\n")
+
+    def test_after_stop(self):
+        self.m1_logger.log("before")
+        try:
+            nixops.logger._stop_all()
+            self.m2_logger.log("after")
+            self.assertEqual(self.logfile.getvalue(), "machine1> before\nmachine2> after\n")
+            self.assertIsNone(self.root_logger._writer)
+        finally:
+            nixops.logger._exiting = False
+
+    def test_flush_dead_writer(self):
+        self.m1_logger.log("before")
+        self.root_logger._stop_writer()
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        self.root_logger._writer = dead
+        self.m2_logger.log("after")
+        self.assert_log("machine1> before\nmachine2> after\n")
+        self.assertIsNone(self.root_logger._writer)
@@ -2,7 +2,7 @@ import unittest
 
 from textwrap import dedent
 
-from nixops.nix_expr import py2nix, nix2py, nixmerge
+from nixops.nix_expr import py2nix, nix2py, nixmerge, nixmerge_all
 from nixops.nix_expr import RawValue, Function, Call
 
 __all__ = ['Py2NixTest', 'Nix2PyTest', 'NixMergeTest']
@@ -287,6 +287,8 @@ class Nix2PyTest(unittest.TestCase):
 class NixMergeTest(unittest.TestCase):
     def assert_merge(self, sources, expect):
         self.assertEqual(reduce(nixmerge, sources), expect)
+        if all(isinstance(s, dict) for s in sources):
+            self.assertEqual(nixmerge_all(sources), expect)
 
     def test_merge_list(self):
         self.assert_merge([
@@ -317,6 +319,13 @@ class NixMergeTest(unittest.TestCase):
             'e': 'f',
         })
 
+    def test_merge_all_copies(self):
+        sources = [{'a': {'b': 1}}, {'a': {'c': 2}}, {'a': {'d': {'e': 3}}}, {'a': {'d': {'f': 4}}}]
+        self.assertEqual(nixmerge_all(sources), {'a': {'b': 1, 'c': 2, 'd': {'e': 3, 'f': 4}}})
+        self.assertEqual(sources[0], {'a': {'b': 1}})
+        self.assertEqual(sources[2], {'a': {'d': {'e': 3}}})
+        self.assertEqual(nixmerge_all([]), {})
+
     def test_unhashable(self):
         self.assertRaises(TypeError, nixmerge, [[1]], [[2]])
         self.assertRaises(TypeError, nixmerge, [{'x': 1}], [{'y': 2}])
@@ -0,0 +1,133 @@
+import threading
+import time
+import unittest
+
+import nixops.parallel
+from nixops.parallel import run_dag, DependencyCycle, Executor, TokenBucket, MultipleExceptions
+
+
+class RunDAGTest(unittest.TestCase):
+    def run_graph(self, graph, nr_workers=-1, **kwargs):
+        order = self.order = []
+        lock = threading.Lock()
+        def worker(t):
+            with lock: order.append(t)
+            time.sleep(0.01)
+            if t.startswith("fail"): raise Exception(t)
+            return t.upper()
+        res = run_dag(nr_workers, sorted(graph.keys()), lambda t: graph[t],
+                      worker, **kwargs)
+        return (order, res)
+
+    def test_order(self):
+        graph = {"a": [], "b": ["a"], "c": ["a", "b"], "d": []}
+        (order, res) = self.run_graph(graph, nr_workers=2)
+        self.assertEqual(res, {"a": "A", "b": "B", "c": "C", "d": "D"})
+        self.assertTrue(order.index("a") < order.index("b") < order.index("c"))
+
+    def test_cycle(self):
+        graph = {"a": ["c"], "b": ["a"], "c": ["b"], "d": []}
+        self.assertRaises(DependencyCycle, self.run_graph, graph)
+
+    def test_failure_skips_dependents(self):
+        graph = {"fail": [], "b": ["fail"], "c": ["b"], "d": []}
+        try:
+            self.run_graph(graph)
+            self.fail("expected an exception")
+        except Exception as e:
+            self.assertEqual(str(e), "fail")
+        self.assertEqual(sorted(self.order), ["d", "fail"])
+
+    def test_limits(self):
+        active = {"n": 0, "max": 0}
+        lock = threading.Lock()
+        def worker(t):
+            with lock:
+                active["n"] += 1
+                active["max"] = max(active["max"], active["n"])
+            time.sleep(0.01)
+            with lock: active["n"] -= 1
+        timings = {}
+        run_dag(-1, range(10), lambda t: [], worker,
+                key_fun=lambda t: "x", limits={"x": 3}, timings=timings)
+        self.assertEqual(active["max"], 3)
+        self.assertEqual(sorted(timings.keys()), range(10))
+
+
+class ExecutorTest(unittest.TestCase):
+    def test_results_in_task_order(self):
+        timings = {}
+        res = Executor(nr_workers=3).run(range(10), lambda t: time.sleep(0.001 * (10 - t)) or t * 2,
+                                         timings=timings)
+        self.assertEqual(res, [t * 2 for t in range(10)])
+        self.assertEqual(sorted(timings.keys()), range(10))
+
+    def test_bounded_workers(self):
+        active = {"n": 0, "max": 0}
+        lock = threading.Lock()
+        def worker(t):
+            with lock:
+                active["n"] += 1
+                active["max"] = max(active["max"], active["n"])
+            time.sleep(0.01)
+            with lock: active["n"] -= 1
+        Executor(nr_workers=4).run(range(20), worker)
+        self.assertEqual(active["max"], 4)
+
+    def test_errors(self):
+        def worker(t):
+            if t % 2: raise Exception("fail {0}".format(t))
+        self.assertRaises(MultipleExceptions, Executor().run, range(4), worker)
+
+    def test_fail_fast(self):
+        started = []
+        def worker(t):
+            started.append(t)
+            if t == 0: raise Exception("fail")
+            time.sleep(0.01)
+        self.assertRaises(Exception, Executor(nr_workers=1, fail_fast=True).run, range(10), worker)
+        self.assertEqual(started, [0])
+
+    def test_stream_close_cancels(self):
+        started = []
+        def worker(t):
+            started.append(t)
+            time.sleep(0.01)
+        stream = Executor(nr_workers=1).stream(range(10), worker)
+        next(stream)
+        stream.close()
+        time.sleep(0.05)
+        self.assertTrue(len(started) <= 2)
+
+    def test_rate_limit(self):
+        executor = Executor(nr_workers=-1, key_fun=lambda t: ("prov", t % 2),
+                            rate_limits={"prov": (100, 1)})
+        start = time.time()
+        executor.run(range(10), lambda t: None)
+        # 5 tasks per key at 100/s with a burst of 1 take at least 40 ms.
+        self.assertTrue(time.time() - start >= 0.04)
+
+    def test_rate_limited(self):
+        orig = nixops.parallel.RATE_LIMITS
+        nixops.parallel.RATE_LIMITS = {"prov": (100, 1)}
+        try:
+            calls = []
+            call = nixops.parallel.rate_limited(calls.append, ("prov", "test_rate_limited"))
+            uncapped = nixops.parallel.rate_limited(calls.append, ("other", 1))
+            start = time.time()
+            for n in range(50): uncapped(n)
+            self.assertTrue(time.time() - start < 0.04)
+            for n in range(5): call(n)
+            # The calls share one bucket, at 100/s with a burst of 1.
+            self.assertTrue(time.time() - start >= 0.04)
+            self.assertEqual(len(calls), 55)
+        finally:
+            nixops.parallel.RATE_LIMITS = orig
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000, burst=5)
+        start = time.time()
+        for n in range(5): bucket.acquire()
+        self.assertTrue(time.time() - start < 0.004)
+        for n in range(20): bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.019)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import nixops.statefile
+
+
+class SendKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.sf = nixops.statefile.StateFile(os.path.join(self.tmpdir, "test.nixops"))
+        self.depl = self.sf.create_deployment()
+        self.m = self.depl._create_resource("machine", "none")
+        self.m.store_keys_on_machine = False
+        key = {'user': "root", 'group': "root", 'permissions': "0600"}
+        self.m.keys = {"old": dict(key, text="same"), "new": dict(key, text="changed")}
+        self.commands = []
+        self.m.run_command = self.run_command
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_command(self, command, stdin):
+        data = stdin.read()
+        if data:
+            stdin.seek(0)
+            with tarfile.open(fileobj=stdin) as tar:
+                data = {i.name: tar.extractfile(i).read() for i in tar}
+        self.commands.append((command, data))
+
+    def test_only_changed_keys_are_sent(self):
+        remote = "{0}  old\n{0}  new\n".format(hashlib.sha256("same").hexdigest())
+        self.m.send_keys(prepared=[(0, ""), (0, remote)])
+        [(script, data)] = self.commands
+        self.assertEqual(data, {"new": "changed"})
+        self.assertIn("mv -f \"$t\"/'new' '/run/keys/new'", script)
+        self.assertNotIn("'old' '/run/keys/old'", script)
+        self.assertIn("chmod '0600' '/run/keys/old'", script)
+        self.assertTrue(script.endswith("touch /run/keys/done"))
+
+    def test_nothing_changed(self):
+        remote = "".join("{0}  {1}\n".format(hashlib.sha256(v).hexdigest(), k)
+                         for (k, v) in [("old", "same"), ("new", "changed")])
+        self.m.send_keys(prepared=[(0, ""), (0, remote)])
+        [(script, data)] = self.commands
+        self.assertEqual(data, "")
+        self.assertNotIn("tar", script)
@@ -0,0 +1,23 @@
+import subprocess
+import unittest
+
+from nixops.ssh_util import run_batch, SSHCommandFailed
+
+
+def run_locally(script):
+    return subprocess.check_output(["bash", "-c", script])
+
+
+class RunBatchTest(unittest.TestCase):
+    def test_outputs_and_statuses(self):
+        res = run_batch(run_locally, ["echo foo; echo bar", "printf 'no newline'",
+                                      "exit 3", "printf '\\nnixops-batch-x 0 0\\n'"])
+        self.assertEqual(res, [(0, "foo\nbar\n"), (0, "no newline"), (3, ""),
+                               (0, "\nnixops-batch-x 0 0\n")])
+
+    def test_stop_on_error(self):
+        res = run_batch(run_locally, ["true", "exit 111", "echo never"], stop_on_error=True)
+        self.assertEqual(res, [(0, ""), (111, ""), None])
+
+    def test_incomplete_output(self):
+        self.assertRaises(SSHCommandFailed, run_batch, lambda script: "", ["true"])
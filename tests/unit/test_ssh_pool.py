@@ -0,0 +1,57 @@
+import unittest
+
+from nixops.ssh_util import SSHMasterPool
+
+
+class FakeMaster(object):
+    def __init__(self, reused=False):
+        self.reused = reused
+        self.stopped = False
+        self.exited = False
+
+    def is_alive(self):
+        return not (self.stopped or self.exited)
+
+    def stop(self):
+        self.stopped = True
+
+    def shutdown(self):
+        self.exited = True
+
+
+class SSHMasterPoolTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        pool = SSHMasterPool()
+        pool.configure(max_masters=2)
+        (a, b, c) = masters = [FakeMaster(), FakeMaster(), FakeMaster(reused=True)]
+        pool.add(a, 0.5)
+        pool.add(b, 1.5)
+        pool.touch(a)
+        pool.add(c, 0)
+        self.assertEqual([m.stopped for m in masters], [False, True, False])
+        self.assertFalse(any(m.exited for m in masters))
+        self.assertEqual(pool.stats(), {'started': 2, 'reused': 1, 'evicted': 1,
+                                        'mean_setup_time': 1.0, 'max_setup_time': 1.5})
+
+    def test_no_limit(self):
+        pool = SSHMasterPool()
+        masters = [FakeMaster() for n in range(10)]
+        for m in masters: pool.add(m, 0.1)
+        self.assertFalse(any(m.stopped for m in masters))
+
+    def test_control_socket(self):
+        pool = SSHMasterPool()
+        self.assertEqual(pool.get_control_socket("root@host", []), None)
+        pool.persist_dir = "/run/nixops"
+        path = pool.get_control_socket("root@host", ["-p", "22"])
+        self.assertTrue(path.startswith("/run/nixops/"))
+        self.assertEqual(pool.get_control_socket("root@host", ["-p", "22"]), path)
+        self.assertNotEqual(pool.get_control_socket("root@other", ["-p", "22"]), path)
+
+    def test_control_socket_host_id(self):
+        pool = SSHMasterPool()
+        pool.persist_dir = "/run/nixops"
+        path = pool.get_control_socket("root@host", [], "i-1")
+        self.assertEqual(pool.get_control_socket("root@host", [], "i-1"), path)
+        self.assertNotEqual(pool.get_control_socket("root@host", [], "i-2"), path)
+        self.assertNotEqual(pool.get_control_socket("root@host", []), path)
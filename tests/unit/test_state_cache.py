@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.statefile
+
+
+class AttrCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        self.db_file = os.path.join(self.tmpdir, "test.nixops")
+        self.sf = nixops.statefile.StateFile(self.db_file)
+        self.depl = self.sf.create_deployment()
+
+    def tearDown(self):
+        self.sf.close()
+        shutil.rmtree(self.tmpdir)
+
+    def reopen(self):
+        sf = nixops.statefile.StateFile(self.db_file)
+        self.addCleanup(sf.close)
+        return sf.open_deployment(uuid=self.depl.uuid)
+
+    def test_deployment_attrs(self):
+        self.depl.name = "foo"
+        self.depl.args = {"x": "1"}
+        self.depl.rollback_enabled = True
+        depl = self.reopen()
+        self.assertEqual(depl.name, "foo")
+        self.assertEqual(depl.args, {"x": "1"})
+        self.assertEqual(depl.rollback_enabled, "1")
+        depl.args = {}
+        self.assertEqual(self.reopen().args, {})
+
+    def test_resource_attrs(self):
+        m = self.depl._create_resource("machine", "none")
+        with self.depl._db:
+            m.index = 3
+            m.obsolete = True
+            m.keys = {"k": {"text": "secret"}}
+        m2 = self.reopen().resources["machine"]
+        self.assertEqual(m2.index, 3)
+        self.assertTrue(m2.obsolete)
+        self.assertEqual(m2.keys, {"k": {"text": "secret"}})
+
+    def test_json_values_are_copies(self):
+        m = self.depl._create_resource("machine", "none")
+        m.owners = ["alice"]
+        owners = m.owners
+        owners.append("bob")
+        self.assertEqual(m.owners, ["alice"])
+
+    def test_writes_survive_exceptions(self):
+        # E.g. a VM that was created before a failure or Ctrl-C must
+        # stay in the state file, or it would be leaked.
+        for exc in [RuntimeError, KeyboardInterrupt]:
+            try:
+                with self.depl._db:
+                    m = self.depl._create_resource("machine-" + exc.__name__, "none")
+                    with self.depl._db:
+                        m.vm_id = "vm-" + exc.__name__
+                    raise exc()
+            except exc:
+                pass
+            m2 = self.reopen().resources["machine-" + exc.__name__]
+            self.assertEqual(m2.vm_id, "vm-" + exc.__name__)
+
+    def test_caught_exception_in_nested_block(self):
+        m = self.depl._create_resource("machine", "none")
+        with self.depl._db:
+            try:
+                with self.depl._db:
+                    m.index = 2
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            m.vm_id = "foo"
+        m2 = self.reopen().resources["machine"]
+        self.assertEqual((m2.index, m2.vm_id), (2, "foo"))
+
+    def test_writes_are_batched(self):
+        m = self.depl._create_resource("machine", "none")
+        with self.depl._db:
+            m.index = 5
+            m.vm_id = "foo"
+            self.assertEqual(self.reopen().resources["machine"].vm_id, None)
+        m2 = self.reopen().resources["machine"]
+        self.assertEqual((m2.index, m2.vm_id), (5, "foo"))
+
+    def test_get_all_deployments(self):
+        self.depl.name = "first"
+        m = self.depl._create_resource("machine", "none")
+        m.vm_id = "vm-1"
+        other = self.sf.create_deployment()
+        other.name = "second"
+        depls = {d.name: d for d in self.sf.get_all_deployments()}
+        self.assertEqual(sorted(depls.keys()), ["first", "second"])
+        self.assertEqual(depls["first"].resources["machine"].vm_id, "vm-1")
+        self.assertEqual(depls["second"].resources, {})
+        self.assertEqual([phase for (phase, t) in self.sf.load_timings],
+                         ["query", "construct"])
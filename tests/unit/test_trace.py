@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import nixops.trace
+
+
+def spans(*specs):
+    return [(name, machine, start, end, False) for (name, machine, start, end) in specs]
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        nixops.trace.reset()
+
+    def tearDown(self):
+        nixops.trace.enable(False)
+        nixops.trace.reset()
+
+    def test_disabled(self):
+        with nixops.trace.span("evaluate"): pass
+        self.assertEqual(nixops.trace.get_spans(), [])
+
+    def test_record(self):
+        nixops.trace.enable()
+        with nixops.trace.span("create", "a"):
+            with nixops.trace.span("wait_for_ssh", "a"): pass
+        try:
+            with nixops.trace.span("copy", "a"): raise Exception("oops")
+        except Exception:
+            pass
+        self.assertEqual([(s[0], s[1], s[4]) for s in nixops.trace.get_spans()],
+                         [("create", "a", False), ("wait_for_ssh", "a", False), ("copy", "a", True)])
+
+    def test_critical_path(self):
+        ss = spans(("evaluate", None, 0, 2), ("create", "a", 2, 5), ("wait_for_ssh", "a", 3, 5),
+                   ("create", "b", 2, 9), ("build", None, 9, 12), ("copy", "a", 12, 13),
+                   ("copy", "b", 12, 15), ("activate", "a", 13, 14))
+        self.assertEqual([(s[0], s[1]) for s in nixops.trace.critical_path(ss)],
+                         [("evaluate", None), ("create", "b"), ("build", None), ("copy", "b")])
+        summary = nixops.trace.summary(ss)
+        self.assertIn("total time: 15.0s", summary)
+        self.assertIn("slowest machines:\n  ‘b’", summary)
+
+    def test_chrome_trace(self):
+        tmpdir = tempfile.mkdtemp(prefix="nixops-test-")
+        try:
+            path = os.path.join(tmpdir, "trace.json")
+            nixops.trace.write_chrome_trace(path, spans(("evaluate", None, 10, 12), ("copy", "a", 12, 13.5)))
+            with open(path) as f: events = json.load(f)['traceEvents']
+            copy = [e for e in events if e['name'] == "copy"][0]
+            self.assertEqual((copy['ph'], copy['ts'], copy['dur'], copy['tid']), ("X", 2000000, 1500000, 1))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,132 @@
+import socket
+import threading
+import time
+import unittest
+
+import nixops.util
+import nixops.wait
+from nixops.wait import Backoff, WaitTimeout, wait_until, wait_for_tcp_ports
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class BackoffTest(unittest.TestCase):
+    def test_delays(self):
+        backoff = Backoff(initial=1, factor=2, max_delay=5, jitter=0)
+        self.assertEqual([backoff.next_delay() for i in range(5)], [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        backoff = Backoff(initial=10, factor=1, jitter=0.5)
+        for i in range(100):
+            self.assertTrue(5 <= backoff.next_delay() <= 15)
+
+    def test_deadline(self):
+        backoff = Backoff(initial=0.01, timeout=0)
+        self.assertRaises(WaitTimeout, backoff.sleep)
+
+
+class WaitUntilTest(unittest.TestCase):
+    def test_success(self):
+        nixops.wait.reset_wait_times()
+        calls = []
+        def test():
+            calls.append(None)
+            return len(calls) == 3
+        self.assertTrue(wait_until(test, initial=0.01, category="test"))
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(0 < nixops.wait.get_wait_times()["test"] < 1)
+
+    def test_max_tries(self):
+        self.assertFalse(wait_until(lambda: False, initial=0.001, max_tries=3, exception=False))
+        self.assertRaises(WaitTimeout, wait_until, lambda: False, initial=0.001, timeout=0.01)
+
+    def test_check_wait_timeout(self):
+        start = time.time()
+        self.assertFalse(nixops.util.check_wait(lambda: False, initial=0.01, max_tries=5, exception=False))
+        self.assertTrue(time.time() - start < 1)
+
+
+class WaitForTCPPortsTest(unittest.TestCase):
+    def test_open_and_closed(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        open_port = listener.getsockname()[1]
+        closed_port = free_port()
+        try:
+            wait_for_tcp_ports([("127.0.0.1", open_port)], timeout=5)
+            wait_for_tcp_ports([("127.0.0.1", closed_port)], open=False, timeout=5)
+            self.assertRaises(WaitTimeout, wait_for_tcp_ports,
+                              [("127.0.0.1", open_port), ("127.0.0.1", closed_port)], timeout=0.3)
+        finally:
+            listener.close()
+
+    def test_port_opens_later(self):
+        port = free_port()
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        calls = []
+        def callback():
+            if not calls:
+                listener.bind(("127.0.0.1", port))
+                listener.listen(5)
+            calls.append(None)
+        try:
+            wait_for_tcp_ports([("127.0.0.1", port)], timeout=10, callback=callback)
+            self.assertEqual(len(calls), 1)
+        finally:
+            listener.close()
+
+
+class TCPProbeTest(unittest.TestCase):
+    def test_transitions(self):
+        listeners = [socket.socket() for i in range(3)]
+        for l in listeners:
+            l.bind(("127.0.0.1", 0))
+            l.listen(5)
+        changes = []
+        def on_change(l, is_open):
+            changes.append((listeners.index(l), is_open))
+            # Simulate a reboot: the port closes once it has been seen open.
+            if is_open: l.close()
+        probe = nixops.wait.TCPProbe(initial=0.01)
+        for l in listeners:
+            probe.add("127.0.0.1", l.getsockname()[1], states=[True, False],
+                      on_change=lambda is_open, l=l: on_change(l, is_open))
+        try:
+            probe.run(timeout=10)
+        finally:
+            for l in listeners: l.close()
+        self.assertEqual(sorted(changes), [(i, s) for i in range(3) for s in (False, True)])
+        for i in range(3):
+            self.assertTrue(changes.index((i, True)) < changes.index((i, False)))
+
+    def test_hold(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        probe = nixops.wait.TCPProbe(initial=0.01)
+        probe.hold()
+        def add():
+            time.sleep(0.3)
+            probe.add("127.0.0.1", listener.getsockname()[1])
+            probe.release()
+        thread = threading.Thread(target=add)
+        thread.start()
+        try:
+            probe.run(timeout=10)
+        finally:
+            thread.join()
+            listener.close()
+        self.assertTrue(all(not t['states'] for t in probe._targets))
+
+    def test_hold_timeout(self):
+        probe = nixops.wait.TCPProbe()
+        probe.hold()
+        self.assertRaises(WaitTimeout, probe.run, timeout=0.3)